@@ -0,0 +1,68 @@
+'''
+Time to tear down a large batch's jobs at once, like when it ends or is stopped, on a
+local sshd: one ssh session per job after a random delay of up to a second, as each
+job used to clean up, against the CleanupQueue tearing them down together.
+
+    python benchmarks/bench_cleanup.py --jobs 2000 --running 200
+'''
+import os
+import time
+import random
+import argparse
+import subprocess
+from local_sshd import LocalSshd
+from ssh_scheduler.better_basic_run import Teardown, machine_command
+from ssh_scheduler.cleanup_queue import CleanupQueue
+
+
+def make_jobs(machine_config, num_jobs, num_running):
+    '''run folders on the machine, the first num_running with a job still running in them'''
+    folders = [f"job_data/bench_cleanup_{i}" for i in range(num_jobs)]
+    setup = f"for i in $(seq 0 {num_jobs - 1}); do mkdir -p job_data/bench_cleanup_$i; done; "
+    setup += f"for i in $(seq 0 {num_running - 1}); do (sleep 600 > /dev/null 2>&1 & echo $! > job_data/bench_cleanup_$i/.job_pid.txt); done"
+    subprocess.run(machine_command(machine_config, setup), shell=True, check=True)
+    return folders
+
+
+def per_job(machine_config, folders, num_running):
+    procs = [
+        subprocess.Popen(f"sleep {random.random()} ; " + Teardown(machine_config, folder, []).command(kill=i < num_running), shell=True, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for i, folder in enumerate(folders)
+    ]
+    failed = sum(proc.wait() != 0 for proc in procs)
+    return len(procs), failed
+
+
+def queued(machine_config, folders, num_running):
+    queue = CleanupQueue()
+    handles = [queue.add(Teardown(machine_config, folder, []), kill=i < num_running) for i, folder in enumerate(folders)]
+    queue.close()
+    failed = sum(handle.wait() != 0 for handle in handles)
+    return queue.sessions, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark tearing down many jobs at once')
+    parser.add_argument('--jobs', type=int, default=2000, help='jobs to tear down')
+    parser.add_argument('--running', type=int, default=200, help='how many of them are still running and need killing')
+    parser.add_argument('--local', action="store_true", help='tear down on this machine without ssh, if there is no sshd to run')
+    args = parser.parse_args()
+
+    def run(machine_config):
+        for name, teardown in [("per job", per_job), ("queued", queued)]:
+            folders = make_jobs(machine_config, args.jobs, args.running)
+            start = time.perf_counter()
+            sessions, failed = teardown(machine_config, folders, args.running)
+            seconds = time.perf_counter() - start
+            left = subprocess.run(machine_command(machine_config, "ls -d job_data/bench_cleanup_* 2> /dev/null | wc -l"), shell=True, stdout=subprocess.PIPE).stdout.decode().strip()
+            print(f"{name:>8}: {seconds:7.2f} s  {sessions:5d} sessions  {failed:5d} failed  {left} folders left", flush=True)
+
+    if args.local:
+        run({"ip": "127.0.0.1", "local": True})
+    else:
+        with LocalSshd(max_sessions=100, max_startups="100:30:200") as sshd:
+            run(sshd.machine_config())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+'''
+Time to move a copy-forward through each codec over a throttled stand-in for the
+link to a machine: tar | compress | throttle | decompress | tar -x on this machine,
+for text, already compressed and mixed payloads, and which codec choose_codec
+picks for each. The pick should be at or near the fastest in every row.
+
+    python benchmarks/bench_compression.py --mb 32 --links 12.5 125 0
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from ssh_scheduler.better_basic_run import DECOMPRESSORS
+from ssh_scheduler.compression import choose_codec, forward_files, local_codecs
+from ssh_scheduler.remote_framer import COMPRESSORS, DEFAULT_LEVELS, sample_ratio
+
+
+def throttle(mb_per_second):
+    '''copies stdin to stdout at mb_per_second, like a link that fast'''
+    start = time.perf_counter()
+    sent = 0
+    chunk = os.read(0, 2**16)
+    while chunk:
+        os.write(1, chunk)
+        sent += len(chunk)
+        ahead = sent / 2**20 / mb_per_second - (time.perf_counter() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+        chunk = os.read(0, 2**16)
+
+
+def make_payload(folder, kind, size_mb):
+    os.makedirs(folder)
+    for i in range(16):
+        text = kind == "text" or (kind == "mixed" and i % 2 == 0)
+        with open(os.path.join(folder, f"{i}.dat"), 'wb') as file:
+            if text:
+                lines = b"".join(b"step %d loss %.6f accuracy %.4f\n" % (j, 1 / (j + 1), j / 1e6) for j in range(size_mb * 2**20 // 16 // 40))
+                file.write(lines[:size_mb * 2**20 // 16])
+            else:
+                file.write(os.urandom(size_mb * 2**20 // 16))
+
+
+def time_transfer(folder, dest, codec, link):
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    compress = decompress = ""
+    if codec is not None:
+        compress = COMPRESSORS[codec].format(level=DEFAULT_LEVELS[codec]) + " | "
+        decompress = DECOMPRESSORS[codec] + " | "
+    link_stage = f"{sys.executable} {os.path.abspath(__file__)} --throttle {link} | " if link else ""
+    command = f"tar -cf - -C {folder} . | {compress}{link_stage}{decompress}tar -xf - -C {dest}"
+    start = time.perf_counter()
+    subprocess.run(command, shell=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark each codec over throttled links')
+    parser.add_argument('--mb', type=int, default=32, help='size of each payload')
+    parser.add_argument('--links', type=float, nargs='*', default=[12.5, 125, 0], help='link speeds in MB/s, 0 for no throttling')
+    parser.add_argument('--throttle', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.throttle:
+        throttle(args.throttle)
+        return
+
+    codecs = local_codecs()
+    folder = tempfile.mkdtemp(prefix="bench_compression_")
+    try:
+        print(f"{'payload':>8} {'link MB/s':>10} {'ratio':>6} " + " ".join(f"{name:>8}" for name in ["none"] + codecs) + "   picked")
+        for kind in ["text", "random", "mixed"]:
+            payload = os.path.join(folder, kind)
+            make_payload(payload, kind, args.mb)
+            ratio = sample_ratio(forward_files([payload]))
+            for link in args.links:
+                times = [time_transfer(payload, os.path.join(folder, "dest"), codec, link) for codec in [None] + codecs]
+                # an unthrottled pipe on one machine stands for a very fast link
+                picked = choose_codec(link or 10000, ratio, codecs)
+                print(f"{kind:>8} {link or 'inf':>10} {ratio:6.2f} " + " ".join(f"{seconds:7.2f}s" for seconds in times) + f"   {picked or 'none'}", flush=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+'''
+Per-job ssh launch latency with and without the connection pool, against a local sshd.
+
+    python benchmarks/bench_connection_pool.py --jobs 50
+'''
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from local_sshd import LocalSshd
+from ssh_scheduler.better_basic_run import make_ssh_command
+from ssh_scheduler.connection_pool import ConnectionPool
+
+
+def time_launches(machine_config, num_jobs):
+    latencies = []
+    for i in range(num_jobs):
+        start = time.perf_counter()
+        subprocess.run(make_ssh_command(machine_config, "true"), shell=True, check=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    print(f"{name:>10}: median {statistics.median(latencies)*1000:7.1f} ms  max {max(latencies)*1000:7.1f} ms  total {sum(latencies):6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark ssh launch latency')
+    parser.add_argument('--jobs', type=int, default=50, help='number of sequential ssh launches')
+    args = parser.parse_args()
+
+    with LocalSshd() as sshd:
+        machine_config = sshd.machine_config()
+        report("fresh", time_launches(machine_config, args.jobs))
+        with ConnectionPool() as pool:
+            if not pool.open(machine_config):
+                sys.exit("could not open control connection")
+            report("pooled", time_launches(machine_config, args.jobs))
+
+
+if __name__ == "__main__":
+    main()
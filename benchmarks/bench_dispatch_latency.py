@@ -0,0 +1,82 @@
+'''
+Gap between a job exiting and the next job starting in its freed slot, for
+thousands of trivial local jobs pushed through scheduler.schedule.
+
+    python benchmarks/bench_dispatch_latency.py --jobs 2000 --slots 8
+
+With --trace, also prints the job trace summary, to compare its overhead.
+'''
+import time
+import argparse
+import statistics
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.dispatch import LaunchRateLimiter
+from ssh_scheduler.job_trace import JobTrace, load_events, summarize, format_summary
+from ssh_scheduler.machine_cost_model import init_machine_limit, get_process_gpu_limit
+
+
+class TimedProc:
+    def __init__(self, finish_times):
+        self.proc = subprocess.Popen(["true"])
+        self.finish_times = finish_times
+
+    def wait(self):
+        self.proc.wait()
+        self.returncode = self.proc.returncode
+        self.finish_times.append(time.perf_counter())
+
+    def close(self):
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark scheduler dispatch latency')
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--slots', type=int, default=8, help='cpus on the simulated machine')
+    parser.add_argument('--launch-rate', type=float, default=0, help='0 for no launch rate limit')
+    parser.add_argument('--trace', help='record a job trace to this file')
+    args = parser.parse_args()
+
+    # cpu bound jobs, the cpu utilization limit decides how many run at once
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**9, "cpu_count": args.slots, "gpus": [{"name": "none", "mem": 1, "free": 1, "utilization": 0.0}]}
+    machine_config = SimpleNamespace(
+        no_gpu_required=False, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    slots = len(get_process_gpu_limit(machine_state, machine_config))
+    init_machine_limit(machine_state)
+    finish_times = []
+    start_times = []
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        start_times.append(time.perf_counter())
+        return TimedProc(finish_times), job_name
+
+    def report(message, line_num, job_name, command):
+        pass
+
+    jobs = [(i, f"job.{i}", "true") for i in range(args.jobs)]
+    trace = JobTrace(args.trace, ["local"], [slots]) if args.trace else None
+    start = time.perf_counter()
+    schedule(jobs, [machine_state], machine_config, launch, report, LaunchRateLimiter(args.launch_rate, slots), trace=trace)
+    total = time.perf_counter() - start
+    if trace is not None:
+        trace.close()
+        print(format_summary(summarize(load_events(args.trace))))
+
+    finish_times.sort()
+    gaps = []
+    # every launch after the slots first fill waits on some earlier job exiting
+    for start_time in start_times[slots:]:
+        before = [t for t in finish_times if t <= start_time]
+        if before:
+            gaps.append(start_time - before[-1])
+    print(f"{slots} concurrent jobs")
+    print(f"{args.jobs} jobs in {total:.2f} s ({args.jobs / total:.0f} jobs/s)")
+    print(f"finish to next start: median {statistics.median(gaps)*1000:.2f} ms, p99 {sorted(gaps)[int(len(gaps)*0.99)]*1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
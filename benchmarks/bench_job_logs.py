@@ -0,0 +1,68 @@
+'''
+Time and disk space to store the output of a job printing a progress bar, written the
+way a StreamDemux writes it (a write and flush for every chunk the job prints): to a file
+opened with line buffering, as jobs' logs used to be, and to LogSinks with each compression,
+and without collapsing progress bars (+\\r).
+
+    python benchmarks/bench_job_logs.py --updates 200000 --lines-every 1000
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from ssh_scheduler.stream_demux import binary_stream
+from ssh_scheduler.job_log import JobLogs, log_files
+
+
+def job_output(num_updates, lines_every):
+    '''chunks a training job prints: a progress bar updated with \\r, and a log line now and then'''
+    for i in range(num_updates):
+        yield b"\rtrain: %6d/%d [loss %.4f] |%s%s|" % (i, num_updates, 1 / (i + 1), b"#" * (i * 40 // num_updates), b" " * (40 - i * 40 // num_updates))
+        if i % lines_every == lines_every - 1:
+            yield b"\nstep %d: validation loss %.4f\n" % (i, 1 / (i + 1))
+
+
+def write_all(fileobj, chunks):
+    stream = binary_stream(fileobj, None)
+    for chunk in chunks:
+        stream.write(chunk)
+        stream.flush()
+
+
+def disk_usage(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark storing job output logs')
+    parser.add_argument('--updates', type=int, default=200000, help='progress bar updates the job prints')
+    parser.add_argument('--lines-every', type=int, default=1000, help='updates between full log lines')
+    parser.add_argument('--max-mb', type=int, default=0, help='rotate logs at this size, 0 for no rotation')
+    args = parser.parse_args()
+
+    chunks = list(job_output(args.updates, args.lines_every))
+    print(f"{len(chunks)} writes, {sum(len(chunk) for chunk in chunks) / 2**20:.1f} MB of output")
+    folder = tempfile.mkdtemp(prefix="bench_job_logs_")
+    try:
+        base = os.path.join(folder, "line_buffered.out")
+        start = time.perf_counter()
+        with open(base, 'a', buffering=1) as file:
+            write_all(file, chunks)
+        print(f"{'line buffered':>14}: {time.perf_counter() - start:6.2f} s  {disk_usage([base]) / 2**20:8.2f} MB")
+        for compression, collapse_cr in [("none", False), ("none", True), ("gzip", True), ("zstd", True)]:
+            if compression == "zstd" and not shutil.which("zstd"):
+                continue
+            name = f"sink {compression}" + ("" if collapse_cr else " +\\r")
+            base = os.path.join(folder, name.replace(" ", "_") + ".out")
+            logs = JobLogs(compression, max_bytes=args.max_mb * 2**20 or None, collapse_cr=collapse_cr)
+            start = time.perf_counter()
+            write_all(logs.open(base), chunks)
+            logs.close()
+            print(f"{name:>14}: {time.perf_counter() - start:6.2f} s  {disk_usage(log_files(base)) / 2**20:8.2f} MB", flush=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+'''
+Cost of placing and releasing jobs with the ResourceLedger, against the old
+copy-and-chain add_to_machine_state/remove_from_machine_state.
+
+    python benchmarks/bench_ledger.py --placements 100000
+'''
+import copy
+import time
+import random
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+from ssh_scheduler.machine_cost_model import init_machine_limit, add_to_machine_state, remove_from_machine_state, ResourceLedger
+
+machine_config = SimpleNamespace(
+    no_gpu_required=False, no_reserve_gpu=True, gpu_memory_required=1, gpu_utilization=0.0001,
+    reserve=False, num_cpus=1, memory_required=1
+)
+
+
+def make_states(num_machines):
+    state = {"cpu_usage": 0.0, "mem_free": 10**9, "cpu_count": 64,
+             "gpus": [{"name": "gpu", "mem": 10**9, "free": 10**9, "utilization": 0.0} for _ in range(8)]}
+    init_machine_limit(state)
+    return [copy.deepcopy(state) for _ in range(num_machines)]
+
+
+def placements(num, num_machines, seed=0):
+    rng = random.Random(seed)
+    return [(rng.randrange(num_machines), rng.randrange(8)) for _ in range(num)]
+
+
+def bench_ledger(states, places, rng):
+    ledger = ResourceLedger(states)
+    for job_id, (machine_idx, gpu_idx) in enumerate(places):
+        ledger.allocate(job_id, machine_idx, gpu_idx, machine_config)
+    release_order = list(range(len(places)))
+    rng.shuffle(release_order)
+    for job_id in release_order:
+        ledger.release(job_id)
+
+
+def bench_chain(states, places):
+    # the old chain can only pop the latest addition, so release in reverse order
+    for machine_idx, gpu_idx in places:
+        states[machine_idx] = add_to_machine_state(states[machine_idx], machine_config, gpu_idx)
+    for machine_idx, gpu_idx in reversed(places):
+        states[machine_idx] = remove_from_machine_state(states[machine_idx], gpu_idx)
+
+
+def measure(name, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    # tracing slows things down, so memory is measured on a separate run
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:>8}: {elapsed:6.2f} s, peak memory {peak / 2**20:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark resource accounting')
+    parser.add_argument('--placements', type=int, default=100000)
+    parser.add_argument('--machines', type=int, default=500)
+    args = parser.parse_args()
+    places = placements(args.placements, args.machines)
+    measure("ledger", lambda: bench_ledger(make_states(args.machines), places, random.Random(1)))
+    measure("chain", lambda: bench_chain(make_states(args.machines), places))
+
+
+if __name__ == "__main__":
+    main()
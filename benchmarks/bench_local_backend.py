@@ -0,0 +1,68 @@
+'''
+Time to run one job with a large working directory on this machine, through ssh and tar
+to a local sshd, and through the local fast path with each way of building its workspace.
+
+    python benchmarks/bench_local_backend.py --files 2000 --file-kb 256 --jobs 5
+'''
+import os
+import io
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from local_sshd import LocalSshd
+from ssh_scheduler.better_basic_run import generate_command
+from ssh_scheduler.local_runner import LINK_MODES
+
+
+def make_working_dir(folder, num_files, file_kb):
+    for i in range(num_files):
+        subfolder = os.path.join(folder, "data", str(i % 50))
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, f"{i}.bin"), 'wb') as file:
+            file.write(os.urandom(file_kb * 1024))
+
+
+def time_jobs(machine_config, num_jobs):
+    times = []
+    for i in range(num_jobs):
+        start = time.perf_counter()
+        with open(os.devnull, 'wb') as devnull:
+            proc = generate_command(["."], ["result.txt"], machine_config, f"bench_{i}", False, "du -s data > result.txt", io.BytesIO(), devnull)
+            assert proc.wait() == 0
+        for cleanup in proc.close():
+            cleanup.wait()
+        times.append(time.perf_counter() - start)
+        shutil.rmtree(f"job_results/bench_{i}")
+    return times
+
+
+def report(name, times):
+    print(f"{name:>10}: median {statistics.median(times)*1000:8.1f} ms  max {max(times)*1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the local fast path against ssh to localhost')
+    parser.add_argument('--files', type=int, default=2000, help='files in the working directory')
+    parser.add_argument('--file-kb', type=int, default=256, help='size of each file')
+    parser.add_argument('--jobs', type=int, default=5, help='jobs run one after another on each path')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="bench_local_")
+    cwd = os.getcwd()
+    try:
+        make_working_dir(folder, args.files, args.file_kb)
+        os.chdir(folder)
+        print(f"working directory of {args.files * args.file_kb / 1024:.0f} MB in {args.files} files")
+        with LocalSshd() as sshd:
+            report("ssh", time_jobs(dict(sshd.machine_config(), local=False), args.jobs))
+        for mode in LINK_MODES:
+            report(mode, time_jobs({"ip": "127.0.0.1", "local": True, "link_mode": mode}, args.jobs))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+'''
+Copy-forward bytes sent for a --commands batch whose lines each name one of a few
+dataset folders, run in runs of the same dataset, through scheduler.schedule on
+simulated machines, with and without the locality term of --transfer-cost.
+Jobs are short local processes, so only placement is measured, not the transfers:
+the time shows what stacking jobs on the machines holding their data costs.
+
+    python benchmarks/bench_locality.py --jobs 400 --machines 8 --datasets 20 --dataset-mb 64 --cache-mb 256
+'''
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.dispatch import LaunchRateLimiter
+from ssh_scheduler.locality import Locality, payload_fingerprint
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def make_datasets(folder, count, size_mb):
+    datasets = []
+    for i in range(count):
+        path = os.path.join(folder, f"dataset{i}")
+        os.makedirs(path)
+        with open(os.path.join(path, "data.bin"), 'wb') as file:
+            file.write(os.urandom(size_mb * 2**20))
+        datasets.append(path)
+    return datasets
+
+
+def run(jobs, datasets, num_machines, cpus, transfer_cost, capacity):
+    machine_states = [{"cpu_usage": 0.0, "mem_free": 10**9, "cpu_count": cpus, "gpus": []} for _ in range(num_machines)]
+    for machine_state in machine_states:
+        init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    locality = Locality(num_machines, lambda command: [datasets[int(command.split()[-1])]], transfer_cost, capacity)
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        return subprocess.Popen(command.split()[:2]), job_name
+
+    start = time.perf_counter()
+    schedule(jobs, machine_states, machine_config, launch, lambda *args: None, LaunchRateLimiter(None), locality=locality)
+    return time.perf_counter() - start, locality
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark locality aware placement')
+    parser.add_argument('--jobs', type=int, default=400)
+    parser.add_argument('--machines', type=int, default=8)
+    parser.add_argument('--cpus', type=int, default=8, help='cpus of each simulated machine')
+    parser.add_argument('--datasets', type=int, default=20)
+    parser.add_argument('--dataset-mb', type=int, default=64)
+    parser.add_argument('--cache-mb', type=int, default=256, help='copy-forwards each machine keeps, as --cache-size')
+    parser.add_argument('--run-length', type=int, default=8, help='consecutive lines naming the same dataset')
+    parser.add_argument('--transfer-costs', type=float, nargs='*', default=[0, 0.1, 1, 10])
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    jobs = [
+        (i, f"job.{i}", f"sleep {rng.uniform(0.05, 0.2):.3f} {(i // args.run_length) % args.datasets}")
+        for i in range(args.jobs)
+    ]
+    folder = tempfile.mkdtemp(prefix="bench_locality_")
+    try:
+        datasets = make_datasets(folder, args.datasets, args.dataset_mb)
+        # hash the datasets once up front, as the first run would otherwise pay for it
+        for dataset in datasets:
+            payload_fingerprint([dataset])
+        for transfer_cost in args.transfer_costs:
+            seconds, locality = run(jobs, datasets, args.machines, args.cpus, transfer_cost, args.cache_mb * 2**20)
+            print(f"transfer cost {transfer_cost:5.2f}: {seconds:6.2f} s  {locality.bytes_sent / 2**30:7.2f} GB sent  {locality.bytes_avoided / 2**30:7.2f} GB avoided  {locality.hits}/{locality.jobs} jobs on their data", flush=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
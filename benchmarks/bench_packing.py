@@ -0,0 +1,65 @@
+'''
+Jobs per second for short commands with and without job packing, run through
+scheduler.schedule against a local sshd.
+
+    python benchmarks/bench_packing.py --jobs 64 --slots 4 --pack-size 8 --seconds 1
+'''
+import os
+import time
+import argparse
+import tempfile
+from types import SimpleNamespace
+from local_sshd import LocalSshd
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.better_basic_run import generate_command, generate_pack_command
+from ssh_scheduler.dispatch import LaunchRateLimiter, Packer
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def run_batch(machine_config, args, packed):
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**9, "cpu_count": args.slots, "gpus": []}
+    init_machine_limit(machine_state)
+    scheduler_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    devnull = open(os.devnull, 'w')
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        return generate_command([], [], machine_config, job_name, False, command, stdout=devnull, stderr=devnull), job_name
+
+    def launch_pack(pack, machine_idx, gpu_idx):
+        jobs = [(job_name, command, devnull, devnull) for _, job_name, command in pack]
+        procs = generate_pack_command([], [], machine_config, pack[0][1] + ".pack", False, jobs, stderr=devnull)
+        return [(proc, job_name) for proc, (_, job_name, _) in zip(procs, pack)]
+
+    def report(message, line_num, job_name, command):
+        pass
+
+    prefix = "packed" if packed else "single"
+    jobs = [(i, f"{prefix}.{i}", f"sleep {args.seconds}") for i in range(args.jobs)]
+    packer = Packer(args.pack_size) if packed else None
+    start = time.perf_counter()
+    schedule(jobs, [machine_state], scheduler_config, launch, report, LaunchRateLimiter(None), packer=packer, launch_pack=launch_pack)
+    return args.jobs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark job packing')
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--slots', type=int, default=4, help='jobs (or packs) running at once')
+    parser.add_argument('--pack-size', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=1, help='how long each command sleeps')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_packing_"))
+    with LocalSshd(max_sessions=4 * args.slots) as sshd:
+        machine_config = sshd.machine_config()
+        ideal = args.slots / args.seconds
+        for packed in (False, True):
+            rate = run_batch(machine_config, args, packed)
+            print(f"{'packed' if packed else 'unpacked':>8}: {rate:6.2f} jobs/s ({100 * rate / ideal:5.1f}% of the {ideal:.2f} jobs/s the slots allow)")
+
+
+if __name__ == "__main__":
+    main()
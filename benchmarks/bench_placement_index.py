@@ -0,0 +1,64 @@
+'''
+Scheduler CPU time per placement as the cluster grows, rescoring every machine
+(get_best_machine) against the incrementally updated MachineIndex.
+
+    python benchmarks/bench_placement_index.py --machines 10 100 500 2000
+'''
+import copy
+import time
+import random
+import argparse
+from types import SimpleNamespace
+from ssh_scheduler.machine_cost_model import (
+    init_machine_limit, get_best_machine, get_best_gpu, machine_cost, is_over_limit, ResourceLedger, MachineIndex
+)
+
+machine_config = SimpleNamespace(
+    no_gpu_required=False, no_reserve_gpu=False, gpu_memory_required=1000, gpu_utilization=0.5,
+    reserve=False, num_cpus=4, memory_required=4000
+)
+
+
+def make_states(num_machines, num_gpus, rng):
+    states = []
+    for i in range(num_machines):
+        state = {"cpu_usage": rng.random() * 0.3, "mem_free": 256000, "cpu_count": 64,
+                 "gpus": [{"name": "gpu", "mem": 24000, "free": 24000, "utilization": rng.random() * 0.2} for _ in range(num_gpus)]}
+        init_machine_limit(state)
+        states.append(state)
+    return states
+
+
+def run(num_machines, num_gpus, num_jobs, use_index):
+    '''places num_jobs, releasing a random running job whenever the cluster is full'''
+    rng = random.Random(0)
+    states = make_states(num_machines, num_gpus, rng)
+    index = MachineIndex(states, machine_config) if use_index else None
+    ledger = ResourceLedger(states, on_change=index.update if use_index else None)
+    start = time.perf_counter()
+    for job_id in range(num_jobs):
+        while True:
+            best = index.best() if use_index else get_best_machine(states, machine_config)
+            ledger.allocate(job_id, best, get_best_gpu(machine_config, states[best]), machine_config)
+            if not is_over_limit(machine_cost(machine_config, states[best])):
+                break
+            ledger.release(job_id)
+            ledger.release(rng.choice(list(ledger.reservations)))
+    return (time.perf_counter() - start) / num_jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark best machine selection')
+    parser.add_argument('--machines', type=int, nargs='*', default=[10, 100, 500, 2000])
+    parser.add_argument('--gpus', type=int, default=8)
+    parser.add_argument('--jobs', type=int, default=5000)
+    args = parser.parse_args()
+    print(f"{'machines':>8} {'argmin us/job':>14} {'index us/job':>13} {'speedup':>8}")
+    for num_machines in args.machines:
+        scan = run(num_machines, args.gpus, args.jobs, False)
+        indexed = run(num_machines, args.gpus, args.jobs, True)
+        print(f"{num_machines:>8} {scan*1e6:>14.1f} {indexed*1e6:>13.1f} {scan/indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
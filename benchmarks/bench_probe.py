@@ -0,0 +1,35 @@
+'''
+Wall time and CPU time of each resource probe, run locally as it would be over ssh.
+
+    python benchmarks/bench_probe.py --runs 20
+'''
+import time
+import resource
+import argparse
+import subprocess
+from ssh_scheduler.query_machine_info import PROBES
+
+
+def child_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark resource probes')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    for name, (get_command, parse_output) in sorted(PROBES.items()):
+        wall = 0
+        cpu_before = child_cpu_time()
+        for i in range(args.runs):
+            start = time.perf_counter()
+            out = subprocess.run(get_command(), shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            parse_output(out.stdout.decode("utf-8"))
+            wall += time.perf_counter() - start
+        cpu = child_cpu_time() - cpu_before
+        print(f"{name:>5}: {wall / args.runs * 1000:7.1f} ms wall, {cpu / args.runs * 1000:6.1f} ms cpu per probe")
+
+
+if __name__ == "__main__":
+    main()
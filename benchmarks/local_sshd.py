@@ -0,0 +1,88 @@
+'''
+Starts a throwaway sshd on localhost for benchmarks, running as the current user
+with its own host key and a passwordless client key. Requires the openssh server binary.
+'''
+import os
+import time
+import shutil
+import socket
+import getpass
+import tempfile
+import subprocess
+
+SSHD_PATHS = ["/usr/sbin/sshd", "/usr/bin/sshd", "/usr/local/sbin/sshd"]
+
+
+def find_sshd():
+    for path in SSHD_PATHS:
+        if os.path.exists(path):
+            return path
+    return shutil.which("sshd")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalSshd:
+    def __init__(self, max_sessions=10, max_startups="10:30:100"):
+        self.sshd_path = find_sshd()
+        if self.sshd_path is None:
+            raise RuntimeError("sshd binary not found, install openssh-server to run this benchmark")
+        self.folder = tempfile.mkdtemp(prefix="local_sshd_")
+        self.port = free_port()
+        self.max_sessions = max_sessions
+        self.max_startups = max_startups
+        self.proc = None
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def start(self):
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", self.path("host_key")], check=True)
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", self.path("client_key")], check=True)
+        shutil.copy(self.path("client_key.pub"), self.path("authorized_keys"))
+        with open(self.path("sshd_config"), 'w') as file:
+            file.write(f"""
+Port {self.port}
+ListenAddress 127.0.0.1
+HostKey {self.path("host_key")}
+AuthorizedKeysFile {self.path("authorized_keys")}
+PidFile {self.path("sshd.pid")}
+StrictModes no
+UsePAM no
+PasswordAuthentication no
+MaxSessions {self.max_sessions}
+MaxStartups {self.max_startups}
+""")
+        self.proc = subprocess.Popen([self.sshd_path, "-D", "-e", "-f", self.path("sshd_config")], stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("local sshd did not start")
+
+    def machine_config(self):
+        return {
+            "username": getpass.getuser(),
+            "ip": "127.0.0.1",
+            "port": self.port,
+            "ssh_key_path": self.path("client_key"),
+        }
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -0,0 +1,268 @@
+'''
+Client side of the agent backend: keeps remote_agent.py running on each machine
+over one ssh session and runs jobs through it, instead of starting new ssh
+sessions to set up, run, and clean up every job as generate_command does.
+'''
+import os
+import json
+import threading
+import subprocess
+from . import forward_cache
+from . import remote_framer
+from .stream_demux import StreamDemux, JobStream
+from .remote_agent import START, INPUT, KILL, STARTED, STDOUT, STDERR, EXIT, RESULTS, END, CHUNK_SIZE, write_message, read_message
+from .better_basic_run import make_ssh_command, remote_python_command, remote_script, rand_fname, export_lines, pin_lines, machine_codec, compress_args, DECOMPRESSORS
+from .connection_pool import ssh_destination
+
+# agent messages that StreamDemux understands, by their remote_framer channel
+DEMUX_CHANNELS = {
+    STARTED: remote_framer.STARTED,
+    STDOUT: remote_framer.STDOUT,
+    STDERR: remote_framer.STDERR,
+    EXIT: remote_framer.EXIT,
+    RESULTS: remote_framer.RESULTS,
+}
+
+
+class InputWriter:
+    '''file-like that sends what is written to it as the job's INPUT messages'''
+    def __init__(self, agent, job_id):
+        self.agent = agent
+        self.job_id = job_id
+
+    def write(self, data):
+        for start in range(0, len(data), CHUNK_SIZE):
+            self.agent.send(INPUT, self.job_id, bytes(data[start:start + CHUNK_SIZE]))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class AgentProcess:
+    '''process-like handle of a job running on an agent, like CleanupShellProcess'''
+    def __init__(self, agent, job_id, demux):
+        self.agent = agent
+        self.job_id = job_id
+        self.demux = demux
+        self.stream = JobStream()
+        self.returncode = None
+        self.reader = threading.Thread(target=demux.run, args=(self.stream,), daemon=True)
+        self.reader.start()
+
+    def _set_returncode(self):
+        # like ssh, 255 when the connection dropped before the job exited
+        self.returncode = self.demux.returncode if self.demux.returncode is not None else 255
+
+    def wait(self):
+        self.reader.join()
+        self._set_returncode()
+        return self.returncode
+
+    def poll(self):
+        if self.reader.is_alive():
+            return None
+        self._set_returncode()
+        return self.returncode
+
+    def kill(self):
+        self.agent.send(KILL, self.job_id)
+
+    def close(self):
+        '''the agent removes the job folder itself, so there are no cleanup processes to return'''
+        if self.reader.is_alive():
+            self.kill()
+        return []
+
+
+class RemoteAgent:
+    '''
+    one remote_agent.py process, started with command, usually an ssh command.
+    Jobs are multiplexed over its stdin and stdout.
+    '''
+    def __init__(self, command):
+        self.proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_id = 1
+        self.disconnected = False
+        self.reader = threading.Thread(target=self.run, daemon=True)
+        self.reader.start()
+
+    def send(self, kind, job_id, payload=b""):
+        try:
+            with self.lock:
+                write_message(self.proc.stdin, kind, job_id, payload)
+                self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # the reader thread ends the agent's jobs
+            pass
+
+    def alive(self):
+        return not self.disconnected and self.proc.poll() is None
+
+    def submit(self, spec, demux, feed):
+        '''
+        starts a job from spec (see remote_agent.AgentJob), whose output goes to demux.
+        feed is called in a thread with a file to write the job's copy-forward archive to.
+        '''
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            job = AgentProcess(self, job_id, demux)
+            if self.disconnected:
+                job.stream.end()
+                return job
+            self.jobs[job_id] = job
+        self.send(START, job_id, json.dumps(spec).encode("utf-8"))
+        threading.Thread(target=self._feed, args=(job_id, feed), daemon=True).start()
+        return job
+
+    def _feed(self, job_id, feed):
+        feed(InputWriter(self, job_id))
+        self.send(INPUT, job_id, b"")
+
+    def run(self):
+        while True:
+            kind, job_id, payload = read_message(self.proc.stdout)
+            if kind is None:
+                break
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == END:
+                with self.lock:
+                    del self.jobs[job_id]
+                job.stream.end()
+            elif kind in DEMUX_CHANNELS:
+                job.stream.put(DEMUX_CHANNELS[kind], payload)
+        with self.lock:
+            self.disconnected = True
+            jobs, self.jobs = self.jobs, {}
+        for job in jobs.values():
+            job.stream.end()
+
+    def close(self):
+        '''the agent kills its remaining jobs once its input closes'''
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+
+
+class AgentPool:
+    '''one RemoteAgent per machine, started on first use and restarted if it disconnects'''
+    def __init__(self):
+        self.agents = {}
+
+    def agent_command(self, machine_config):
+        return make_ssh_command(machine_config, agent_python_command(machine_config))
+
+    def get(self, machine_config):
+        key = (ssh_destination(machine_config), machine_config.get('port', 22))
+        agent = self.agents.get(key)
+        if agent is None or not agent.alive():
+            agent = RemoteAgent(self.agent_command(machine_config))
+            self.agents[key] = agent
+        return agent
+
+    def close(self):
+        for agent in self.agents.values():
+            agent.close()
+        self.agents = {}
+
+
+def agent_python_command(machine_config):
+    '''runs remote_agent.py, with the remote_framer.py it imports'''
+    return remote_python_command(machine_config, remote_script("remote_agent.py"), "", modules=[remote_script("remote_framer.py")])
+
+
+def compressed_feed(feed, compressor):
+    '''feed writing what feed writes through compressor, a shell command'''
+    def compressed(writer):
+        proc = subprocess.Popen(compressor, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def fill():
+            try:
+                feed(proc.stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        filler = threading.Thread(target=fill, daemon=True)
+        filler.start()
+        chunk = proc.stdout.read(CHUNK_SIZE)
+        while chunk:
+            writer.write(chunk)
+            chunk = proc.stdout.read(CHUNK_SIZE)
+        filler.join()
+        proc.wait()
+    return compressed
+
+
+def pump_tar(copy_forwards):
+    '''feed that archives copy_forwards like generate_command does'''
+    def feed(writer):
+        tar = subprocess.Popen(
+            ["tar", "--exclude", "job_results", "--exclude", ".git", "-cmf", "-"] + list(copy_forwards),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE
+        )
+        chunk = tar.stdout.read(CHUNK_SIZE)
+        while chunk:
+            writer.write(chunk)
+            chunk = tar.stdout.read(CHUNK_SIZE)
+        tar.wait()
+    return feed
+
+
+def run_on_agent(
+    agent,
+    copy_forwards,
+    copy_backwards,
+    machine_config,
+    job_name,
+    command,
+    stdout=None,
+    stderr=None,
+    cache=None,
+    env=None,
+    cpus=None,
+    copy_back_all=False
+):
+    '''
+    like generate_command, but runs the job through agent, a RemoteAgent on the machine.
+    Both ways are compressed as the machine config's compression says, see machine_codec.
+    '''
+    job_name = rand_fname() if job_name == "__random__" else job_name
+    local_data_folder = "job_results/"+job_name
+    if copy_backwards and os.path.exists(local_data_folder):
+        raise RuntimeError(f"results for job '{job_name}' already exist, move or remove files before continuing")
+    spec = {
+        "folder": "job_data/"+job_name,
+        "script": export_lines(env) + pin_lines(cpus) + command + "\n",
+        "copy_backwards": list(copy_backwards),
+        "copy_back_all": copy_back_all,
+    }
+    results_args = compress_args(machine_config)
+    if results_args:
+        spec["compress"] = results_args[1]
+    codec = machine_codec(machine_config)
+    decompress = DECOMPRESSORS[codec[0]] + " | " if codec is not None else ""
+    if cache is None:
+        if not copy_forwards:
+            feed = lambda writer: None
+        else:
+            feed = pump_tar(copy_forwards)
+            spec["unpack"] = decompress + "tar -x"
+    else:
+        manifest = forward_cache.build_manifest(copy_forwards)
+        query_command = remote_python_command(machine_config, remote_script("remote_cache.py"), f"missing {cache['dir']}")
+        missing = forward_cache.query_missing(make_ssh_command(machine_config, query_command), manifest)
+        feed = lambda writer: forward_cache.write_payload(writer, manifest, missing)
+        spec["unpack"] = decompress + remote_python_command(machine_config, remote_script("remote_cache.py"), forward_cache.build_args(cache))
+    if codec is not None and "unpack" in spec:
+        feed = compressed_feed(feed, remote_framer.COMPRESSORS[codec[0]].format(level=codec[1]))
+    demux = StreamDemux(stdout, stderr, local_data_folder if copy_backwards else None)
+    return agent.submit(spec, demux, feed)
@@ -1,8 +1,8 @@
 import os
-import subprocess
+import sys
 import argparse
-import subprocess
-from better_basic_run import generate_command, load_data_from_yaml
+from .better_basic_run import generate_command, load_data_from_yaml
+from .fan_out import run_bounded, distribute, unpack_first, Progress
 
 
 my_folder = os.path.dirname(os.path.realpath(__file__))
@@ -15,26 +15,44 @@ def main():
     parser.add_argument('--machines', nargs='*', help='machine id', required=True)
     parser.add_argument('--job-name', default="__random__", help='job name')
     parser.add_argument('--verbose', action="store_true", help='print debugging information to stderr')
+    parser.add_argument('--max-parallel', type=int, default=32, help='most machines copied to or run on at once')
+    parser.add_argument('--relay', action="store_true", help='send the copy-forwards to a few machines, which pass them on to the rest over their own ssh, instead of sending them to every machine')
+    parser.add_argument('--relay-fanout', type=int, default=4, help='with --relay, how many machines each machine that has the copy-forwards sends them to at once')
     parser.add_argument('command')
 
     args = parser.parse_args()
 
-    procs = []
-    for i,machine in enumerate(args.machines):
+    machine_configs = [load_data_from_yaml(machine) for machine in args.machines]
+    targets = list(range(len(machine_configs)))
+    copy_forwards = args.copy_forwards
+    command = args.command
+    if args.relay and copy_forwards:
+        path, received = distribute(copy_forwards, machine_configs, args.machines, args.relay_fanout, args.max_parallel)
+        targets = sorted(received)
+        copy_forwards = []
+        command = unpack_first(path, command)
+
+    progress = Progress(args.machines, "run")
+    for i in set(range(len(machine_configs))) - set(targets):
+        progress.failed.append(args.machines[i])
+
+    def start(i):
         job_name = "__random__" if args.job_name == "__random__" else f"{args.job_name}_{i}"
-        machine_config = load_data_from_yaml(machine)
-        procs.append(generate_command(
-            args.copy_forwards,
+        return generate_command(
+            copy_forwards,
             args.copy_backwards,
-            machine_config,
+            machine_configs[i],
             job_name,
             args.verbose,
-            args.command,
+            command,
             stdout=None,
             stderr=None
-        ))
-    for proc in procs:
-        proc.communicate()
+        )
+
+    run_bounded(targets, start, args.max_parallel, lambda i, returncode: progress.done(i, returncode == 0))
+    print(progress.summary(), file=sys.stderr, flush=True)
+    if progress.failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+'''
+Reads the jobs of a batch lazily, so memory stays flat however many there are.
+A batch is either a file with one command per line, or a YAML sweep file:
+
+    command: python train.py --lr {lr} --seed {seed} --data {data}
+    product:
+      lr: [0.1, 0.01, 0.001]
+      seed: {start: 0, stop: 100}
+    zip:
+      data: [a.csv, b.csv]
+      batch_size: [32, 64]
+
+which runs command once per point of the cartesian product of the product axes,
+with the zip axes moving together (so 3 * 100 * 2 jobs). An axis is a list of values
+or a range, {start, stop, step}. Use {{ and }} for literal braces in the command.
+'''
+import re
+import hashlib
+import itertools
+import yaml
+
+SWEEP_EXTENSIONS = (".yaml", ".yml")
+MAX_POINT_NAME = 100
+
+
+def is_sweep(path):
+    return path.endswith(SWEEP_EXTENSIONS)
+
+
+def read_lines(path):
+    '''yields (line_num, name, command), name being the line number counted from 1'''
+    with open(path) as file:
+        for line_num, line in enumerate(file):
+            yield line_num, str(line_num + 1), line.strip()
+
+
+def axis_values(spec):
+    if isinstance(spec, dict):
+        start, stop, step = spec.get("start", 0), spec["stop"], spec.get("step", 1)
+        if all(isinstance(v, int) for v in (start, stop, step)):
+            return range(start, stop, step)
+        count = max(0, int(-(-(stop - start) // step)))
+        return [start + i * step for i in range(count)]
+    if not isinstance(spec, list):
+        return [spec]
+    return spec
+
+
+def point_name(params):
+    '''
+    a job name for a point of the sweep, from every key=value of it, hashed if longer than
+    MAX_POINT_NAME. Points keep their names when an axis gets more values, so --resume
+    picks up an extended sweep, but adding an axis renames every point.
+    '''
+    name = ".".join(f"{key}={value}" for key, value in params.items())
+    name = re.sub(r"[^A-Za-z0-9_.=+-]", "_", name)
+    if len(name) > MAX_POINT_NAME:
+        name = hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+    return name
+
+
+def expand_sweep(sweep):
+    '''yields the parameters of every point of the sweep, as dicts'''
+    product_axes = sweep.get("product") or {}
+    zip_axes = sweep.get("zip") or {}
+    zip_values = [list(axis_values(spec)) for spec in zip_axes.values()]
+    if len({len(values) for values in zip_values}) > 1:
+        raise ValueError(f"zip axes {', '.join(zip_axes)} must all have the same number of values")
+    zipped = list(zip(*zip_values)) if zip_axes else [()]
+    product_values = [axis_values(spec) for spec in product_axes.values()]
+    for zip_point in zipped:
+        for product_point in itertools.product(*product_values):
+            params = dict(zip(zip_axes, zip_point))
+            params.update(zip(product_axes, product_point))
+            yield params
+
+
+def read_sweep(path):
+    '''yields (index, name, command) for every point of the sweep file at path'''
+    with open(path) as file:
+        sweep = yaml.safe_load(file)
+    for index, params in enumerate(expand_sweep(sweep)):
+        yield index, point_name(params), sweep["command"].format(**params)
+
+
+def read_batch(path):
+    '''yields (line_num, name, command) for each job of the batch file at path'''
+    return read_sweep(path) if is_sweep(path) else read_lines(path)
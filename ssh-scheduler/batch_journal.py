@@ -0,0 +1,133 @@
+'''
+Append-only record of a batch, one JSON object per line:
+
+    {"event": EVENT, "line": LINE_NUM, "job": JOB_NAME, "time": UNIX_TIME, ...}
+
+EVENT is queued (with the "command"), started (with "machine", "gpu", "pack",
+the first job of its pack if it was packed, and "run", the name the job runs under
+if launching it gave it another, like a --job-name in a --commands line), speculating (when a second "copy" of
+a straggler is started on "copy_machine"), finished, failed or retrying (after
+its ssh connection failed, before it is started again). Every event is
+flushed as it is written, so after the scheduler dies the journal still says
+which jobs finished, and which were left running on which machine.
+JOB_NAME is always the name the job was queued as, which stays the same when lines
+are reordered or sweep axes extended, while LINE_NUM may then point at another job.
+A batch event, with no line, records the machine states and the resources
+requested at the start of each run, for simulate.py to replay the batch.
+'''
+import os
+import json
+import time
+import subprocess
+from .better_basic_run import machine_command, load_data_from_yaml, printe, is_local, LOCAL_RUN_FOLDER
+
+
+# the fields of a machine config the cost model reserves resources by
+RESOURCE_FIELDS = ["num_cpus", "memory_required", "reserve", "no_reserve_gpu", "no_gpu_required", "gpu_memory_required", "gpu_utilization", "num_gpus", "pin_cpus"]
+
+
+class BatchJournal:
+    def __init__(self, path, machines):
+        self.machines = machines
+        self.file = open(path, 'a', buffering=1)
+
+    def record(self, event, line_num, job_name, **fields):
+        entry = {"event": event, "line": line_num, "job": job_name, "time": time.time()}
+        entry.update(fields)
+        self.file.write(json.dumps(entry) + "\n")
+
+    def batch(self, machine_infos, machine_config):
+        resources = {field: getattr(machine_config, field) for field in RESOURCE_FIELDS if hasattr(machine_config, field)}
+        self.record("batch", None, None, machines=self.machines, infos=machine_infos, resources=resources)
+
+    def queued(self, line_num, job_name, command):
+        self.record("queued", line_num, job_name, command=command)
+
+    def started(self, line_num, job_name, machine_idx, gpu_idx, pack=None, run=None):
+        self.record("started", line_num, job_name, machine=self.machines[machine_idx], gpu=gpu_idx, pack=pack, run=run)
+
+    def speculating(self, line_num, job_name, copy_name, machine_idx):
+        self.record("speculating", line_num, job_name, copy=copy_name, copy_machine=self.machines[machine_idx])
+
+    def close(self):
+        self.file.close()
+
+
+def load_journal(path):
+    '''
+    job name -> the fields of all of the job's events merged in order, so "event" is its latest.
+    A last line cut short by a crash is ignored.
+    '''
+    statuses = {}
+    with open(path) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["job"] is None:
+                continue
+            statuses.setdefault(entry["job"], {}).update(entry)
+    return statuses
+
+
+def is_done(status, command):
+    '''whether the journal says the job finished, running the same command it has now'''
+    return status is not None and status["event"] == "finished" and status.get("command") == command
+
+
+def orphaned_jobs(statuses):
+    '''machine -> the jobs the journal says were left running there'''
+    orphans = {}
+    for status in statuses.values():
+        if status["event"] in ("started", "speculating"):
+            orphans.setdefault(status["machine"], []).append(status)
+        if status["event"] == "speculating":
+            orphans.setdefault(status["copy_machine"], []).append({"job": status["copy"]})
+    return orphans
+
+
+def run_folders(jobs, root="job_data/"):
+    folders = set()
+    for job in jobs:
+        folders.add(root+(job.get("run") or job["job"]))
+        if job.get("pack"):
+            folders.add(root+job["pack"]+".pack")
+    return sorted(folders)
+
+
+def reconcile_command(folders):
+    '''kills whatever the jobs in folders left running and removes the folders'''
+    return f"for d in {' '.join(folders)}; do kill -- $(cat $d/.*_pid.txt $d/.pack_*/.*_pid.txt 2>/dev/null) 2>/dev/null; rm -rf $d; done; true"
+
+
+def reconcile(statuses, machine_configs):
+    '''
+    cleans up after the jobs a crashed batch left running, with one ssh session per remote machine.
+    machine_configs maps machine names to configs, other machines' configs are loaded by name.
+    returns the number of jobs cleaned up.
+    '''
+    procs = []
+    count = 0
+    for machine, jobs in orphaned_jobs(statuses).items():
+        try:
+            machine_config = machine_configs[machine] if machine in machine_configs else load_data_from_yaml(machine)
+        except RuntimeError as err:
+            printe(f"WARNING: could not clean up {len(jobs)} jobs left running on {machine}: {err}")
+            continue
+        folders = run_folders(jobs, LOCAL_RUN_FOLDER if is_local(machine_config) else "job_data/")
+        command = machine_command(machine_config, reconcile_command(folders))
+        procs.append(subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL))
+        count += len(jobs)
+    for proc in procs:
+        proc.wait()
+    return count
+
+
+def set_aside_results(job_name):
+    '''moves the partial results of a job that did not finish out of the way of its rerun'''
+    results = "./job_results/"+job_name
+    if os.path.exists(results):
+        incomplete = results + ".incomplete"
+        subprocess.run(["rm", "-rf", incomplete])
+        os.rename(results, incomplete)
@@ -13,9 +13,22 @@ import copy
 import os
 import signal
 from ssh_scheduler import better_basic_run
-from ssh_scheduler.query_machine_info import get_full_command, parse_full_output
-from .machine_cost_model import machine_cost, is_over_limit, get_process_gpu_limit, get_best_gpu, get_best_machine, init_machine_limit, add_to_machine_state, remove_from_machine_state
-from .better_basic_run import generate_command
+from ssh_scheduler.query_machine_info import PROBES
+from .machine_cost_model import machine_cost, is_over_limit, get_process_gpu_limit, get_best_gpu, get_best_machine, init_machine_limit, gpu_indices
+from .better_basic_run import generate_command, generate_pack_command
+from .connection_pool import ConnectionPool
+from .agent_backend import AgentPool, run_on_agent
+from .dispatch import CompletionQueue, LaunchRateLimiter, MachineRateLimiter, Packer, RetryPolicy, Speculator, backoff_delay
+from .resource_refresh import ResourceRefresher, AgentRefresher
+from .batch_input import read_batch
+from .batch_journal import BatchJournal, load_journal, is_done, reconcile, set_aside_results
+from .job_trace import JobTrace, load_events, summarize, format_summary
+from .compression import negotiate_all, LINKS_PATH
+from .cleanup_queue import CleanupQueue
+from .job_log import JobLogs, COMPRESSIONS as LOG_COMPRESSIONS
+from .locality import Locality
+from .job_history import JobHistory, LongestFirst, DEFAULT_PATH as DEFAULT_HISTORY_PATH
+from .scheduler import schedule
 
 
 my_folder = os.path.dirname(os.path.realpath(__file__))
@@ -39,22 +52,62 @@ def run_all(commands):
     return outputs
 
 
-def find_all_machine_info(machines):
-    cmd = get_full_command()
-    commands = [better_basic_run.make_ssh_command(mac, cmd) for mac in machines]
+def find_all_machine_info(machines, probe="proc", retries=0, allow_failures=False):
+    '''
+    queries the free resources of every machine, retrying those that could not be reached
+    with backoff. With allow_failures, machines still unreachable get None instead of
+    raising, unless none could be reached.
+    '''
+    get_command, parse_output = PROBES[probe]
+    cmd = get_command()
+    commands = [better_basic_run.machine_command(mac, cmd) for mac in machines]
     outputs = run_all(commands)
-    if not all(outputs):
+    for attempt in range(retries):
+        failed = [idx for idx, out in enumerate(outputs) if out is None]
+        if not failed:
+            break
+        time.sleep(backoff_delay(attempt))
+        for idx, out in zip(failed, run_all([commands[idx] for idx in failed])):
+            outputs[idx] = out
+    if not all(outputs) and (not allow_failures or not any(outputs)):
         fail_machines = [(mach, " ".join(cmd)) for out,mach,cmd in zip(outputs, machines, commands) if out is None]
         raise RuntimeError("could not connect to machines: "+json.dumps(fail_machines))
-    parsed_outs = [parse_full_output(out) for out in outputs]
+    parsed_outs = [parse_output(out) if out is not None else None for out in outputs]
     for out in parsed_outs:
-        init_machine_limit(out)
+        if out is not None:
+            init_machine_limit(out)
     return parsed_outs
 
 
-def make_basic_run_command(machine, job_name, export_prefix, command, gpu_choice, args):
-    stdout = open(f"./job_results/{job_name}.out",'a',buffering=1)
-    stderr = open(f"./job_results/{job_name}.err",'a',buffering=1)
+def gpu_env(gpu_idx):
+    '''pins a job to its gpus, numbered in the order nvidia-smi lists them'''
+    return {"CUDA_DEVICE_ORDER": "PCI_BUS_ID", "CUDA_VISIBLE_DEVICES": ",".join(str(i) for i in gpu_indices(gpu_idx))}
+
+
+def job_outputs(job_name, logs=None):
+    '''where a job's stdout and stderr go: LogSinks if logs, a JobLogs, is given, files flushed every line if not'''
+    if logs is None:
+        return open(f"./job_results/{job_name}.out",'a',buffering=1), open(f"./job_results/{job_name}.err",'a',buffering=1)
+    return logs.open(f"./job_results/{job_name}.out"), logs.open(f"./job_results/{job_name}.err")
+
+
+def make_basic_run_command(machine, job_name, env, command, gpu_choice, args, agents=None, cpus=None, cleanup_queue=None, logs=None):
+    stdout, stderr = job_outputs(job_name, logs)
+    if agents is not None and not better_basic_run.is_local(machine):
+        return run_on_agent(
+            agents.get(machine),
+            args.copy_forwards,
+            args.copy_backwards,
+            machine,
+            job_name,
+            command,
+            stdout=stdout,
+            stderr=stderr,
+            cache=better_basic_run.cache_options(args),
+            env=env,
+            cpus=cpus,
+            copy_back_all=args.copy_back_all
+        )
     proc = generate_command(
         args.copy_forwards,
         args.copy_backwards,
@@ -63,138 +116,291 @@ def make_basic_run_command(machine, job_name, export_prefix, command, gpu_choice
         args.verbose,
         command,
         stdout=stdout,
-        stderr=stderr
+        stderr=stderr,
+        cache=better_basic_run.cache_options(args),
+        env=env,
+        cpus=cpus,
+        copy_back_all=args.copy_back_all,
+        cleanup_queue=cleanup_queue
     )
     return proc
 
 
-def make_ssh_scheduler_run_command(machine, job_name, export_prefix, command, gpu_choice, args):
+def make_ssh_scheduler_run_command(machine, job_name, env, command, gpu_choice, args, agents=None, cpus=None, cleanup_queue=None, logs=None):
     # add required args for parsing
     final_command = command
     if "--copy-forward" not in command:
-        final_command += f" --copy-forward {' '.join(args.copy_forward)} "
+        final_command += f" --copy-forward {' '.join(args.copy_forwards)} "
     if "--copy-backwards" not in command:
         final_command += f" --copy-backwards {' '.join(args.copy_backwards)} "
     if "--job-name" not in command:
         final_command += f" --job-name {job_name} "
     if args.verbose:
         final_command += f" --verbose "
+    if args.copy_back_all and "--copy-back-all" not in command:
+        final_command += f" --copy-back-all "
+    if args.cache_forwards and "--cache-forwards" not in command:
+        final_command += f" --cache-forwards --cache-dir {args.cache_dir} --cache-size {args.cache_size} "
     final_command += f" --machine {machine} "
 
     split_cmd = shlex.split(final_command)[1:]
     parse_results = better_basic_run.parse_args(split_cmd)
-    # final_command = final_command.replace(parse_results.command, f" {export_prefix} {parse_results.command} ")
-    # catted_cmd =  f" {export_prefix} {parse_results.command} "
-    run_proc = make_basic_run_command(machine, parse_results.job_name, export_prefix, parse_results.command, gpu_choice, parse_results)
+    run_proc = make_basic_run_command(machine, parse_results.job_name, env, parse_results.command, gpu_choice, parse_results, agents, cpus, cleanup_queue, logs)
 
     return run_proc, parse_results.job_name
 
 
+def cached_forwards(args, command):
+    '''the copy-forwards of a job of the batch if its worker caches them, None if not'''
+    if not args.commands:
+        return args.copy_forwards if args.cache_forwards else None
+    parsed = better_basic_run.parse_args(shlex.split(command)[1:] + ["--machine", ""])
+    if not parsed.cache_forwards and not args.cache_forwards:
+        return None
+    return parsed.copy_forwards if "--copy-forward" in command else args.copy_forwards
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Run a batched command',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('--copy-forwards', nargs='*', default=[], help='Files and folders to copy when running the command. Defaults to everything in the current working directory')
-    parser.add_argument('--copy-backwards', nargs='*', default=[], help='Files and folders to copy back from the worker running the command. Defaults to everything in the current working directory')
     parser.add_argument('--machines', nargs='*', help='machine id', required=True)
-    parser.add_argument('--num-cpus', type=int, default=1, help='cpus to reserve for the job')
-    parser.add_argument('--memory-required', type=int, default=7000, help='memory to reserve for the job')
-    parser.add_argument('--reserve', action="store_true", help='reserve entire machine for job')
-    parser.add_argument('--no-reserve-gpu', action="store_true", help='reserve entire machine for job')
-    parser.add_argument('--no-gpu-required', action="store_true", help='is a gpu required for the job')
-    parser.add_argument('--gpu-memory-required', type=int, default=1000, help='gpu memory to reserve for the job')
-    parser.add_argument('--gpu-utilization', type=float, default=0.75, help='gpu utilization consumed')
     parser.add_argument('--verbose', action="store_true", help='print out debug information')
     parser.add_argument('--dry-run', action="store_true", help='just print out first round of commands')
     parser.add_argument('--commands', action="store_true", help='Whether the batch file should be interpreted as ssh_scheduler commands instead of bash commands')
-    parser.add_argument('filename', help="a file where each line contains a command")
+    files = parser.add_argument_group('files sent to and from the workers')
+    files.add_argument('--copy-forwards', nargs='*', default=[], help='Files and folders to copy when running the command. Defaults to everything in the current working directory')
+    files.add_argument('--copy-backwards', nargs='*', default=[], help='Files and folders to copy back from the worker running the command. Defaults to everything in the current working directory')
+    files.add_argument('--copy-back-all', action="store_true", help='copy back every file under --copy-backwards, not only those the job added or changed')
+    files.add_argument('--compression', choices=["auto", "none", "zstd", "lz4", "gzip"], default="none", help='codec for copy-forwards and results of machines whose config does not set compression. auto picks one per machine by sending it a few MB to measure its link, and sampling how well the copy-forwards compress')
+    files.add_argument('--link-cache-hours', type=float, default=24, help=f'with --compression auto, reuse the link speed of each machine measured in the last this many hours, kept in {LINKS_PATH}, instead of sending it a few MB again. 0 to measure at every batch')
+    better_basic_run.add_cache_args(files)
+    files.add_argument('--transfer-cost', type=float, default=0.1, help='with --cache-forwards, how much a GB of copy-forwards costs to send to a machine that does not hold it from an earlier job, as a fraction of a fully loaded machine, so jobs go where their inputs are when loads are close. 0 to place by load alone')
+    resources = parser.add_argument_group('resources reserved for each job')
+    resources.add_argument('--num-cpus', type=int, default=1, help='cpus to reserve for the job')
+    resources.add_argument('--memory-required', type=int, default=7000, help='memory to reserve for the job')
+    resources.add_argument('--reserve', action="store_true", help='reserve entire machine for job')
+    resources.add_argument('--no-reserve-gpu', action="store_true", help='reserve entire machine for job')
+    resources.add_argument('--no-gpu-required', action="store_true", help='is a gpu required for the job')
+    resources.add_argument('--gpu-memory-required', type=int, default=1000, help='gpu memory to reserve for the job')
+    resources.add_argument('--num-gpus', type=int, default=1, help='gpus each job gets, picking sets joined by nvlink or a shared pcie switch when the machine has them')
+    resources.add_argument('--gpu-utilization', type=float, default=0.75, help='gpu utilization consumed')
+    resources.add_argument('--pin-cpus', action="store_true", help='pin each job to its own --num-cpus cores with taskset, on the numa node local to its gpus')
+    resources.add_argument('--size-from-history', action="store_true", help='reserve memory and cpus for each job from the peaks its command reached before, instead of --memory-required and --num-cpus')
+    launching = parser.add_argument_group('how jobs are launched')
+    launching.add_argument('--agent', action="store_true", help='run jobs through one long lived agent process per machine instead of several ssh sessions per job')
+    launching.add_argument('--launch-rate', type=float, default=10, help='jobs launched per second on each machine to start with, adapting to how fast its sshd keeps up. 0 for no limit')
+    launching.add_argument('--launch-burst', type=int, default=5, help='jobs that can be launched at once on a machine before --launch-rate applies')
+    launching.add_argument('--max-launch-rate', type=float, default=100, help='the most jobs launched per second on each machine, however well its sshd keeps up')
+    launching.add_argument('--cleanup-interval', type=float, default=0.5, help='seconds finished jobs wait to be torn down together with the others finishing on the same machine, in one ssh session')
+    launching.add_argument('--no-connection-pool', action="store_true", help='open a new ssh connection for every remote call instead of reusing one control connection per machine')
+    launching.add_argument('--pack-size', type=int, default=1, help='run this many consecutive lines in one remote session, sharing one copy-forward and run folder')
+    launching.add_argument('--pack-seconds', type=float, default=None, help='instead of --pack-size, size packs to take about this many seconds, from the durations of finished packs')
+    launching.add_argument('--pack-parallel', type=int, default=1, help='how many commands of a pack run at once, sharing the resources reserved for one job')
+    failures = parser.add_argument_group('failed connections and machines')
+    failures.add_argument('--max-retries', type=int, default=3, help='times to retry a job whose ssh connection failed, with backoff, before reporting it failed')
+    failures.add_argument('--quarantine-after', type=int, default=5, help='stop placing jobs on a machine after this many connection failures in a row')
+    failures.add_argument('--quarantine-seconds', type=float, default=300, help='how long a machine stays quarantined before jobs are tried on it again')
+    failures.add_argument('--refresh-interval', type=float, default=0, help='seconds between re-querying the free resources of each machine during the batch. 0 to only query at the start')
+    failures.add_argument('--probe', choices=sorted(PROBES), default="proc", help='how to query machine resources: sample /proc directly, or parse top and lscpu')
+    failures.add_argument('--metrics-agent', action="store_true", help='with --refresh-interval, keep a small python agent streaming resource snapshots on each machine instead of re-probing')
+    ordering = parser.add_argument_group('job order and stragglers')
+    ordering.add_argument('--history', default=None, help=f'record the durations and peak resources of jobs to this file of past jobs, by command with numbers left out. --order, --size-from-history and --speculate read and record {DEFAULT_HISTORY_PATH} if it is not given')
+    ordering.add_argument('--order', choices=["file", "longest-first", "backfill"], default="file", help='run jobs in file order, longest expected first, or longest first while also starting short jobs in the gaps before the next job fits')
+    ordering.add_argument('--lookahead', type=int, default=1000, help='how many upcoming lines --order reorders among')
+    ordering.add_argument('--speculate', action="store_true", help='once every job has started, start a second copy of jobs running far longer than expected on free slots, keeping whichever copy finishes first')
+    ordering.add_argument('--speculate-factor', type=float, default=2.0, help='with --speculate, how many times its expected duration a job has to run to get a second copy')
+    ordering.add_argument('--speculate-after', type=float, default=60, help='with --speculate, the fewest seconds a job has to run to get a second copy')
+    logs = parser.add_argument_group('job output and batch records')
+    logs.add_argument('--log-buffer', type=int, default=64, help='kilobytes of job output kept in memory before writing it to job_results/<job>.out and .err, which also happens every second')
+    logs.add_argument('--log-compression', choices=LOG_COMPRESSIONS, default="none", help='compress job output logs, gzip as they are written, or zstd as each segment is rotated out')
+    logs.add_argument('--log-max-mb', type=int, default=0, help='start a new segment of a job output log once it reaches this size. 0 for one unbounded segment')
+    logs.add_argument('--log-keep', type=int, default=None, help='with --log-max-mb, delete all but this many of the newest rotated segments of each log')
+    logs.add_argument('--collapse-carriage-returns', action="store_true", help='store only the last text of each line of the job output rewritten with \\r, like progress bars, instead of every update')
+    logs.add_argument('--journal', help='file recording when each job is queued, started and finished. Defaults to job_results/<batch file>.journal')
+    logs.add_argument('--resume', action="store_true", help='rerun only the lines the journal does not show as finished, after cleaning up jobs a crashed run left running')
+    logs.add_argument('--trace', help='write the timing of every phase of every job to this JSON lines file, and print a summary at the end')
+    parser.add_argument('filename', help="a file where each line contains a command, or a .yaml parameter sweep (see batch_input.py)")
 
     args = parser.parse_args()
 
-    lines = open(args.filename).readlines()
+    pool = ConnectionPool()
+    try:
+        run_batch(args, pool)
+    finally:
+        pool.close()
+
+
+def run_batch(args, pool):
     machine_configs = [better_basic_run.load_data_from_yaml(mac) for mac in args.machines]
-    machine_infos = find_all_machine_info(machine_configs)
+    if not args.no_connection_pool:
+        pool.open_all([machine for machine in machine_configs if not better_basic_run.is_local(machine)])
+    machine_infos = find_all_machine_info(machine_configs, args.probe, retries=args.max_retries, allow_failures=True)
+    if not all(machine_infos):
+        for name, info in zip(args.machines, machine_infos):
+            if info is None:
+                print(f"WARNING: could not connect to {name}, running the batch without it", flush=True)
+        reachable = [idx for idx, info in enumerate(machine_infos) if info is not None]
+        args.machines = [args.machines[idx] for idx in reachable]
+        machine_configs = [machine_configs[idx] for idx in reachable]
+        machine_infos = [machine_infos[idx] for idx in reachable]
+    if args.compression != "auto":
+        for machine in machine_configs:
+            machine.setdefault('compression', args.compression)
+    elif not args.dry_run:
+        negotiate_all(machine_configs, args.machines, args.copy_forwards, max_age=args.link_cache_hours * 3600)
     machine_gpu_choices = [get_process_gpu_limit(info, args) for info in machine_infos]
     machine_proc_limits = [len(c) for c in machine_gpu_choices]
+    if not args.no_connection_pool:
+        # each running job holds a session, and its cleanup may briefly hold another
+        remote = [(machine, 2 * limit) for machine, limit in zip(machine_configs, machine_proc_limits) if not better_basic_run.is_local(machine)]
+        pool.open_all([machine for machine, _ in remote], [sessions for _, sessions in remote])
     print("machine limits: ", {name:limit for name, limit in zip(args.machines,machine_proc_limits)})
     print("machine gpu choices:",machine_gpu_choices)
     machine_procs = [[None for i in range(limit)] for limit in machine_proc_limits]
     save_filename = args.filename.replace("/","_")
-    job_names = [f"{save_filename}.{line_num+1}" for line_num in range(len(lines))]
-    for line_num in range(len(lines)):
-        if os.path.exists(f"./job_results/{job_names[line_num]}"):
-            print(f"WARNING: job results already exists for line {line_num+1}, skipping evaluation: delete if you wish to rerun")
+    journal_path = args.journal or f"./job_results/{save_filename}.journal"
+    statuses = None
+    if args.resume:
+        if os.path.exists(journal_path):
+            statuses = load_journal(journal_path)
+            cleaned = reconcile(statuses, dict(zip(args.machines, machine_configs)))
+            if cleaned:
+                print(f"cleaned up {cleaned} jobs left running by the previous run", flush=True)
+        else:
+            print(f"WARNING: no journal at {journal_path} to resume from, skipping jobs whose results exist instead")
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx, cpus=None):
+        env = gpu_env(gpu_idx) if not args.reserve and not args.no_gpu_required else None
+        machine = machine_configs[machine_idx]
+        if args.dry_run:
+            return None, job_name
+        elif args.commands:
+            return make_ssh_scheduler_run_command(machine, job_name, env, command, gpu_idx, args, agents, cpus, cleanups, logs)
+        else:
+            return make_basic_run_command(machine, job_name, env, command, gpu_idx, args, agents, cpus, cleanups, logs), job_name
+
+    def launch_pack(pack, machine_idx, gpu_idx, cpus=None):
+        if args.dry_run or args.commands or agents is not None or better_basic_run.is_local(machine_configs[machine_idx]):
+            # the agent and local machines already run every job without new ssh sessions, so packs only save for generate_command
+            return [launch(line_num, job_name, command, machine_idx, gpu_idx, cpus) for line_num, job_name, command in pack]
+        outputs = [
+            (job_name, command, *job_outputs(job_name, logs))
+            for line_num, job_name, command in pack
+        ]
+        procs = generate_pack_command(
+            args.copy_forwards,
+            args.copy_backwards,
+            machine_configs[machine_idx],
+            pack[0][1] + ".pack",
+            args.verbose,
+            outputs,
+            parallel=args.pack_parallel,
+            stderr=outputs[0][3],
+            cache=better_basic_run.cache_options(args),
+            env=gpu_env(gpu_idx) if not args.reserve and not args.no_gpu_required else None,
+            cpus=cpus,
+            copy_back_all=args.copy_back_all,
+            cleanup_queue=cleanups
+        )
+        return [(proc, job_name) for proc, (line_num, job_name, command) in zip(procs, pack)]
+
+    def report(message, line_num, job_name, command):
+        separator = ";  " if message == "started" else "; "
+        print(f"{message}: {job_name}{separator}{command}",flush=True)
 
-    def poll_all_jobs():
-        not_finished_procs = []
-        for p_line_num, p_machine, p_gpu, proc in proc_list:
-            if args.dry_run or proc.poll() is not None:
-                message = "finished" if args.dry_run or proc.returncode == 0 else "failed"
-                job_name = job_names[p_line_num]
-                machine_infos[p_machine] = remove_from_machine_state(machine_infos[p_machine], p_gpu)
-                print(f"{message}: {job_name}; {lines[p_line_num].strip()}",flush=True)
-            else:
-                not_finished_procs.append((p_line_num, p_machine, p_gpu, proc))
-        proc_list[:] = not_finished_procs
-
-    proc_list = []
-    machine_config = args
     os.makedirs("./job_results/",exist_ok=True)
-    for line_num in range(len(job_names)):
-        job_name = job_names[line_num]
-        if os.path.exists(f"./job_results/{job_name}"):
-            print("skipping", lines[line_num].strip(),flush=True)
-            continue
-        not_polled = True
-        while not_polled or is_over_limit(machine_cost(machine_config, machine_infos[best_machine_idx])):
-            if not not_polled:
-                if not args.dry_run:
-                    # ssh commands take at least a second to finish
-                    # so its a reasonable slow-query time
-                    time.sleep(1)
-
-                # revert machine addition from previous loop iteration
-                machine_infos[best_machine_idx] = remove_from_machine_state(machine_infos[best_machine_idx], best_gpu_idx)
-
-                poll_all_jobs()
-
-            not_polled = False
-
-            best_machine_idx = get_best_machine(machine_infos, machine_config)
-            best_gpu_idx = get_best_gpu(machine_config, machine_infos[best_machine_idx])
-            machine_infos[best_machine_idx] = add_to_machine_state(machine_infos[best_machine_idx], machine_config, best_gpu_idx)
-
-
-        # start new job
-        command = lines[line_num].strip()
-        export_prefix = f"export CUDA_VISIBLE_DEVICES={best_gpu_idx} &&" if not args.reserve and not args.no_gpu_required else ""
-        machine = machine_configs[best_machine_idx]
-        job_name = job_names[line_num]
-        if not args.dry_run:
-            if args.commands:
-                proc, new_job_name = make_ssh_scheduler_run_command(machine, job_name, export_prefix, command, best_gpu_idx, args)
-                job_name = job_names[line_num] = new_job_name
-            else:
-                proc = make_basic_run_command(machine, job_name, export_prefix, command, best_gpu_idx, args)
+    jobs = pending_jobs(read_batch(args.filename), save_filename, statuses)
+    # job history is only read and recorded when asked for, directly or by a feature using it
+    wants_history = args.history is not None or args.order != "file" or args.size_from_history or args.speculate
+    history = JobHistory(args.history or DEFAULT_HISTORY_PATH) if wants_history else None
+    order = None
+    if history is not None and args.order != "file":
+        order = LongestFirst(history, args.lookahead, backfill=args.order == "backfill")
+        jobs = order.jobs(jobs)
+    job_config = (lambda command: history.sized_config(args, command)) if history is not None and args.size_from_history else None
+
+    agents = AgentPool() if args.agent and not args.dry_run else None
+    cleanups = CleanupQueue(args.cleanup_interval) if not args.dry_run else None
+    logs = None
+    if not args.dry_run:
+        logs = JobLogs(
+            args.log_compression,
+            args.log_buffer * 2**10,
+            args.log_max_mb * 2**20 if args.log_max_mb else None,
+            args.log_keep,
+            collapse_cr=args.collapse_carriage_returns
+        )
+    if args.dry_run or not args.launch_rate:
+        limiter = LaunchRateLimiter(None)
+    else:
+        limiter = MachineRateLimiter(len(machine_configs), args.launch_rate, args.launch_burst, max_rate=args.max_launch_rate)
+    retry_policy = RetryPolicy(args.max_retries, quarantine_after=args.quarantine_after, quarantine_seconds=args.quarantine_seconds) if not args.dry_run else None
+    completions = CompletionQueue()
+    refresher = None
+    if args.refresh_interval > 0 and not args.dry_run:
+        if args.metrics_agent:
+            refresher = AgentRefresher(machine_configs, args.refresh_interval, completions).start()
         else:
-            proc = None
-
-        proc_list.append((
-            line_num,
-            best_machine_idx,
-            best_gpu_idx,
-            proc
-        ))
-
-        print(f"started: {job_name};  {command}",flush=True)
-        if not args.dry_run:
-            # give time as to not overload the sshd server
-            time.sleep(0.1)
-    while proc_list:
-        poll_all_jobs()
-        if not args.dry_run:
-            time.sleep(1)
+            refresher = ResourceRefresher(machine_configs, args.refresh_interval, completions, probe=args.probe).start()
+    packer = Packer(args.pack_size, args.pack_seconds, args.pack_parallel) if args.pack_size > 1 or args.pack_seconds else None
+    speculator = None
+    if args.speculate and not args.dry_run:
+        if args.commands:
+            print("WARNING: --speculate is ignored with --commands, which name their own results", flush=True)
+        else:
+            speculator = Speculator(history, args.speculate_factor, args.speculate_after)
+    trace = JobTrace(args.trace, args.machines, machine_proc_limits) if args.trace and not args.dry_run else None
+    locality = None
+    if args.transfer_cost > 0:
+        local = [idx for idx, machine in enumerate(machine_configs) if better_basic_run.is_local(machine)]
+        locality = Locality(len(machine_configs), lambda command: cached_forwards(args, command), args.transfer_cost, args.cache_size * 2**20, local)
+    journal = BatchJournal(journal_path, args.machines) if not args.dry_run else None
+    if journal is not None:
+        journal.batch(machine_infos, args)
+    try:
+        schedule(jobs, machine_infos, args, launch, report, limiter, completions, refreshing=refresher is not None, trace=trace, packer=packer, launch_pack=launch_pack, journal=journal, retry_policy=retry_policy, history=history, order=order, job_config=job_config, speculator=speculator, locality=locality)
+    finally:
+        if journal is not None:
+            journal.close()
+        if refresher is not None:
+            refresher.stop()
+        if cleanups is not None:
+            cleanups.close()
+        if logs is not None:
+            logs.close()
+        if agents is not None:
+            agents.close()
+        if trace is not None:
+            trace.close()
+        if history is not None:
+            history.close()
+    if trace is not None:
+        print(format_summary(summarize(load_events(args.trace))), flush=True)
+    if locality is not None and locality.jobs:
+        print(locality.summary(), flush=True)
+
+
+def pending_jobs(batch, save_filename, statuses=None):
+    '''
+    lazily yields (line_num, job_name, command) for the jobs of batch that still have to run.
+    With the journal's statuses, those it shows as finished are skipped, otherwise those whose results exist.
+    '''
+    for line_num, name, command in batch:
+        job_name = f"{save_filename}.{name}"
+        if statuses is not None:
+            # by name, as the line_num of a sweep point changes when an axis is extended
+            status = statuses.get(job_name)
+            if is_done(status, command):
+                print("skipping", command,flush=True)
+                continue
+            set_aside_results((status or {}).get("run") or job_name)
+        elif os.path.exists(f"./job_results/{job_name}"):
+            print(f"WARNING: job results already exists for line {line_num+1}, skipping evaluation: delete if you wish to rerun")
+            print("skipping", command,flush=True)
+            continue
+        yield line_num, job_name, command
 
 
 if __name__ == "__main__":
@@ -10,7 +10,14 @@ import sys
 import signal
 import shlex
 import time
-import random
+import getpass
+import threading
+from collections import namedtuple
+from . import forward_cache
+from .stream_demux import StreamDemux, PackDemux
+from .remote_framer import COMPRESSORS, parse_codec
+from .job_trace import JobTrace
+from .connection_pool import ssh_base_options, ssh_destination, control_options
 
 
 def parse_args(args_list):
@@ -20,11 +27,27 @@ def parse_args(args_list):
     parser.add_argument('--machine', help='machine id', required=True)
     parser.add_argument('--job-name', default="__random__", help='job name')
     parser.add_argument('--verbose', action="store_true", help='print debugging information to stderr')
+    parser.add_argument('--copy-back-all', action="store_true", help='copy back every file under --copy-backwards, not only those the job added or changed')
+    add_cache_args(parser)
+    parser.add_argument('--trace', help='write the timing of each phase of the job to this JSON lines file')
     parser.add_argument('command')
 
     return parser.parse_args(args_list)
 
 
+def add_cache_args(parser):
+    parser.add_argument('--cache-forwards', action="store_true", help='only send files the worker does not already have in its copy-forward cache')
+    parser.add_argument('--cache-dir', default=forward_cache.DEFAULT_CACHE_DIR, help='copy-forward cache folder on the worker')
+    parser.add_argument('--cache-size', type=int, default=20000, help='size limit of the copy-forward cache on the worker, in megabytes')
+    parser.add_argument('--cache-hardlinks', action="store_true", help='on filesystems without reflinks, hardlink cached files into the job folder instead of copying them. They are then read only to the job')
+
+
+def cache_options(args):
+    if not args.cache_forwards:
+        return None
+    return {"dir": args.cache_dir, "max_bytes": args.cache_size * 2**20, "hardlinks": args.cache_hardlinks}
+
+
 def load_data_from_yaml(computer_override):
     yaml_path = os.path.expanduser("~/.local/var/")
     global_path = os.path.join(yaml_path,"{}".format(computer_override))
@@ -43,10 +66,79 @@ def load_data_from_yaml(computer_override):
 
 
 def make_ssh_command(machine_config, command):
-    ssh_command = f"ssh -T -o StrictHostKeyChecking=no -o ConnectTimeout=5 -p {machine_config['port']} -i {machine_config['ssh_key_path']} {machine_config['username']}@{machine_config['ip']} '{command}'"
+    ssh_command = f"ssh -T {control_options(machine_config)} {ssh_base_options(machine_config)} {ssh_destination(machine_config)} '{command}'"
     return ssh_command
 
 
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+# where jobs on a local machine run, under job_results so the copy-forwards skip it
+LOCAL_RUN_FOLDER = "job_results/.running/"
+
+
+def is_local(machine_config):
+    '''
+    whether jobs on the machine can run as subprocesses of this one: it is this machine's own
+    sshd, as the same user. A port other than 22 may be a tunnel or a container, so it is only
+    taken as local when set so. Setting local: true or false in the machine config overrides the guess.
+    '''
+    if 'local' in machine_config:
+        return bool(machine_config['local'])
+    return (
+        machine_config.get('ip') in LOCAL_HOSTS
+        and int(machine_config.get('port', 22)) == 22
+        and machine_config.get('username', getpass.getuser()) == getpass.getuser()
+    )
+
+
+def machine_command(machine_config, command):
+    '''command run on the machine: through ssh, or in a subshell on a local machine, so it can be piped into as a whole'''
+    return f"({command})" if is_local(machine_config) else make_ssh_command(machine_config, command)
+
+
+# codec -> command undoing what its remote_framer.COMPRESSORS command did
+DECOMPRESSORS = {"zstd": "zstd -q -d -c", "lz4": "lz4 -q -d -c", "gzip": "gzip -d -c"}
+
+
+def machine_codec(machine_config):
+    '''
+    (codec, level) the machine's copy-forwards and results are compressed with, from the
+    compression (zstd, lz4, gzip or none) and compression_level of its config, or None
+    '''
+    compression = machine_config.get('compression', "none")
+    if compression != "none" and compression not in COMPRESSORS:
+        raise RuntimeError(f"unknown compression '{compression}' in machine config, use one of: none {' '.join(COMPRESSORS)}")
+    level = machine_config.get('compression_level')
+    return parse_codec(compression if level is None else f"{compression}:{level}")
+
+
+def compress_args(machine_config):
+    '''remote_framer.py args compressing results like the copy-forwards, when the machine config sets compression'''
+    if 'compression' not in machine_config:
+        return []
+    codec = machine_codec(machine_config)
+    return ["--compress", "none" if codec is None else f"{codec[0]}:{codec[1]}"]
+
+
+def remote_script(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def remote_python_command(machine_config, script_path, args, modules=()):
+    '''
+    runs a stdlib-only python file on the remote without copying it there first. modules are
+    the paths of other stdlib-only files it imports, sent along and importable by their names
+    '''
+    def encoded(path):
+        return base64.b64encode(open(path, 'rb').read()).decode("utf-8")
+
+    imports = ""
+    for path in modules:
+        name = os.path.splitext(os.path.basename(path))[0]
+        imports += f"m=types.ModuleType(\\\"{name}\\\");sys.modules[\\\"{name}\\\"]=m;exec(base64.b64decode(\\\"{encoded(path)}\\\"),m.__dict__);"
+    python = machine_config.get('python', 'python3')
+    return f"{python} -c \"import base64,sys,types;{imports}exec(base64.b64decode(\\\"{encoded(script_path)}\\\"))\" {args}"
+
+
 def rand_fname(suffix=""):
     return base64.b16encode(os.urandom(12)).decode("utf-8") + suffix
 
@@ -55,29 +147,128 @@ def printe(*args):
     print(*args, file=sys.stderr)
 
 
+def teardown_command(machine_config, run_folders, killed=(), local_files=()):
+    '''
+    one command cleaning up after jobs on the machine: kills the jobs still running in the
+    run folders in killed, gives them a moment to exit, removes all the run folders, then
+    removes the local files here
+    '''
+    remote = f"rm -rf {' '.join(run_folders)}"
+    if killed:
+        remote = f"for d in {' '.join(killed)}; do kill -- $(cat $d/.*_pid.txt $d/.pack_*/.*_pid.txt 2>/dev/null) 2>/dev/null; done; sleep 0.3; {remote}"
+    command = machine_command(machine_config, remote)
+    if local_files:
+        command += f" ; rm -f {' '.join(local_files)}"
+    return command
+
+
+class Teardown(namedtuple("Teardown", ["machine_config", "run_folder", "local_files"])):
+    '''what a job leaves behind: its run folder on the machine, and the script files sent from here'''
+    def command(self, kill=True):
+        return teardown_command(self.machine_config, [self.run_folder], [self.run_folder] if kill else [], self.local_files)
+
+
+def copy_stream(source, dest):
+    '''writes everything read from source, a pipe, to dest as it comes'''
+    chunk = os.read(source.fileno(), 2**16)
+    while chunk:
+        dest.write(chunk)
+        chunk = os.read(source.fileno(), 2**16)
+    source.close()
+    dest.flush()
+
+
 class CleanupShellProcess:
-    def __init__(self, command, cleanups=[], **kwargs):
-        self.proc = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, **kwargs)
+    def __init__(self, command, cleanups=[], feed=None, demux=None, teardown=None, cleanup_queue=None, **kwargs):
+        '''
+        feed, if given, is called in a thread with the process's stdin to write its input.
+        demux, if given, is a StreamDemux that reads the process's framed stdout in a thread,
+        and whose exit code is reported instead of the process's own.
+        teardown, a Teardown, is run when the process is closed, by cleanup_queue (a
+        cleanup_queue.CleanupQueue) along with other jobs' if it is given.
+        stderr may also be a file-like object that is not a file, like a job_log.LogSink,
+        which the process's stderr is then copied to.
+        '''
+        stdin = subprocess.PIPE if feed is not None else subprocess.DEVNULL
+        if demux is not None:
+            kwargs['stdout'] = subprocess.PIPE
+        stderr_sink = kwargs.get('stderr')
+        if stderr_sink is not None and not isinstance(stderr_sink, int) and not hasattr(stderr_sink, 'fileno'):
+            kwargs['stderr'] = subprocess.PIPE
+        else:
+            stderr_sink = None
+        self.proc = subprocess.Popen(command, shell=True, stdin=stdin, **kwargs)
         self.cleanups = cleanups
+        self.teardown = teardown
+        self.cleanup_queue = cleanup_queue
+        self.cleanup_procs = None
         self.kwargs = kwargs
+        self.demux = demux
+        self.returncode = None
+        if feed is not None:
+            self.feeder = threading.Thread(target=self._feed, args=(feed,), daemon=True)
+            self.feeder.start()
+        if demux is not None:
+            self.reader = threading.Thread(target=demux.run, args=(self.proc.stdout,), daemon=True)
+            self.reader.start()
+        self.stderr_pump = None
+        if stderr_sink is not None:
+            self.stderr_pump = threading.Thread(target=copy_stream, args=(self.proc.stderr, stderr_sink), daemon=True)
+            self.stderr_pump.start()
+
+    def _feed(self, feed):
+        try:
+            feed(self.proc.stdin)
+            self.proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # remote side went away, the process's exit code reports the failure
+            pass
 
     def close(self):
-        for cleanup in self.cleanups:
-            subprocess.Popen(cleanup, shell=True, stdin=subprocess.DEVNULL)#, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        '''
+        starts the cleanup, only the first time it is called, and returns its processes. The job
+        is only killed if it has not exited, as its pid may belong to another process by now
+        '''
+        if self.cleanup_procs is None:
+            self.cleanup_procs = [subprocess.Popen(cleanup, shell=True, stdin=subprocess.DEVNULL) for cleanup in self.cleanups]
+            if self.teardown is not None:
+                kill = self.demux is None or self.demux.returncode is None
+                if self.cleanup_queue is not None:
+                    self.cleanup_procs.append(self.cleanup_queue.add(self.teardown, kill))
+                else:
+                    self.cleanup_procs.append(subprocess.Popen(self.teardown.command(kill), shell=True, stdin=subprocess.DEVNULL))
+        return self.cleanup_procs
+
+    def _set_returncode(self):
+        if self.demux is not None and self.demux.returncode is not None:
+            self.returncode = self.demux.returncode
+        else:
+            self.returncode = self.proc.returncode
 
     def wait(self):
+        if self.demux is not None:
+            self.reader.join()
+        if self.stderr_pump is not None:
+            self.stderr_pump.join()
         self.proc.wait()
-        self.returncode = self.proc.returncode
+        self._set_returncode()
+        return self.returncode
 
     def communicate(self):
+        if self.demux is not None:
+            self.wait()
+            return None, None
         out, err = self.proc.communicate()
-        self.returncode = self.proc.returncode
+        self._set_returncode()
         return out, err
 
     def poll(self):
-        result = self.proc.poll()
-        self.returncode = self.proc.returncode
-        return result
+        if self.demux is not None and self.reader.is_alive():
+            return None
+        if self.proc.poll() is None:
+            return None
+        self._set_returncode()
+        return self.returncode
 
     def send_signal(self, *args):
         self.proc.send_signal(*args)
@@ -92,97 +283,259 @@ class CleanupShellProcess:
         self.close()
 
 
-def generate_command(
-    copy_forwards,
-    copy_backwards,
-    machine_config,
-    job_name,
-    verbose,
-    command,
-    stdout=None,
-    stderr=None
-):
+class PackMember:
+    '''process-like handle of one job of a pack run by generate_pack_command'''
+    def __init__(self, pack_proc, demux, reader):
+        self.pack_proc = pack_proc
+        self.demux = demux
+        self.reader = reader
+        self.returncode = None
 
-    def vprint(*fargs):
-        if verbose:
-            printe(*fargs)
+    def _set_returncode(self):
+        if self.demux.returncode is not None:
+            self.returncode = self.demux.returncode
+        else:
+            # the pack's session ended before this job exited, report the session's failure
+            self.pack_proc.wait()
+            self.returncode = self.pack_proc.returncode or 255
 
-    job_name = rand_fname() if job_name == "__random__" else job_name
-    job_result_folder = os.path.expanduser("./job_results/")+job_name
-    read_after_script_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "read_after.py"))
-    if copy_backwards and os.path.exists(job_result_folder):
-        raise RuntimeError(f"results for job '{job_name}' already exist, move or remove files before continuing")
+    def wait(self):
+        self.reader.join()
+        self._set_returncode()
+        return self.returncode
 
-    run_folder = "job_data/"+job_name
-    local_data_folder = "job_results/"+job_name
-    pid_name = "."+rand_fname("_pid.txt")
-    stdout_separator = rand_fname()
-    script_name = "tmp/"+rand_fname(".sh")
-    local_script_file = "/"+script_name
-    local_all_out_file = "/tmp/"+rand_fname()
+    def poll(self):
+        if self.reader.is_alive():
+            return None
+        self._set_returncode()
+        return self.returncode
 
-    script_contents = rf'{command} &\n'
+    def close(self):
+        '''the pack is cleaned up once every job in it is done with'''
+        return []
+
+
+def export_lines(env):
+    return "".join(f"export {name}={value}\n" for name, value in (env or {}).items())
+
+
+def cpu_list(cpus):
+    '''cpus in taskset's list format, runs of consecutive cpus as ranges: [0, 1, 2, 5] gives 0-2,5'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def pin_lines(cpus):
+    '''
+    pins the script's shell, and so everything it starts, to cpus. Memory is then allocated
+    on their numa node as it is first used, so memory binding with numactl is not needed.
+    '''
+    if not cpus:
+        return ""
+    return f"command -v taskset > /dev/null && taskset -cp {cpu_list(cpus)} $$ > /dev/null\n"
+
+
+def job_script(command, pid_name, env=None, cpus=None):
+    '''
+    printf format script running command in the background, saving its pid for the cleanup to kill.
+    env holds environment variables to export to the command first, cpus the cpus to pin it to.
+    '''
+    script_contents = (export_lines(env) + pin_lines(cpus)).replace("\n", r"\n")
+    script_contents += rf'{command} &\n'
     script_contents += r"RETVAL=$!\n"
     script_contents += rf"echo $RETVAL > {pid_name}\n"
     script_contents += rf"echo  started command $RETVAL ...  >&2 \n"
     script_contents += r"wait $RETVAL\n"
     script_contents += r"RETCODE=$?\n"
     script_contents += r"exit $RETCODE\n"
+    return script_contents
+
+
+def remote_job_command(copy_forwards, machine_config, run_folder, script_contents, framer_args, verbose, cache=None):
+    '''
+    the shell commands to run remote_framer.py with framer_args in a fresh run_folder, holding
+    the copy-forwards and one script per entry of script_contents, and to clean up afterwards.
+    framer_args are formatted with the remote script names, as {scripts}.
+    returns (full_command, teardown, feed), teardown and feed are for CleanupShellProcess
+    '''
+
+    def vprint(*fargs):
+        if verbose:
+            printe(*fargs)
 
+    script_names = ["tmp/"+rand_fname(".sh") for _ in script_contents]
+    local_script_files = ["/"+script_name for script_name in script_names]
 
-    create_local_script = f"printf '{script_contents}' > {local_script_file}"
+    create_local_script = " && ".join(f"printf '{contents}' > {local_file}" for contents, local_file in zip(script_contents, local_script_files))
 
     # gather_results_command = f"cd && cd {run_folder} && tar cfm {remote_tar_fname_back} {' '.join(.copy_backwards)}\n"
     q = '"'
-    vprint(f"Script contents:\n{(q+script_contents+q)}")
-    tararg = f"tar --exclude job_results --exclude .git -cmf - {' '.join(copy_forwards)} {local_script_file}"
-    setup_data = f"(rm -rf {run_folder} && mkdir -p {run_folder} && cd {run_folder} && tar -x ) "
-    # quoted_command = shlex.quote(.command)
-    # vprint(quoted_command)
-    return_results_command = f"tar -cmf - {' '.join(copy_backwards)}"
-    interactive_command = f"stdbuf -i0 -o0 -e0  bash -i {script_name}"
-    full_remote_command = f"{setup_data} && cd {run_folder} && {interactive_command} ; echo {stdout_separator} ; {return_results_command} | cat"
-
-    remote_kill_cleanup = f"kill -- $(cat {os.path.join(run_folder,pid_name)})"
-    remote_wait_cleaup = f"sleep 0.3" # wait for kill to finalize...
-    remote_file_cleanup = f"rm -rf {run_folder}"
-    full_remote_cleanup = f"{remote_kill_cleanup} && {remote_wait_cleaup} ; {remote_file_cleanup}"
-    ssh_remote_cleanup = make_ssh_command(machine_config, full_remote_cleanup)
-
-    get_stdout_txt = f"python {read_after_script_path} {stdout_separator}" # f"sed -n '/{stdout_separator}/q;p'"
-    divert_all_data = f"tee {local_all_out_file}"
-    remove_stdout = f"sed -n '/{stdout_separator}/,$p' {local_all_out_file} | tail -n +2 | tar xm "
-    unpack_tar_out = f"( mkdir -p {local_data_folder} && cd {local_data_folder} && {remove_stdout} ) " if copy_backwards else ' : '
-    post_process_output = f"{divert_all_data} | {get_stdout_txt}"
-
-    cleanup_local_files = f"rm -f {local_all_out_file} {local_script_file}"
-    cleanup_remote_delay = f"sleep {random.random()}" # keeps number of ssh connections at once to a reasonable number if large number of commands are stopped at once
-    cleanup_commands = f"{cleanup_remote_delay} ; {ssh_remote_cleanup} ; {unpack_tar_out} ; {cleanup_local_files}"
-
-    full_command = f"{create_local_script} && trap '' INT && {tararg} | {make_ssh_command(machine_config, full_remote_command)} | {post_process_output}"
+    for contents in script_contents:
+        vprint(f"Script contents:\n{(q+contents+q)}")
+    tararg = f"tar --exclude job_results --exclude .git -cmf - {' '.join(copy_forwards)} {' '.join(local_script_files)}"
+    codec = machine_codec(machine_config)
+    compress = decompress = ""
+    if codec is not None:
+        compress = COMPRESSORS[codec[0]].format(level=codec[1]) + " | "
+        decompress = DECOMPRESSORS[codec[0]] + " | "
+    unpack_data = decompress + "tar -x"
+    feed = None
+    if cache is not None:
+        manifest = forward_cache.build_manifest(copy_forwards)
+        query_command = remote_python_command(machine_config, remote_script("remote_cache.py"), f"missing {cache['dir']}")
+        missing = forward_cache.query_missing(make_ssh_command(machine_config, query_command), manifest)
+        vprint(f"copy-forward cache missing {len(missing)} of {len(forward_cache.manifest_blobs(manifest))} blobs")
+        script_files = [(script_name, contents.replace(r"\n", "\n").encode("utf-8"), 0o644) for script_name, contents in zip(script_names, script_contents)]
+        feed = lambda stdin: forward_cache.write_payload(stdin, manifest, missing, script_files)
+        unpack_data = decompress + remote_python_command(machine_config, remote_script("remote_cache.py"), forward_cache.build_args(cache))
+    setup_data = f"(rm -rf {run_folder} && mkdir -p {run_folder} && cd {run_folder} && {unpack_data} ) "
+    run_and_frame = remote_python_command(machine_config, remote_script("remote_framer.py"), framer_args.format(scripts=" ".join(script_names)))
+    full_remote_command = f"SETUP_START=$(date +%s.%N) && {setup_data} && cd {run_folder} && SSHS_SETUP_START=$SETUP_START {run_and_frame}"
+
+    teardown = Teardown(machine_config, run_folder, local_script_files)
+
+    if feed is None:
+        full_command = f"{create_local_script} && trap '' INT && {tararg} | {compress}{make_ssh_command(machine_config, full_remote_command)}"
+    else:
+        full_command = f"trap '' INT && {compress}{make_ssh_command(machine_config, full_remote_command)}"
 
     vprint("full_command")
     vprint(full_command)
-    vprint("cleanup_commands")
-    vprint(cleanup_commands)
+    vprint("teardown")
+    vprint(teardown.command())
+    return full_command, teardown, feed
+
+
+def generate_local_command(copy_forwards, copy_backwards, machine_config, job_name, verbose, command, stdout=None, stderr=None, env=None, cpus=None, copy_back_all=False, cleanup_queue=None):
+    '''
+    generate_command for a local machine: runs local_runner.py in LOCAL_RUN_FOLDER/job_name,
+    a workspace of links to the copy-forwards, and renames the copy-backwards into place.
+    The machine config's link_mode picks how files are linked, see local_runner.py.
+    '''
+    run_folder = LOCAL_RUN_FOLDER+job_name
+    local_data_folder = "job_results/"+job_name
+    script_name = rand_fname(".sh")
+    pid_name = "."+rand_fname("_pid.txt")
+    script = job_script(command, pid_name, env, cpus).replace(r"\n", "\n").encode("utf-8")
+    runner_args = (["--copy-back-all"] if copy_back_all else []) + [machine_config.get('link_mode', "reflink"), run_folder, local_data_folder, script_name] + list(copy_forwards) + ["--"] + list(copy_backwards)
+    full_command = f"trap '' INT && {shlex.quote(sys.executable)} {shlex.quote(remote_script('local_runner.py'))} {' '.join(shlex.quote(arg) for arg in runner_args)}"
+    if verbose:
+        printe(f"Script contents:\n{script.decode('utf-8')}")
+        printe("full_command")
+        printe(full_command)
+    feed = lambda stdin: stdin.write(script)
+    demux = StreamDemux(stdout, stderr, local_data_folder if copy_backwards else None)
+    return CleanupShellProcess(full_command, feed=feed, demux=demux, teardown=Teardown(machine_config, run_folder, []), cleanup_queue=cleanup_queue, stderr=stderr)
+
 
-    safeproc = CleanupShellProcess(full_command, cleanups=[cleanup_commands], stdout=stdout, stderr=stderr)
+def generate_command(
+    copy_forwards,
+    copy_backwards,
+    machine_config,
+    job_name,
+    verbose,
+    command,
+    stdout=None,
+    stderr=None,
+    cache=None,
+    env=None,
+    cpus=None,
+    copy_back_all=False,
+    cleanup_queue=None
+):
+    '''
+    cache, if given, is a dict with the worker's copy-forward cache "dir" and "max_bytes".
+    Files are then sent as content addressed blobs, skipping those the worker already has.
+    env holds environment variables to export to the command, like CUDA_VISIBLE_DEVICES.
+    cpus, if given, are the cpus to pin the command to.
+    Only the copy-backwards the job added or changed come back, unless copy_back_all.
+    Both ways are compressed as the machine config's compression says, see machine_codec.
+    cleanup_queue, a cleanup_queue.CleanupQueue, tears the job down along with others once it is closed.
+    Jobs on this machine skip ssh and tar, see generate_local_command.
+    '''
+    job_name = rand_fname() if job_name == "__random__" else job_name
+    job_result_folder = os.path.expanduser("./job_results/")+job_name
+    if copy_backwards and os.path.exists(job_result_folder):
+        raise RuntimeError(f"results for job '{job_name}' already exist, move or remove files before continuing")
+
+    if is_local(machine_config):
+        return generate_local_command(copy_forwards, copy_backwards, machine_config, job_name, verbose, command, stdout, stderr, env, cpus, copy_back_all, cleanup_queue)
+
+    run_folder = "job_data/"+job_name
+    local_data_folder = "job_results/"+job_name
+    pid_name = "."+rand_fname("_pid.txt")
+    framer_args = " ".join((["--copy-back-all"] if copy_back_all else []) + compress_args(machine_config) + ["{scripts}"] + copy_backwards)
+    full_command, teardown, feed = remote_job_command(copy_forwards, machine_config, run_folder, [job_script(command, pid_name, env, cpus)], framer_args, verbose, cache)
+
+    demux = StreamDemux(stdout, stderr, local_data_folder if copy_backwards else None)
+    safeproc = CleanupShellProcess(full_command, feed=feed, demux=demux, teardown=teardown, cleanup_queue=cleanup_queue, stderr=stderr)
     return safeproc
 
 
+def generate_pack_command(
+    copy_forwards,
+    copy_backwards,
+    machine_config,
+    pack_name,
+    verbose,
+    jobs,
+    parallel=1,
+    stderr=None,
+    cache=None,
+    env=None,
+    cpus=None,
+    copy_back_all=False,
+    cleanup_queue=None
+):
+    '''
+    runs several commands in one remote session, sharing one copy-forward and one run folder.
+    jobs is a list of (job_name, command, stdout, stderr), parallel how many of them run at once.
+    Returns one process-like PackMember per job, each with its own exit code and results folder.
+    The jobs share one slot, so env is exported to all of them and all are pinned to the same cpus.
+    '''
+    for job_name, _, _, _ in jobs:
+        if copy_backwards and os.path.exists("./job_results/"+job_name):
+            raise RuntimeError(f"results for job '{job_name}' already exist, move or remove files before continuing")
+
+    run_folder = "job_data/"+pack_name
+    scripts = [job_script(command, "."+rand_fname("_pid.txt"), env, cpus) for _, command, _, _ in jobs]
+    framer_args = " ".join((["--copy-back-all"] if copy_back_all else []) + compress_args(machine_config) + ["--pack", str(parallel), "{scripts}", "--"] + copy_backwards)
+    full_command, teardown, feed = remote_job_command(copy_forwards, machine_config, run_folder, scripts, framer_args, verbose, cache)
+
+    demuxes = [
+        StreamDemux(job_stdout, job_stderr, "job_results/"+job_name if copy_backwards else None)
+        for job_name, _, job_stdout, job_stderr in jobs
+    ]
+    pack_demux = PackDemux(demuxes)
+    pack_proc = CleanupShellProcess(full_command, feed=feed, demux=pack_demux, teardown=teardown, cleanup_queue=cleanup_queue, stderr=stderr)
+    return [PackMember(pack_proc, demux, reader) for demux, reader in zip(demuxes, pack_demux.readers)]
+
+
 def main():
     args = parse_args(sys.argv[1:])
 
     machine_config = load_data_from_yaml(args.machine)
+    trace = JobTrace(args.trace, [args.machine], [1]) if args.trace else None
     proc = generate_command(
         args.copy_forwards,
         args.copy_backwards,
         machine_config,
         args.job_name,
         args.verbose,
-        args.command
+        args.command,
+        cache=cache_options(args),
+        copy_back_all=args.copy_back_all
     )
     proc.wait()
+    if trace is not None:
+        trace.record_job(args.job_name, 0, 0.0, 0.0, trace.now(), proc)
+        trace.record_cleanup(args.job_name, 0, proc)
+        trace.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+'''
+Tears down finished and stopped jobs together: the teardowns queued for a machine
+since the last flush run as one command, one ssh session, that kills the jobs
+still running and removes all their run folders, instead of one session per job.
+A flush waits interval seconds after the first teardown is queued, so jobs ending
+around the same time share it, and at most max_parallel machines are flushed at once,
+so stopping a large batch opens a bounded number of ssh sessions.
+'''
+import threading
+import subprocess
+from .better_basic_run import teardown_command
+from .fan_out import run_bounded
+
+# most run folders removed by one command, keeping it well under the command line limit
+MAX_BATCH = 200
+
+
+def machine_key(machine_config):
+    return (machine_config.get('username'), machine_config.get('ip'), machine_config.get('port'))
+
+
+class QueuedTeardown:
+    '''process-like handle of a queued teardown, done once the flush holding it is'''
+    def __init__(self):
+        self.finished = threading.Event()
+        self.returncode = None
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        self.finished.set()
+
+    def wait(self):
+        self.finished.wait()
+        return self.returncode
+
+    def poll(self):
+        return self.returncode if self.finished.is_set() else None
+
+
+class CleanupQueue:
+    '''flushes queued teardowns in a background thread. sessions counts the teardown commands run'''
+    def __init__(self, interval=0.5, max_parallel=16):
+        self.interval = interval
+        self.max_parallel = max_parallel
+        self.cond = threading.Condition()
+        # machine key -> (machine_config, [(teardown, kill, handle)])
+        self.pending = {}
+        self.closed = False
+        self.sessions = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, teardown, kill=True):
+        '''queues a Teardown, killing the job first if kill. returns a handle to wait for it with'''
+        handle = QueuedTeardown()
+        with self.cond:
+            if not self.closed:
+                if not self.pending:
+                    self.cond.notify()
+                entries = self.pending.setdefault(machine_key(teardown.machine_config), (teardown.machine_config, []))[1]
+                entries.append((teardown, kill, handle))
+                return handle
+        # a job closed after the queue was, like at interpreter exit
+        return subprocess.Popen(teardown.command(kill), shell=True, stdin=subprocess.DEVNULL)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                if not self.closed:
+                    # let the jobs ending around the same time join this flush
+                    self.cond.wait(self.interval)
+                pending, self.pending = self.pending, {}
+            self.flush(pending)
+
+    def flush(self, pending):
+        batches = []
+        for machine_config, entries in pending.values():
+            for start in range(0, len(entries), MAX_BATCH):
+                batches.append((machine_config, entries[start:start + MAX_BATCH]))
+
+        def start(idx):
+            machine_config, entries = batches[idx]
+            folders = [teardown.run_folder for teardown, _, _ in entries]
+            killed = [teardown.run_folder for teardown, kill, _ in entries if kill]
+            local_files = [path for teardown, _, _ in entries for path in teardown.local_files]
+            command = teardown_command(machine_config, folders, killed, local_files)
+            return subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL)
+
+        def done(idx, returncode):
+            for _, _, handle in batches[idx][1]:
+                handle.finish(returncode)
+
+        self.sessions += len(batches)
+        run_bounded(range(len(batches)), start, self.max_parallel, done)
+
+    def close(self):
+        '''flushes what is still queued at once, and waits for it'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,163 @@
+'''
+Picks the codec the copy-forwards and results of each machine are compressed with
+on their way over ssh, for machines whose config does not set compression itself.
+negotiate times sending random bytes to a machine to measure its link and asks which
+codecs it has, then choose_codec picks the one moving the payload fastest, from how
+fast each codec runs and how well a sample of the copy-forwards compresses. On a fast
+link, or for data that is already compressed, that is no compression at all.
+Measured links are kept in LINKS_PATH, so later batches reuse them for a while
+instead of sending every machine a few MB again.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import threading
+from .remote_framer import INCOMPRESSIBLE, EXCLUDED, sample_ratio
+from .better_basic_run import DECOMPRESSORS, is_local, machine_command
+
+# codec -> (MB/s it compresses, MB/s it decompresses, on one core at its default level,
+# and the size of its output relative to zlib level 1's, which sample_ratio measures)
+CODEC_SPEEDS = {"zstd": (350, 1000, 0.9), "lz4": (700, 3000, 1.2), "gzip": (70, 300, 1.0)}
+# a codec has to move the payload this many times faster than sending it raw to be worth it
+MIN_SPEEDUP = 1.2
+# random bytes sent to a machine to measure its link
+MEASURE_BYTES = 2**22
+# prints the codecs the machine has, then reads and drops stdin
+CODECS_COMMAND = "for codec in " + " ".join(CODEC_SPEEDS) + "; do command -v $codec > /dev/null && echo $codec; done; cat > /dev/null"
+# machine -> {"link": MB/s, "codecs": [...], "time": unix time measured}
+LINKS_PATH = "~/.cache/ssh_scheduler/links.json"
+# seconds a measured link is reused for
+LINK_MAX_AGE = 24 * 3600
+
+
+def payload_speed(link, ratio, codec=None):
+    '''
+    MB/s of payload moved over a link of link MB/s, compressed with codec, or raw if it is None,
+    when the payload compresses to ratio of its size with zlib level 1. Compressing, sending and
+    decompressing are pipelined, so the slowest of them sets the speed
+    '''
+    if codec is None:
+        return link
+    compress, decompress, relative = CODEC_SPEEDS[codec]
+    return min(compress, decompress, link / min(1.0, ratio * relative))
+
+
+def choose_codec(link, ratio, codecs):
+    '''the codec of codecs moving the payload fastest over a link of link MB/s, or None if sending it raw is about as fast'''
+    if link is None or ratio > INCOMPRESSIBLE:
+        return None
+    best = max(codecs, key=lambda codec: payload_speed(link, ratio, codec), default=None)
+    if best is None or payload_speed(link, ratio, best) < MIN_SPEEDUP * link:
+        return None
+    return best
+
+
+def local_codecs():
+    '''the codecs this machine can decompress results with'''
+    return [codec for codec in CODEC_SPEEDS if shutil.which(DECOMPRESSORS[codec].split()[0])]
+
+
+def forward_files(copy_forwards):
+    '''the files a tar of the copy-forwards holds'''
+    files = []
+    for path in copy_forwards:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = [name for name in dirs if name not in EXCLUDED]
+                files += [os.path.join(root, name) for name in names]
+        elif os.path.lexists(path):
+            files.append(path)
+    return files
+
+
+def timed_run(command, data=b""):
+    '''seconds command took, and its stdout, or None if it failed'''
+    start = time.perf_counter()
+    proc = subprocess.run(command, shell=True, input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None, None
+    return time.perf_counter() - start, proc.stdout.decode("utf-8")
+
+
+def negotiate(machine_config, measure_bytes=MEASURE_BYTES):
+    '''
+    (link MB/s, codecs) of a machine: how fast measure_bytes of random data get to it, beyond
+    the time of a round trip sending nothing, and which of CODEC_SPEEDS it has. (None, []) if
+    it could not be reached
+    '''
+    command = machine_command(machine_config, CODECS_COMMAND)
+    empty_seconds, out = timed_run(command)
+    full_seconds, _ = timed_run(command, os.urandom(measure_bytes))
+    if empty_seconds is None or full_seconds is None:
+        return None, []
+    link = measure_bytes / 2**20 / max(full_seconds - empty_seconds, 1e-3)
+    return link, [codec for codec in CODEC_SPEEDS if codec in out.split()]
+
+
+def link_key(machine_config):
+    '''what the link of a machine is kept under in LINKS_PATH'''
+    return f"{machine_config.get('username', '')}@{machine_config.get('ip')}:{machine_config.get('port', 22)}"
+
+
+def load_links(path):
+    try:
+        with open(os.path.expanduser(path)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_links(path, links):
+    '''writes the links file whole, so a batch starting at the same time never reads half of it'''
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}"
+    with open(temp_path, "w") as file:
+        json.dump(links, file)
+    os.replace(temp_path, path)
+
+
+def negotiate_all(machine_configs, names, copy_forwards, measure_bytes=MEASURE_BYTES, links_path=LINKS_PATH, max_age=LINK_MAX_AGE, now=None):
+    '''
+    sets compression in the config of every remote machine that does not set it, from its
+    link and codecs, and how well the copy-forwards compress. Links measured less than max_age
+    seconds before now are read from links_path, the others are all measured at once and saved
+    there. links_path None measures every machine and keeps nothing
+    '''
+    now = time.time() if now is None else now
+    ratio = sample_ratio(forward_files(copy_forwards))
+    todo = [idx for idx, config in enumerate(machine_configs) if 'compression' not in config and not is_local(config)]
+    links = load_links(links_path) if links_path is not None else {}
+    results = {}
+    for idx in todo:
+        known = links.get(link_key(machine_configs[idx]))
+        if known is not None and now - known["time"] < max_age:
+            results[idx] = known["link"], known["codecs"]
+    measured = [idx for idx in todo if idx not in results]
+
+    def measure(idx):
+        results[idx] = negotiate(machine_configs[idx], measure_bytes)
+
+    threads = [threading.Thread(target=measure, args=(idx,)) for idx in measured]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if links_path is not None and measured:
+        for idx in measured:
+            link, codecs = results[idx]
+            if link is not None:
+                links[link_key(machine_configs[idx])] = {"link": link, "codecs": codecs, "time": now}
+        save_links(links_path, links)
+    usable = local_codecs()
+    for idx in todo:
+        link, codecs = results[idx]
+        codec = choose_codec(link, ratio, [codec for codec in codecs if codec in usable])
+        machine_configs[idx]['compression'] = codec or "none"
+        link_text = f"{link:.1f} MB/s" if link is not None else "unmeasured"
+        if idx not in measured:
+            link_text += " measured before"
+        print(f"compression for {names[idx]}: {codec or 'none'} (link {link_text}, copy-forwards compress to {ratio:.2f})", file=sys.stderr, flush=True)
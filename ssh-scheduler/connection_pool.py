@@ -0,0 +1,126 @@
+import os
+import math
+import shutil
+import hashlib
+import tempfile
+import itertools
+import subprocess
+
+
+# default sshd MaxSessions, the number of sessions one control connection can multiplex
+DEFAULT_MAX_SESSIONS = 10
+
+_round_robin = itertools.count()
+
+
+def ssh_base_options(machine_config):
+    return f"-o StrictHostKeyChecking=no -o ConnectTimeout=5 -p {machine_config['port']} -i {machine_config['ssh_key_path']}"
+
+
+def ssh_destination(machine_config):
+    return f"{machine_config['username']}@{machine_config['ip']}"
+
+
+def control_options(machine_config):
+    '''
+    ssh options that route a command through one of the machine's control connections.
+    ControlMaster=no means ssh falls back to a fresh connection if the master is gone.
+    '''
+    control_paths = machine_config.get('control_paths')
+    if not control_paths:
+        return ""
+    control_path = control_paths[next(_round_robin) % len(control_paths)]
+    return f"-o ControlMaster=no -o ControlPath={control_path}"
+
+
+class ConnectionPool:
+    '''
+    Keeps persistent ssh control connections (ControlMaster) open to each machine,
+    so later ssh calls to that machine skip the tcp and key exchange handshakes.
+
+    Opening a machine records the control sockets in the machine config under
+    'control_paths', which make_ssh_command picks up.
+    '''
+    def __init__(self, persist=600, max_sessions=DEFAULT_MAX_SESSIONS):
+        # sockets paths are limited to ~100 chars, so keep the folder short
+        self.socket_dir = tempfile.mkdtemp(prefix="sshs_")
+        self.persist = persist
+        self.max_sessions = max_sessions
+        self.masters = {}
+
+    def control_path(self, machine_config, idx):
+        key = f"{ssh_destination(machine_config)}:{machine_config['port']}:{idx}"
+        return os.path.join(self.socket_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def master_command(self, machine_config, control_path):
+        return f"ssh -T -N -f -o ControlMaster=yes -o ControlPersist={self.persist} -o ControlPath={control_path} {ssh_base_options(machine_config)} {ssh_destination(machine_config)}"
+
+    def open_all(self, machine_configs, sessions=None):
+        '''
+        starts control connections to all machines in parallel.
+        sessions[i] is the most ssh sessions expected at once on machine i,
+        enough masters are opened so that none exceeds sshd's MaxSessions.
+        Returns a list of booleans, whether each machine is pooled.
+        '''
+        sessions = sessions if sessions is not None else [1] * len(machine_configs)
+        procs = []
+        for machine_config, num_sessions in zip(machine_configs, sessions):
+            num_masters = max(1, math.ceil(num_sessions / self.max_sessions))
+            paths = [self.control_path(machine_config, idx) for idx in range(num_masters)]
+            mach_procs = []
+            for path in paths:
+                if path in self.masters:
+                    continue
+                proc = subprocess.Popen(
+                    self.master_command(machine_config, path),
+                    shell=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+                mach_procs.append((path, proc))
+            procs.append((machine_config, paths, mach_procs))
+
+        opened = []
+        for machine_config, paths, mach_procs in procs:
+            # -f forks the master into the background once it is authenticated
+            ok = True
+            for path, proc in mach_procs:
+                if proc.wait() == 0:
+                    self.masters[path] = machine_config
+                else:
+                    # not recorded, so the next open_all tries it again and close does not stop it
+                    ok = False
+            if ok:
+                machine_config['control_paths'] = paths
+            opened.append(ok)
+        return opened
+
+    def open(self, machine_config, sessions=1):
+        return self.open_all([machine_config], [sessions])[0]
+
+    def close(self):
+        procs = []
+        for path, machine_config in self.masters.items():
+            if not os.path.exists(path):
+                continue
+            procs.append(subprocess.Popen(
+                # stop lets sessions still in flight (like job cleanups) finish before the master exits
+                f"ssh -O stop -o ControlPath={path} {ssh_destination(machine_config)}",
+                shell=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            ))
+        for proc in procs:
+            proc.wait()
+        for machine_config in self.masters.values():
+            machine_config.pop('control_paths', None)
+        self.masters = {}
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
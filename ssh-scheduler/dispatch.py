@@ -0,0 +1,248 @@
+import time
+import queue
+import bisect
+import random
+import threading
+from .remote_framer import STARTED
+
+
+class CompletionQueue:
+    '''
+    Collects jobs as they exit, so the scheduler can place the next job
+    the moment a slot frees instead of polling every process on a timer.
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def watch(self, proc, token):
+        '''puts token on the queue once proc exits, right away if proc is None (dry runs)'''
+        if proc is None:
+            self.queue.put(token)
+            return
+        threading.Thread(target=self._wait, args=(proc, token), daemon=True).start()
+
+    def _wait(self, proc, token):
+        proc.wait()
+        self.queue.put(token)
+
+    def put(self, token):
+        '''wakes the scheduler with some other event, like a machine refresh'''
+        self.queue.put(token)
+
+    def get(self, timeout=None):
+        '''blocks until at least one job has exited, returns the tokens of every exited job'''
+        try:
+            tokens = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                tokens.append(self.queue.get_nowait())
+            except queue.Empty:
+                return tokens
+
+
+class LaunchRateLimiter:
+    '''
+    token bucket limiting how fast jobs are launched, to not overload the sshd servers.
+    rate is in launches per second, None or 0 means unlimited
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def wait(self, machine_idx=None):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.last = time.monotonic()
+            self.tokens = 1
+        self.tokens -= 1
+
+    def observe(self, machine_idx, failed, latency=None):
+        '''a fixed rate does not adapt'''
+        pass
+
+
+class MachineRateLimiter:
+    '''
+    a token bucket per machine, whose rate adapts to what the machine's sshd sustains:
+    it grows by about one launch per second every rate successful launches, halves when
+    a launch fails to connect, and backs off when connecting gets much slower than the fastest seen.
+    '''
+    SLOW_FACTOR = 3.0
+    SLOW_SECONDS = 1.0
+
+    def __init__(self, num_machines, rate, burst=1, min_rate=0.5, max_rate=100):
+        self.buckets = [LaunchRateLimiter(rate, burst) for _ in range(num_machines)]
+        self.fastest = [None] * num_machines
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+    def wait(self, machine_idx=None):
+        self.buckets[machine_idx].wait()
+
+    def rate(self, machine_idx):
+        return self.buckets[machine_idx].rate
+
+    def observe(self, machine_idx, failed, latency=None):
+        '''feedback from one launch: whether ssh failed to connect, and how long connecting took'''
+        bucket = self.buckets[machine_idx]
+        if failed:
+            bucket.rate = max(self.min_rate, bucket.rate * 0.5)
+            return
+        if latency is not None:
+            fastest = self.fastest[machine_idx]
+            self.fastest[machine_idx] = latency if fastest is None else min(fastest, latency)
+            if latency > self.SLOW_SECONDS and latency > self.SLOW_FACTOR * self.fastest[machine_idx]:
+                bucket.rate = max(self.min_rate, bucket.rate * 0.8)
+                return
+        bucket.rate = min(self.max_rate, bucket.rate + 1 / bucket.rate)
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    '''exponential backoff with full jitter, so retries of many jobs spread out'''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def is_connection_failure(proc):
+    '''
+    whether a job failed because ssh could not connect or lost the connection, rather than
+    its command failing: ssh exits with 255 for its own errors, and no exit code came back.
+    '''
+    demux = getattr(proc, "demux", None)
+    return proc.returncode == 255 and (demux is None or demux.returncode is None)
+
+
+def connect_latency(proc, launched_at):
+    '''seconds from launch until the worker started setting up the job, None if unknown'''
+    demux = getattr(proc, "demux", None)
+    if demux is None or STARTED not in demux.times:
+        return None
+    return demux.times[STARTED] - (demux.remote_setup or 0.0) - launched_at
+
+
+class RetryPolicy:
+    '''
+    retries jobs that failed to connect with jittered exponential backoff, and quarantines
+    machines after quarantine_after connection failures in a row, for quarantine_seconds.
+    A machine coming out of quarantine goes back in after one more failure.
+    Times are those of the clock the scheduler is given, passed in as now.
+    '''
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=60.0, quarantine_after=5, quarantine_seconds=300):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.quarantine_after = quarantine_after
+        self.quarantine_seconds = quarantine_seconds
+        self.attempts = {}
+        self.failures = {}
+        self.quarantined = {}
+
+    def job_failed(self, job_id):
+        '''seconds to wait before retrying the job, None if it ran out of retries'''
+        attempt = self.attempts.get(job_id, 0)
+        if attempt >= self.max_retries:
+            return None
+        self.attempts[job_id] = attempt + 1
+        return backoff_delay(attempt, self.base_delay, self.max_delay)
+
+    def machine_failed(self, machine_idx, now):
+        '''returns whether the machine should now be quarantined'''
+        self.failures[machine_idx] = self.failures.get(machine_idx, 0) + 1
+        if self.failures[machine_idx] >= self.quarantine_after and machine_idx not in self.quarantined:
+            self.quarantined[machine_idx] = now + self.quarantine_seconds
+            return True
+        return False
+
+    def machine_ok(self, machine_idx):
+        self.failures[machine_idx] = 0
+
+    def released(self, now):
+        '''machines whose quarantine is over, on probation'''
+        released = [machine_idx for machine_idx, until in self.quarantined.items() if until <= now]
+        for machine_idx in released:
+            del self.quarantined[machine_idx]
+            self.failures[machine_idx] = self.quarantine_after - 1
+        return released
+
+    def next_release(self):
+        return min(self.quarantined.values(), default=None)
+
+
+class Speculator:
+    '''
+    picks stragglers to start a second copy of, once there are no more jobs to start: jobs running
+    factor times longer than expected, and at least min_seconds. A job is expected to take as long
+    as its command took before, from the history, or else the median of the jobs of the batch that
+    finished, once min_finished have. The scheduler checks for stragglers every interval seconds.
+    '''
+    def __init__(self, history=None, factor=2.0, min_seconds=60.0, min_finished=3, interval=5.0):
+        self.history = history
+        self.factor = factor
+        self.min_seconds = min_seconds
+        self.min_finished = min_finished
+        self.interval = interval
+        self.durations = []
+
+    def observe(self, seconds):
+        bisect.insort(self.durations, seconds)
+
+    def expected(self, command):
+        seconds = self.history.seconds(command) if self.history is not None else None
+        if seconds is None and len(self.durations) >= self.min_finished:
+            seconds = self.durations[len(self.durations) // 2]
+        return seconds
+
+    def stragglers(self, jobs, now):
+        '''the running jobs that are stragglers, the longest running first'''
+        late = []
+        for job in jobs:
+            expected = self.expected(job.command)
+            if expected is not None and now - job.launched_at > max(self.min_seconds, self.factor * expected):
+                late.append(job)
+        return sorted(late, key=lambda job: job.launched_at)
+
+
+class Packer:
+    '''
+    groups consecutive jobs into packs, each run in one remote session.
+    size is the number of jobs per pack. With target_seconds, the size instead adapts so a
+    pack takes about that long, from the durations of the packs that finished so far.
+    parallel is how many jobs of a pack run at once.
+    '''
+    def __init__(self, size=1, target_seconds=None, parallel=1, max_size=1000):
+        self.size = size
+        self.target_seconds = target_seconds
+        self.parallel = parallel
+        self.max_size = max_size
+        self.job_seconds = None
+
+    def observe(self, pack_seconds, num_jobs):
+        '''records that a pack of num_jobs took pack_seconds'''
+        rounds = -(-num_jobs // self.parallel)
+        seconds = pack_seconds / rounds
+        self.job_seconds = seconds if self.job_seconds is None else 0.7 * self.job_seconds + 0.3 * seconds
+
+    def next_size(self):
+        if self.target_seconds is None or self.job_seconds is None:
+            return self.size
+        size = int(self.target_seconds * self.parallel / max(self.job_seconds, 1e-3))
+        return max(1, min(self.max_size, size))
+
+    def packs(self, jobs):
+        '''lazily groups jobs, so pack sizes follow the durations observed while scheduling'''
+        pack = []
+        for job in jobs:
+            pack.append(job)
+            if len(pack) >= self.next_size():
+                yield pack
+                pack = []
+        if pack:
+            yield pack
@@ -0,0 +1,150 @@
+'''
+Runs one command on many machines with a bound on how many ssh sessions are open
+at once. With relaying, the copy-forwards are first archived once and spread as a
+tree: machines that have the archive pass it on to others over their own ssh, so
+the uplink of the machine running execute_on sends it a number of times growing
+with the log of the number of machines, instead of once per machine. Each machine's job then unpacks its copy of the archive.
+'''
+import os
+import sys
+import subprocess
+from collections import deque
+from .dispatch import CompletionQueue
+from .better_basic_run import machine_command, rand_fname
+
+RELAY_FOLDER = "~/.cache/ssh_scheduler/relay"
+# where the copy-forwards come from, as the sender of a relay transfer
+ORIGIN = None
+
+
+def relay_path(payload_id):
+    return f"{RELAY_FOLDER}/{payload_id}.tar"
+
+
+def receive_command(path):
+    '''stores stdin at path, only once all of it arrived'''
+    return f"mkdir -p {os.path.dirname(path)} && cat > {path}.part && mv {path}.part {path}"
+
+
+def upload_command(copy_forwards, machine_config, path):
+    tararg = f"tar --exclude job_results --exclude .git -cmf - {' '.join(copy_forwards)}"
+    return f"{tararg} | {machine_command(machine_config, receive_command(path))}"
+
+
+def relay_command(sender_config, receiver_config, path):
+    '''
+    has the sender pass its archive at path on to the receiver, with the sender's own ssh keys.
+    relay_ip, if set in the receiver's config, is the address the sender reaches it by.
+    '''
+    destination = f"{receiver_config['username']}@{receiver_config.get('relay_ip', receiver_config['ip'])}"
+    hop = f"ssh -T -o StrictHostKeyChecking=no -o BatchMode=yes -p {receiver_config['port']} {destination} \"{receive_command(path)}\" < {path}"
+    return machine_command(sender_config, hop)
+
+
+def run_bounded(items, start, max_parallel, done=None):
+    '''
+    calls start(item), returning a process, for every item, keeping at most max_parallel of
+    the processes running. done(item, returncode) is called as each exits. returns {item: returncode}
+    '''
+    completions = CompletionQueue()
+    pending = deque(items)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < max(1, max_parallel):
+            item = pending.popleft()
+            running[item] = start(item)
+            completions.watch(running[item], item)
+        for item in completions.get():
+            results[item] = running.pop(item).wait()
+            if done is not None:
+                done(item, results[item])
+    return results
+
+
+def relay(num_machines, send, fanout=4, max_parallel=32, done=None):
+    '''
+    spreads a payload from ORIGIN to machines 0..num_machines-1 as a tree. send(sender, receiver)
+    starts the transfer from sender (ORIGIN or a machine that has the payload) and returns its
+    process. The origin and every machine that has the payload send to at most fanout others at
+    once, so the machines having it grow geometrically and the origin sends about fanout * log(N) times.
+    A machine a relay could not reach is sent the payload by the origin itself.
+    done(receiver, ok) is called as each machine gets the payload or fails to.
+    returns the set of machines that have the payload.
+    '''
+    completions = CompletionQueue()
+    pending = deque(range(num_machines))
+    retry_from_origin = deque()
+    capacity = {ORIGIN: fanout}
+    running = {}
+    received = set()
+    while pending or retry_from_origin or running:
+        while len(running) < max(1, max_parallel):
+            senders = [sender for sender in received if capacity[sender] > 0]
+            if pending and senders:
+                sender, receiver = min(senders), pending.popleft()
+            elif capacity[ORIGIN] > 0 and (retry_from_origin or pending):
+                sender, receiver = ORIGIN, (retry_from_origin or pending).popleft()
+            else:
+                break
+            capacity[sender] -= 1
+            running[receiver] = (sender, send(sender, receiver))
+            completions.watch(running[receiver][1], receiver)
+        for receiver in completions.get():
+            sender, proc = running.pop(receiver)
+            capacity[sender] += 1
+            if proc.wait() == 0:
+                received.add(receiver)
+                capacity[receiver] = fanout
+                if done is not None:
+                    done(receiver, True)
+            elif sender is not ORIGIN:
+                retry_from_origin.append(receiver)
+            elif done is not None:
+                done(receiver, False)
+    return received
+
+
+class Progress:
+    '''prints a line as each machine finishes a step, and what failed at the end'''
+    def __init__(self, names, step):
+        self.names = names
+        self.step = step
+        self.count = 0
+        self.failed = []
+
+    def done(self, idx, ok):
+        self.count += 1
+        if not ok:
+            self.failed.append(self.names[idx])
+        print(f"[{self.count}/{len(self.names)}] {self.step} {'done' if ok else 'FAILED'}: {self.names[idx]}", file=sys.stderr, flush=True)
+
+    def summary(self):
+        if not self.failed:
+            return f"{self.step} succeeded on all {len(self.names)} machines"
+        return f"{self.step} failed on {len(self.failed)} of {len(self.names)} machines: {' '.join(self.failed)}"
+
+
+def distribute(copy_forwards, machine_configs, names, fanout=4, max_parallel=32):
+    '''
+    relays an archive of copy_forwards to every machine. returns the path each machine
+    has it at and the indices of the machines that got it
+    '''
+    path = relay_path(rand_fname())
+    progress = Progress(names, "copy")
+
+    def send(sender, receiver):
+        if sender is ORIGIN:
+            command = upload_command(copy_forwards, machine_configs[receiver], path)
+        else:
+            command = relay_command(machine_configs[sender], machine_configs[receiver], path)
+        return subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL)
+
+    received = relay(len(machine_configs), send, fanout, max_parallel, progress.done)
+    print(progress.summary(), file=sys.stderr, flush=True)
+    return path, received
+
+
+def unpack_first(path, command):
+    '''command run after unpacking the relayed archive at path into the job's folder'''
+    return f"tar -xmf {path} && rm -f {path} && {command}"
@@ -0,0 +1,126 @@
+'''
+Client side of the copy-forward cache: hashes the files to forward, asks the
+worker which blobs it is missing, and writes a payload with only those blobs.
+The worker side lives in remote_cache.py.
+'''
+import os
+import io
+import json
+import hashlib
+import tarfile
+import subprocess
+from .remote_cache import BLOB_PREFIX, MANIFEST_NAME
+from .remote_framer import EXCLUDED
+
+DEFAULT_CACHE_DIR = "~/.cache/ssh_scheduler/blobs"
+CHUNK_SIZE = 2**20
+
+# abspath -> (size, mtime_ns, hash), so unchanged files are only hashed once per batch
+_hash_cache = {}
+
+
+def file_hash(path, stat):
+    cached = _hash_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        chunk = file.read(CHUNK_SIZE)
+        while chunk:
+            hasher.update(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    _hash_cache[path] = (stat.st_size, stat.st_mtime_ns, hasher.hexdigest())
+    return hasher.hexdigest()
+
+
+def archive_name(path):
+    '''the name tar would store path under: no leading / or ../'''
+    parts = [part for part in os.path.normpath(path).split(os.sep) if part not in ("", ".", "..")]
+    return "/".join(parts)
+
+
+def manifest_entry(path, arcname):
+    stat = os.lstat(path)
+    if os.path.islink(path):
+        return {"path": arcname, "type": "symlink", "target": os.readlink(path)}
+    elif os.path.isdir(path):
+        return {"path": arcname, "type": "dir"}
+    return {
+        "path": arcname,
+        "type": "file",
+        "hash": file_hash(os.path.abspath(path), stat),
+        "size": stat.st_size,
+        "mode": stat.st_mode & 0o777,
+        "local_path": path,
+    }
+
+
+def build_manifest(copy_forwards):
+    '''walks the forwarded paths like `tar --exclude job_results --exclude .git` would'''
+    manifest = []
+    for top in copy_forwards:
+        if os.path.basename(os.path.normpath(top)) in EXCLUDED:
+            continue
+        manifest.append(manifest_entry(top, archive_name(top)))
+        if os.path.isdir(top) and not os.path.islink(top):
+            for root, dirs, files in os.walk(top):
+                dirs[:] = sorted(d for d in dirs if d not in EXCLUDED)
+                for name in dirs + sorted(f for f in files if f not in EXCLUDED):
+                    path = os.path.join(root, name)
+                    manifest.append(manifest_entry(path, archive_name(path)))
+    return manifest
+
+
+def manifest_blobs(manifest):
+    '''unique (hash, size, local_path) of the file contents in the manifest'''
+    blobs = {}
+    for entry in manifest:
+        if entry['type'] == 'file':
+            blobs.setdefault(entry['hash'], (entry['size'], entry['local_path']))
+    return blobs
+
+
+def query_missing(ssh_command, manifest):
+    '''
+    asks the worker which blobs it lacks, by running `remote_cache.py missing` through ssh_command.
+    If the query fails (for example no python on the remote) every blob is treated as missing.
+    '''
+    blobs = manifest_blobs(manifest)
+    query = "".join(f"{blob_hash} {size}\n" for blob_hash, (size, _) in blobs.items())
+    result = subprocess.run(
+        ssh_command,
+        shell=True,
+        input=query.encode("utf-8"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    if result.returncode != 0:
+        return set(blobs)
+    return set(result.stdout.decode("utf-8").split())
+
+
+def build_args(cache):
+    '''arguments of `remote_cache.py build` for the cache options of better_basic_run.cache_options'''
+    return f"build {cache['dir']} {cache['max_bytes']}" + (" hardlink" if cache.get('hardlinks') else "")
+
+
+def add_bytes(tar, name, data, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_payload(fileobj, manifest, missing, extra_files=()):
+    '''
+    writes the tar stream remote_cache.build expects: missing blobs, the manifest,
+    and extra_files, a list of (arcname, bytes, mode) extracted as is.
+    '''
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for blob_hash, (size, local_path) in manifest_blobs(manifest).items():
+            if blob_hash in missing:
+                tar.add(local_path, arcname=BLOB_PREFIX + blob_hash, recursive=False)
+        remote_manifest = [{k: v for k, v in entry.items() if k != 'local_path'} for entry in manifest]
+        add_bytes(tar, MANIFEST_NAME, json.dumps(remote_manifest).encode("utf-8"))
+        for arcname, data, mode in extra_files:
+            add_bytes(tar, arcname, data, mode)
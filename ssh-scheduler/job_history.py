@@ -0,0 +1,152 @@
+'''
+Durations and peak resources of past jobs, so a batch can run its longest jobs
+first and fit short jobs into the gaps. Jobs are grouped by command template,
+their command with every number replaced, so `train.py --lr 0.1 --seed 3` and
+`train.py --lr 0.01 --seed 4` share a history. The history is an append-only
+JSON lines file, one finished job per line:
+
+    {"template": TEMPLATE, "seconds": WALL_SECONDS, "peak_memory": MB, "cpu_seconds": CPU_SECONDS, "time": UNIX_TIME}
+'''
+import os
+import re
+import copy
+import json
+import math
+import time
+import heapq
+from .remote_framer import STARTED, EXIT
+
+DEFAULT_PATH = "~/.local/var/ssh_scheduler_history.jsonl"
+# weight of the newest duration in a template's running average
+SMOOTHING = 0.3
+# reservations sized from history get this much more than the peak seen
+HEADROOM = 1.25
+
+NUMBER = re.compile(r"(?<![A-Za-z_])[-+]?\d+(\.\d*)?([eE][-+]?\d+)?")
+
+
+def command_template(command):
+    return " ".join(NUMBER.sub("#", command).split())
+
+
+def observed_usage(proc, seconds):
+    '''
+    (seconds, peak_memory, cpu_seconds) of a finished job, timed by the worker if it could.
+    seconds is the wall time from launch to exit, used when the worker did not say when the command started.
+    '''
+    demux = getattr(proc, "demux", None)
+    if demux is None:
+        return seconds, None, None
+    if STARTED in demux.times and EXIT in demux.times:
+        seconds = demux.times[EXIT] - demux.times[STARTED]
+    return seconds, demux.peak_memory, demux.cpu_seconds
+
+
+class JobHistory:
+    '''
+    template -> {"count", "seconds" (a running average), "peak_memory" and "cores" (the largest seen)}.
+    With no path, the history is only kept in memory. template maps a command to the key it is recorded by.
+    '''
+    def __init__(self, path=None, template=command_template):
+        self.path = os.path.expanduser(path) if path else None
+        self.template = template
+        self.stats = {}
+        self.file = None
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.add(entry["template"], entry["seconds"], entry.get("peak_memory"), entry.get("cpu_seconds"))
+
+    def add(self, template, seconds, peak_memory=None, cpu_seconds=None):
+        stats = self.stats.get(template)
+        if stats is None:
+            stats = self.stats[template] = {"count": 0, "seconds": seconds, "peak_memory": None, "cores": None}
+        stats["count"] += 1
+        stats["seconds"] += SMOOTHING * (seconds - stats["seconds"])
+        if peak_memory is not None:
+            stats["peak_memory"] = max(peak_memory, stats["peak_memory"] or 0)
+        if cpu_seconds is not None and seconds > 0:
+            stats["cores"] = max(cpu_seconds / seconds, stats["cores"] or 0)
+
+    def record(self, command, seconds, peak_memory=None, cpu_seconds=None):
+        template = self.template(command)
+        self.add(template, seconds, peak_memory, cpu_seconds)
+        if self.path is None:
+            return
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'a', buffering=1)
+        entry = {"template": template, "seconds": seconds, "peak_memory": peak_memory, "cpu_seconds": cpu_seconds, "time": time.time()}
+        self.file.write(json.dumps(entry) + "\n")
+
+    def estimate(self, command):
+        return self.stats.get(self.template(command))
+
+    def seconds(self, command):
+        '''expected duration of command, None if nothing like it ran before'''
+        stats = self.estimate(command)
+        return stats["seconds"] if stats is not None else None
+
+    def sized_config(self, machine_config, command):
+        '''machine_config with the memory and cpus reserved for command sized from the peaks seen'''
+        stats = self.estimate(command)
+        if stats is None or stats["peak_memory"] is None:
+            return machine_config
+        sized = copy.copy(machine_config)
+        sized.memory_required = int(math.ceil(stats["peak_memory"] * HEADROOM))
+        if stats["cores"] is not None:
+            sized.num_cpus = max(1, int(math.ceil(stats["cores"])))
+        return sized
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class LongestFirst:
+    '''
+    reorders jobs longest expected duration first, within a window of the next lookahead jobs,
+    so long jobs do not end up as the tail of the batch. Jobs that never ran before go first,
+    in file order, since they could be the longest. With backfill, the scheduler can also take
+    short jobs from the window to run in the gap before the next job fits.
+    '''
+    def __init__(self, history, lookahead=1000, backfill=False):
+        self.history = history
+        self.lookahead = lookahead
+        self.backfill = backfill
+        self.window = []
+        self.taken = set()
+
+    def push(self, job):
+        seconds = self.history.seconds(job[2])
+        heapq.heappush(self.window, (-(seconds if seconds is not None else math.inf), job[0], job))
+
+    def jobs(self, jobs):
+        '''lazily yields the (line_num, job_name, command) of jobs in the order to run them'''
+        jobs = iter(jobs)
+        for job in jobs:
+            self.push(job)
+            if len(self.window) >= self.lookahead:
+                break
+        while self.window:
+            _, line_num, job = heapq.heappop(self.window)
+            following = next(jobs, None)
+            if following is not None:
+                self.push(following)
+            if line_num in self.taken:
+                self.taken.discard(line_num)
+            else:
+                yield job
+
+    def candidates(self, horizon):
+        '''jobs in the window expected to finish within horizon seconds, longest first'''
+        fitting = [(-neg_seconds, line_num, job) for neg_seconds, line_num, job in self.window if -neg_seconds <= horizon and line_num not in self.taken]
+        return [job for _, _, job in sorted(fitting, key=lambda item: (-item[0], item[1]))]
+
+    def take(self, job):
+        '''removes a job the scheduler backfilled from the window'''
+        self.taken.add(job[0])
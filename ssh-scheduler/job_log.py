@@ -0,0 +1,314 @@
+'''
+Writes the stdout and stderr of jobs to job_results/<job>.out and .err with large
+buffered writes, instead of a write and flush for every chunk the job prints, and
+reads them back while the job runs. A LogSink can:
+
+* collapse progress bars, if asked: a line rewritten after each \\r only keeps its last
+  text. Logs are byte for byte what the job printed otherwise
+* compress: gzip on the fly, or zstd when a segment is rotated out, as the zstd
+  command cannot flush the part of a stream written so far for a reader
+* rotate to a new segment every max_bytes, keeping the last keep rotated segments
+
+The segments of job.out are:
+
+    job.out[.gz]            the current segment, appended to while the job runs
+    job.out.N[.gz|.zst]     rotated segments, N counting up from 1, oldest first
+
+Written output reaches the file once buffer_bytes of it are waiting, or when JobLogs
+syncs every sink, every interval seconds. When collapsing, a line still being rewritten
+by \\r is held back until it ends, or until the sink is flushed, as when the job's stream ends.
+
+    tail_job [-n LINES] [-f] job_results/JOB.out
+'''
+import os
+import re
+import sys
+import gzip
+import time
+import zlib
+import weakref
+import argparse
+import threading
+import subprocess
+from collections import deque
+
+COMPRESSIONS = ["none", "gzip", "zstd"]
+SEGMENT_PATTERN = re.compile(r"\.(\d+)(\.gz|\.zst)?$")
+
+
+def last_update(line):
+    '''what a terminal ends up showing of a line rewritten after each \\r, for progress bars'''
+    return line.rstrip(b"\r").rpartition(b"\r")[2]
+
+
+def rotated_segments(base):
+    '''[(N, path)] of the rotated segments of the log at base, oldest first'''
+    folder, name = os.path.split(base)
+    segments = {}
+    if not os.path.isdir(folder or "."):
+        return []
+    for entry in os.listdir(folder or "."):
+        match = SEGMENT_PATTERN.match(entry[len(name):]) if entry.startswith(name) else None
+        if match is not None:
+            number = int(match.group(1))
+            # a segment being compressed exists twice for a moment, the compressed one is complete
+            if number not in segments or entry.endswith(".zst"):
+                segments[number] = os.path.join(folder, entry)
+    return sorted(segments.items())
+
+
+def current_segment(base):
+    return base + ".gz" if os.path.exists(base + ".gz") else base
+
+
+def log_files(base):
+    '''every file of the log at base'''
+    files = [path for _, path in rotated_segments(base)]
+    for path in (base, base + ".gz"):
+        if os.path.exists(path):
+            files.append(path)
+    return files
+
+
+def rename_log(base, new_base):
+    for path in log_files(base):
+        os.rename(path, new_base + path[len(base):])
+
+
+class LogSink:
+    '''
+    file-like sink for one job's output at base, for a StreamDemux or a process's stderr.
+    sync() writes out the complete lines, flush() everything written so far, once the
+    segment rotated out before is compressed. StreamDemux only flushes it when the job ends.
+    '''
+    buffered = True
+
+    def __init__(self, base, compression="none", buffer_bytes=2**16, max_bytes=None, keep=None, collapse_cr=False):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown log compression '{compression}', use one of: {' '.join(COMPRESSIONS)}")
+        self.base = base
+        self.compression = compression
+        self.buffer_bytes = buffer_bytes
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.collapse_cr = collapse_cr
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.partial = b""
+        self.compressing = []
+        self.closed = False
+        self.file = None
+        self.open_segment()
+
+    def open_segment(self):
+        path = self.base + ".gz" if self.compression == "gzip" else self.base
+        self.segment_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        self.file = gzip.open(path, 'ab', compresslevel=6) if self.compression == "gzip" else open(path, 'ab', buffering=0)
+
+    def rotate(self):
+        self.file.close()
+        # the segment rotated out before is compressed by now, unless the log grows faster than zstd
+        for proc in self.compressing:
+            proc.wait()
+        self.compressing = []
+        rotated = rotated_segments(self.base)
+        number = rotated[-1][0] + 1 if rotated else 1
+        suffix = ".gz" if self.compression == "gzip" else ""
+        path = f"{self.base}.{number}{suffix}"
+        os.rename(self.base + suffix, path)
+        if self.compression == "zstd":
+            self.compressing.append(subprocess.Popen(["zstd", "-q", "-f", "--rm", path], stdin=subprocess.DEVNULL))
+        if self.keep is not None:
+            for _, old in rotated[:max(0, len(rotated) + 1 - self.keep)]:
+                os.remove(old)
+        self.open_segment()
+
+    def collapse(self, data):
+        '''the complete lines of what came before and data, each cut to its last update'''
+        if b"\n" not in data and len(self.partial) + len(data) <= self.buffer_bytes:
+            # a progress bar update, the common case
+            text = self.partial + data
+            self.partial = last_update(text) + (b"\r" if text.endswith(b"\r") else b"") if b"\r" in data else text
+            return b""
+        lines = (self.partial + data).split(b"\n")
+        partial = lines.pop()
+        # keep only the latest update of the line still being written
+        self.partial = last_update(partial) + (b"\r" if partial.endswith(b"\r") else b"") if b"\r" in partial else partial
+        out = b"".join(last_update(line) + b"\n" for line in lines)
+        if len(self.partial) > self.buffer_bytes:
+            # not a progress bar, output without newlines
+            out += last_update(self.partial)
+            self.partial = b""
+        return out
+
+    def write(self, data):
+        size = len(data)
+        with self.lock:
+            if self.closed:
+                return 0
+            if self.collapse_cr:
+                data = self.collapse(data)
+            self.pending += data
+            if len(self.pending) >= self.buffer_bytes:
+                self._sync()
+        return size
+
+    def flush(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._drain()
+        for proc in self.compressing:
+            proc.wait()
+
+    def _sync(self):
+        if not self.pending:
+            return
+        if self.max_bytes and self.segment_bytes and self.segment_bytes + len(self.pending) > self.max_bytes:
+            self.rotate()
+        self.file.write(bytes(self.pending))
+        if self.compression == "gzip":
+            # readable up to here while the job runs
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+        self.segment_bytes += len(self.pending)
+        self.pending = bytearray()
+
+    def _drain(self):
+        if self.partial:
+            self.pending += last_update(self.partial)
+            self.partial = b""
+        self._sync()
+
+    def sync(self):
+        with self.lock:
+            if not self.closed:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._drain()
+            self.file.close()
+            self.closed = True
+        for proc in self.compressing:
+            proc.wait()
+
+    def __del__(self):
+        if getattr(self, "file", None) is not None:
+            self.close()
+
+
+class JobLogs:
+    '''opens the LogSinks of a batch's jobs, and syncs the open ones every interval seconds from one thread'''
+    def __init__(self, compression="none", buffer_bytes=2**16, max_bytes=None, keep=None, collapse_cr=False, interval=1.0):
+        self.options = {"compression": compression, "buffer_bytes": buffer_bytes, "max_bytes": max_bytes, "keep": keep, "collapse_cr": collapse_cr}
+        self.interval = interval
+        self.sinks = weakref.WeakSet()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def open(self, base):
+        sink = LogSink(base, **self.options)
+        self.sinks.add(sink)
+        return sink
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for sink in list(self.sinks):
+                sink.sync()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        for sink in list(self.sinks):
+            sink.close()
+
+
+def decode_gzip(data, decompressor=None):
+    '''(output, decompressor to continue with) of gzip data that may hold several members, the last maybe unfinished'''
+    out = b""
+    while data:
+        decompressor = decompressor or zlib.decompressobj(31)
+        out += decompressor.decompress(data)
+        data = decompressor.unused_data if decompressor.eof else b""
+        if decompressor.eof:
+            decompressor = None
+    return out, decompressor
+
+
+def read_segment(path):
+    if path.endswith(".zst"):
+        return subprocess.run(["zstd", "-q", "-d", "-c", path], stdout=subprocess.PIPE).stdout
+    with open(path, 'rb') as file:
+        data = file.read()
+    return decode_gzip(data)[0] if path.endswith(".gz") else data
+
+
+class Follower:
+    '''reads what was added to the current segment of a log since the last read, across rotations'''
+    def __init__(self, base):
+        self.base = base
+        self.file = None
+        self.inode = None
+        self.decompressor = None
+
+    def decode(self, data):
+        if not self.file.name.endswith(".gz"):
+            return data
+        out, self.decompressor = decode_gzip(data, self.decompressor)
+        return out
+
+    def read(self):
+        path = current_segment(self.base)
+        if not os.path.exists(path):
+            return b""
+        out = b""
+        inode = os.stat(path).st_ino
+        if self.file is not None and inode != self.inode:
+            # rotated: finish the old segment, then start on the new one
+            out += self.decode(self.file.read())
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.file = open(path, 'rb')
+            self.inode = inode
+            self.decompressor = None
+        return out + self.decode(self.file.read())
+
+
+def tail(base, lines=10, follow=False, out=None, poll=0.5):
+    '''writes the last lines of the log at base to out, then what is added to it if follow, until interrupted'''
+    out = out or sys.stdout.buffer
+    follower = Follower(base)
+    text = follower.read()
+    rotated = rotated_segments(base)
+    while text.count(b"\n") <= lines and rotated:
+        text = read_segment(rotated.pop()[1]) + text
+    last = deque(text.split(b"\n"), maxlen=lines + 1)
+    out.write(b"\n".join(last) if lines else b"")
+    out.flush()
+    try:
+        while follow:
+            time.sleep(poll)
+            new = follower.read()
+            if new:
+                out.write(new)
+                out.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='print the end of a job log, across its rotated and compressed segments')
+    parser.add_argument('-n', '--lines', type=int, default=10, help='lines to print')
+    parser.add_argument('-f', '--follow', action="store_true", help='keep printing what the job writes, until interrupted')
+    parser.add_argument('log', help='the log, like job_results/<job>.out')
+    args = parser.parse_args()
+    base = args.log[:-len(".gz")] if args.log.endswith(".gz") else args.log
+    tail(base, args.lines, args.follow)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+'''
+Records where the time of a batch goes, one JSON object per line:
+
+    {"job": NAME, "machine": IDX, "phase": PHASE, "start": SECONDS, "end": SECONDS}
+
+with times in seconds since the batch started. The job phases are
+    queue      waiting for a free slot, from the start of the batch to its launch
+    connect    from launch until the worker starts setting up the job folder: ssh, tar startup
+    unpack     clearing the job folder and unpacking the copy-forwards, as timed by the worker
+    command    the job's command
+    copy_back  sending and unpacking the copy-backwards
+    cleanup    killing leftover processes and removing the job folder
+and the scheduler's own phases, with job "scheduler", are
+    place      choosing a machine and gpu
+    launch     starting the job's processes, including copy-forward cache queries
+
+Convert a trace to the chrome trace event format (chrome://tracing, ui.perfetto.dev)
+and print its summary with
+
+    python -m ssh_scheduler.job_trace TRACE.jsonl --chrome TRACE.json
+'''
+import sys
+import json
+import time
+import argparse
+import threading
+from .remote_framer import STARTED, EXIT, END
+
+SCHEDULER = "scheduler"
+JOB_PHASES = ["queue", "connect", "unpack", "command", "copy_back", "cleanup"]
+SCHEDULER_PHASES = ["place", "launch"]
+
+
+class JobTrace:
+    '''
+    writes phase events to the file at path.
+    machines and slots are the machine names and how many jobs each can run at once,
+    for the utilization summary.
+    '''
+    def __init__(self, path, machines=(), slots=()):
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', buffering=1)
+        self.cleanup_threads = []
+        self.write({"phase": "batch", "machines": list(machines), "slots": list(slots), "unix_start": time.time()})
+
+    def write(self, event):
+        with self.lock:
+            self.file.write(json.dumps(event) + "\n")
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def since_start(self, monotonic):
+        return monotonic - self.start
+
+    def record(self, job, machine, phase, start, end):
+        if start is not None and end is not None:
+            self.write({"job": job, "machine": machine, "phase": phase, "start": start, "end": max(start, end)})
+
+    def record_job(self, job, machine, queued, launched, finished, proc):
+        '''records a finished job's phases from when it was queued, launched and found finished, and its StreamDemux's timings'''
+        self.record(job, machine, "queue", queued, launched)
+        demux = getattr(proc, "demux", None)
+        times = {channel: self.since_start(t) for channel, t in demux.times.items()} if demux is not None else {}
+        started = times.get(STARTED)
+        exited = times.get(EXIT, finished)
+        if started is not None:
+            setup_start = max(launched, started - demux.remote_setup) if demux.remote_setup is not None else started
+            self.record(job, machine, "connect", launched, setup_start)
+            self.record(job, machine, "unpack", setup_start, started)
+            self.record(job, machine, "command", started, exited)
+        else:
+            self.record(job, machine, "command", launched, exited)
+        self.record(job, machine, "copy_back", exited, times.get(END, finished))
+
+    def record_cleanup(self, job, machine, proc):
+        '''starts proc's cleanup and records how long it takes, in a thread'''
+        thread = threading.Thread(target=self._time_cleanup, args=(job, machine, proc), daemon=True)
+        thread.start()
+        self.cleanup_threads.append(thread)
+
+    def _time_cleanup(self, job, machine, proc):
+        start = self.now()
+        for cleanup in proc.close() or []:
+            cleanup.wait()
+        self.record(job, machine, "cleanup", start, self.now())
+
+    def close(self):
+        '''waits for the cleanups being timed'''
+        for thread in self.cleanup_threads:
+            thread.join()
+        self.file.close()
+
+
+def load_events(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def chrome_trace(events):
+    '''chrome trace event format, one row per job grouped by machine'''
+    header = next((e for e in events if e.get("phase") == "batch"), {"machines": []})
+    names = header["machines"]
+    trace_events = []
+    for event in events:
+        if event.get("phase") == "batch":
+            continue
+        machine = event["machine"]
+        pid = SCHEDULER if machine is None else (names[machine] if machine < len(names) else str(machine))
+        trace_events.append({
+            "name": event["phase"],
+            "cat": "scheduler" if event["job"] == SCHEDULER else "job",
+            "ph": "X",
+            "ts": event["start"] * 1e6,
+            "dur": (event["end"] - event["start"]) * 1e6,
+            "pid": pid,
+            "tid": event["job"],
+        })
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def summarize(events):
+    '''
+    per machine utilization (busy job seconds over slots times the batch length),
+    jobs finished per second, scheduler overhead as a percent of the batch length,
+    and the total seconds spent in each phase.
+    '''
+    header = next((e for e in events if e.get("phase") == "batch"), {"machines": [], "slots": []})
+    spans = [e for e in events if e.get("phase") != "batch"]
+    wall = max((e["end"] for e in spans), default=0.0)
+    phase_seconds = {}
+    for event in spans:
+        phase_seconds[event["phase"]] = phase_seconds.get(event["phase"], 0.0) + event["end"] - event["start"]
+    busy = {}
+    jobs = set()
+    for event in spans:
+        if event["job"] != SCHEDULER and event["phase"] not in ("queue", "cleanup"):
+            busy[event["machine"]] = busy.get(event["machine"], 0.0) + event["end"] - event["start"]
+            jobs.add(event["job"])
+    utilization = {}
+    for machine, seconds in sorted(busy.items()):
+        name = header["machines"][machine] if machine < len(header["machines"]) else str(machine)
+        slots = header["slots"][machine] if machine < len(header["slots"]) else 1
+        utilization[name] = seconds / (max(slots, 1) * wall) if wall > 0 else 0.0
+    scheduler_seconds = sum(phase_seconds.get(phase, 0.0) for phase in SCHEDULER_PHASES)
+    return {
+        "wall_seconds": wall,
+        "jobs": len(jobs),
+        "jobs_per_second": len(jobs) / wall if wall > 0 else 0.0,
+        "scheduler_overhead_percent": 100 * scheduler_seconds / wall if wall > 0 else 0.0,
+        "utilization": utilization,
+        "phase_seconds": phase_seconds,
+    }
+
+
+def format_summary(summary):
+    lines = [
+        f"{summary['jobs']} jobs in {summary['wall_seconds']:.1f}s, {summary['jobs_per_second']:.3f} jobs/s, "
+        f"scheduler overhead {summary['scheduler_overhead_percent']:.2f}%",
+    ]
+    for name, utilization in summary["utilization"].items():
+        lines.append(f"  {name}: {100 * utilization:.1f}% utilized")
+    for phase in JOB_PHASES + SCHEDULER_PHASES:
+        if phase in summary["phase_seconds"]:
+            lines.append(f"  {phase}: {summary['phase_seconds'][phase]:.2f}s total")
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Summarize a job trace written by execute_batch --trace')
+    parser.add_argument('trace', help='the JSON lines trace file')
+    parser.add_argument('--chrome', help='also write the trace in the chrome trace event format to this file')
+    args = parser.parse_args(argv)
+
+    events = load_events(args.trace)
+    if args.chrome:
+        with open(args.chrome, 'w') as file:
+            json.dump(chrome_trace(events), file)
+    print(format_summary(summarize(events)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
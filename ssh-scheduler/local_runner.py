@@ -0,0 +1,144 @@
+'''
+Runs a job on this machine without ssh or tar, for machine configs pointing at
+localhost. The job's workspace is built from the copy-forwards with reflinks
+(or hardlinks, or plain copies), the job script comes on stdin, and the
+copy-backwards the job added or changed (all of them with --copy-back-all) are
+renamed into the results folder instead of being archived. Writes the same
+frames as remote_framer.py, so a StreamDemux reads its output:
+
+    python3 local_runner.py [--copy-back-all] LINK_MODE RUN_FOLDER RESULTS_FOLDER SCRIPT COPY_FORWARDS ... -- COPY_BACKWARDS ...
+
+LINK_MODE is reflink, hardlink or copy. Hardlinked files are shared with the
+originals, so a job writing into one of its inputs in place changes the original.
+'''
+import os
+import sys
+import time
+import fcntl
+import shutil
+import struct
+
+try:
+    from .remote_framer import STDOUT, STDERR, EXIT, END, STARTED, EXCLUDED, FrameWriter, run_command, exit_payload, snapshot, changed_files
+except ImportError:
+    # run as a script, from this folder
+    from remote_framer import STDOUT, STDERR, EXIT, END, STARTED, EXCLUDED, FrameWriter, run_command, exit_payload, snapshot, changed_files
+
+LINK_MODES = ["reflink", "hardlink", "copy"]
+# the ioctl cloning one file's extents into another, on filesystems that share them (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(source, dest):
+    '''clones source where the filesystem can, copies it where it cannot'''
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, 2**20)
+    shutil.copystat(source, dest)
+
+
+def hardlink(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        # another filesystem
+        shutil.copy2(source, dest)
+
+
+LINKERS = {"reflink": reflink, "hardlink": hardlink, "copy": shutil.copy2}
+
+
+def link_tree(source, dest, mode="reflink"):
+    '''puts source, a file or folder, at dest, linking or cloning every file instead of copying its data'''
+    link = LINKERS[mode]
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), dest)
+    elif os.path.isdir(source):
+        os.makedirs(dest, exist_ok=True)
+        for name in os.listdir(source):
+            if name not in EXCLUDED:
+                link_tree(os.path.join(source, name), os.path.join(dest, name), mode)
+    else:
+        link(source, dest)
+
+
+def build_workspace(run_folder, copy_forwards, mode):
+    '''lays out the copy-forwards in run_folder where tar -x would, absolute paths under their path from /'''
+    shutil.rmtree(run_folder, ignore_errors=True)
+    os.makedirs(run_folder)
+    for path in copy_forwards:
+        dest = os.path.normpath(os.path.join(run_folder, path.lstrip("/")))
+        if dest == os.path.normpath(run_folder):
+            # "." and the like, the workspace is the folder itself
+            for name in os.listdir(path):
+                if name not in EXCLUDED:
+                    link_tree(os.path.join(path, name), os.path.join(dest, name), mode)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            link_tree(path, dest, mode)
+
+
+def move_results(run_folder, results_folder, copy_backwards):
+    '''
+    renames the copy-backwards from the workspace into results_folder, merging into folders
+    already there like unpacking the results archive would. returns the paths that did not exist.
+    '''
+    missing = []
+    for path in copy_backwards:
+        source = os.path.normpath(os.path.join(run_folder, path))
+        if not os.path.lexists(source):
+            missing.append(path)
+            continue
+        dest = os.path.normpath(os.path.join(results_folder, path))
+        if source == os.path.normpath(run_folder):
+            for name in os.listdir(source):
+                merge(os.path.join(source, name), os.path.join(dest, name))
+        else:
+            merge(source, dest)
+    return missing
+
+
+def merge(source, dest):
+    if os.path.isdir(dest) and not os.path.islink(dest) and os.path.isdir(source):
+        for name in os.listdir(source):
+            merge(os.path.join(source, name), os.path.join(dest, name))
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        os.replace(source, dest)
+
+
+def main(argv):
+    setup_start = time.time()
+    copy_back_all = argv[0] == "--copy-back-all"
+    if copy_back_all:
+        argv = argv[1:]
+    split = argv.index("--")
+    mode, run_folder, results_folder, script = argv[:4]
+    copy_forwards, copy_backwards = argv[4:split], argv[split+1:]
+    writer = FrameWriter(sys.stdout.buffer)
+    build_workspace(run_folder, copy_forwards, mode)
+    with open(os.path.join(run_folder, script), 'wb') as file:
+        file.write(sys.stdin.buffer.read())
+    results_folder = os.path.abspath(results_folder)
+    os.chdir(run_folder)
+    before = snapshot(copy_backwards) if copy_backwards and not copy_back_all else None
+    writer.write(STARTED, struct.pack(">d", time.time() - setup_start))
+    unbuffer = ["stdbuf", "-i0", "-o0", "-e0"] if shutil.which("stdbuf") else []
+    returncode, usage = run_command(writer, unbuffer + ["bash", "-i", script], STDOUT)
+    writer.write(EXIT, exit_payload(returncode, usage))
+    if copy_backwards:
+        os.makedirs(results_folder, exist_ok=True)
+        moved = copy_backwards if before is None else changed_files(copy_backwards, before)[0]
+        for path in copy_backwards:
+            if not os.path.lexists(path):
+                writer.write(STDERR, f"local_runner: {path}: Cannot stat: No such file or directory\n".encode("utf-8"))
+        move_results(".", results_folder, moved)
+    writer.write(END)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+'''
+Remembers which copy-forward sets were recently sent to which machine, so that when
+machine loads are close, a job is placed where its inputs already are instead of
+paying for sending them again. A set is known by a fingerprint of its contents, so
+lines forwarding the same dataset folder share it.
+
+Sent files only stay on a worker with --cache-forwards, whose blob cache keeps them
+after the job, so only jobs caching their copy-forwards are placed by locality. Each
+machine is taken to hold the sets sent to it most recently, up to its cache size.
+Machines running jobs locally copy nothing, so they never pay for a transfer.
+'''
+import hashlib
+from collections import OrderedDict
+from .forward_cache import build_manifest, manifest_blobs
+from .machine_cost_model import MAX_COST
+
+
+def payload_fingerprint(copy_forwards):
+    '''(fingerprint, bytes) of the file contents copy_forwards sends, the same wherever they are'''
+    blobs = manifest_blobs(build_manifest(copy_forwards))
+    hasher = hashlib.sha256()
+    for blob_hash in sorted(blobs):
+        hasher.update(blob_hash.encode("utf-8"))
+    return hasher.hexdigest(), sum(size for size, _ in blobs.values())
+
+
+class Locality:
+    '''
+    job_inputs(command) returns the copy-forwards of a job placed by locality, None for
+    other jobs. transfer_cost is what sending a GB of copy-forwards to a machine costs,
+    as a fraction of MAX_COST, a fully loaded machine. capacity is the bytes of copy-forwards
+    each machine keeps, local the indices of the machines that run jobs locally.
+    '''
+    def __init__(self, num_machines, job_inputs, transfer_cost, capacity=None, local=()):
+        self.job_inputs = job_inputs
+        self.transfer_cost = transfer_cost
+        self.capacity = capacity
+        self.local = set(local)
+        # machine_idx -> fingerprint -> bytes, least recently used first
+        self.staged = [OrderedDict() for _ in range(num_machines)]
+        # fingerprint -> machines it is staged on
+        self.holders = {}
+        # tuple of copy-forwards -> (fingerprint, bytes), hashed once per batch
+        self.fingerprints = {}
+        self.jobs = 0
+        self.hits = 0
+        self.bytes_sent = 0
+        self.bytes_avoided = 0
+
+    def inputs(self, command):
+        '''(fingerprint, bytes) of the job's copy-forwards, None if it is not placed by locality'''
+        copy_forwards = self.job_inputs(command)
+        if copy_forwards is None:
+            return None
+        key = tuple(copy_forwards)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = payload_fingerprint(copy_forwards)
+        return self.fingerprints[key]
+
+    def preference(self, inputs):
+        '''(staged, transfer_cost) for MachineIndex.best'''
+        if inputs is None:
+            return (), 0
+        fingerprint, size = inputs
+        return self.holders.get(fingerprint, set()) | self.local, self.transfer_cost * MAX_COST * size / 2**30
+
+    def placed(self, machine_idx, inputs):
+        '''records that a job with inputs was started on the machine, which holds them from then on'''
+        if inputs is None or machine_idx in self.local:
+            return
+        fingerprint, size = inputs
+        staged = self.staged[machine_idx]
+        self.jobs += 1
+        if fingerprint in staged:
+            self.hits += 1
+            self.bytes_avoided += size
+            staged.move_to_end(fingerprint)
+            return
+        self.bytes_sent += size
+        staged[fingerprint] = size
+        self.holders.setdefault(fingerprint, set()).add(machine_idx)
+        while self.capacity is not None and len(staged) > 1 and sum(staged.values()) > self.capacity:
+            evicted, _ = staged.popitem(last=False)
+            self.holders[evicted].discard(machine_idx)
+
+    def summary(self):
+        return (
+            f"locality: {self.hits} of {self.jobs} jobs placed where their copy-forwards already were, "
+            f"{self.bytes_avoided / 2**20:.1f} MB not sent again, {self.bytes_sent / 2**20:.1f} MB sent"
+        )
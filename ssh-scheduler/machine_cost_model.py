@@ -1,7 +1,14 @@
 import copy
+import math
+import heapq
+import itertools
 
 
 MAX_COST = 1e10
+# cost of each unit of distance between two gpus of a multi-gpu job, see link_distance
+LINK_COST = MAX_COST * 0.01
+# how far apart nvidia-smi topo -m says two gpus are, from an nvlink between them to crossing sockets
+LINK_DISTANCES = {"X": 0, "NV": 0, "PIX": 1, "PXB": 2, "PHB": 3, "NODE": 4, "SYS": 5}
 
 
 def is_over_limit(cost):
@@ -20,28 +27,113 @@ def argmin(costs):
     return min((cost, i) for i, cost in enumerate(costs))[1]
 
 
+def num_gpus(machine_config):
+    return getattr(machine_config, 'num_gpus', 1)
+
+
+def gpu_indices(gpu_idx):
+    '''the gpus a placement uses: gpu_idx is None, one gpu's index, or a tuple of them for a multi-gpu job'''
+    if gpu_idx is None:
+        return ()
+    return gpu_idx if isinstance(gpu_idx, tuple) else (gpu_idx,)
+
+
+def link_distance(link):
+    '''distance of a connection type from nvidia-smi topo -m, NV<n> being n nvlinks'''
+    if link.startswith("NV"):
+        return 0
+    return LINK_DISTANCES.get(link, LINK_DISTANCES["SYS"])
+
+
+def gpu_set_cost(machine_config, machine_state, gpu_set):
+    links = machine_state.get('gpu_links')
+    cost = sum(gpu_cost(machine_config, machine_state['gpus'][i]) for i in gpu_set)
+    if links:
+        cost += LINK_COST * sum(link_distance(links[i][j]) for i, j in itertools.combinations(gpu_set, 2))
+    return cost
+
+
 def get_best_gpu(machine_config, machine_state):
-    if 'gpus' not in machine_state:
+    '''
+    the least loaded gpu, or for jobs needing several, the tuple of gpus that is
+    cheapest counting both their load and how far apart they are connected
+    '''
+    if not machine_state.get('gpus'):
+        return None
+    count = num_gpus(machine_config)
+    if count <= 1:
+        return argmin(gpu_cost(machine_config, gpu_conf) for gpu_conf in machine_state['gpus'])
+    if count > len(machine_state['gpus']):
         return None
-    return argmin(gpu_cost(machine_config, gpu_conf) for gpu_conf in machine_state['gpus'])
+    gpu_sets = list(itertools.combinations(range(len(machine_state['gpus'])), count))
+    return gpu_sets[argmin(gpu_set_cost(machine_config, machine_state, gpu_set) for gpu_set in gpu_sets)]
+
+def pinned(machine_config):
+    return getattr(machine_config, 'pin_cpus', False)
 
-def get_best_machine(machine_states, machine_config):
-    return argmin(machine_cost(machine_config, machine_state) for machine_state in machine_states)
 
+def pick_cpus(numa_cpus, free_cpus, count, nodes=()):
+    '''
+    count of the free cpus for a job to be pinned to, all on one numa node if one has enough,
+    trying the given nodes first (those local to the job's gpus), then the nodes with the most free.
+    Returns fewer than count if there are not enough free cpus.
+    '''
+    free_by_node = [sorted(cpu for cpu in cpus if cpu in free_cpus) for cpus in numa_cpus]
+    order = sorted(range(len(numa_cpus)), key=lambda node: (node not in nodes, -len(free_by_node[node]), node))
+    for node in order:
+        if len(free_by_node[node]) >= count:
+            return free_by_node[node][:count]
+    return [cpu for node in order for cpu in free_by_node[node]][:count]
+
+
+def transfer_term(machine_idx, cost, staged, transfer_cost):
+    '''what a job costs a machine on top of its load: transfer_cost unless the machine is in staged, holding the job's inputs, and has room'''
+    return 0 if machine_idx in staged and not is_over_limit(cost) else transfer_cost
+
+
+def get_best_machine(machine_states, machine_config, staged=(), transfer_cost=0):
+    costs = [machine_cost(machine_config, machine_state) for machine_state in machine_states]
+    # ties, as when adding transfer_cost rounds loads apart to the same cost, go to the least loaded
+    return min((cost + transfer_term(i, cost, staged, transfer_cost), cost, i) for i, cost in enumerate(costs))[2]
 
-def machine_cost(machine_config, machine_state):
+
+def machine_cost(machine_config, machine_state, gpu_idx=None):
+    '''
+    cost of the machine's load. Without gpu_idx, counts the gpus a new job would get,
+    with it, the gpus a job placed there has, to check that they are not overloaded.
+    '''
     MAX_CPU_UTILIZATION = 1.5
     min_gpu_cost = 0
     if not machine_config.no_gpu_required:
-        min_gpu_cost = min(gpu_cost(machine_config, gpu_conf) for gpu_conf in machine_state['gpus'])
+        if gpu_idx is None:
+            gpu_idx = get_best_gpu(machine_config, machine_state)
+        if gpu_idx is None:
+            # not enough gpus
+            min_gpu_cost = MAX_COST
+        else:
+            min_gpu_cost = gpu_set_cost(machine_config, machine_state, gpu_indices(gpu_idx))
     return (
+        (MAX_COST if machine_state.get('drained') else 0) +
+        (MAX_COST if machine_state.get('quarantined') else 0) +
         (MAX_COST if machine_state['reserved'] > 1 else 0) +
         (MAX_COST if machine_state['mem_free'] < 0 else 0) +
+        (MAX_COST if machine_state.get('free_cpu_count', 0) < 0 else 0) +
         MAX_COST * ((machine_state['cpu_usage']/MAX_CPU_UTILIZATION) ** 3) +
         min_gpu_cost
     )
 
 
+def fitted_cost(machine_config, machine_state):
+    '''cost of the machine once a job reserving machine_config is added to it, on the gpus it would get'''
+    gpu_idx = None if machine_config.no_gpu_required else get_best_gpu(machine_config, machine_state)
+    if gpu_idx is None and not machine_config.no_gpu_required:
+        return machine_cost(machine_config, machine_state)
+    added = add_to_machine_state(machine_state, machine_config, gpu_idx)
+    cost = machine_cost(machine_config, added, gpu_idx)
+    remove_from_machine_state(added, gpu_idx)
+    return cost
+
+
 def add_to_gpu_state(old_gpu_state, machine_config):
     """return copy of gpu state with new job instance added"""
     gpu_state = copy.copy(old_gpu_state)
@@ -63,7 +155,8 @@ def add_to_machine_state(old_machine_state, machine_config, gpu_idx):
     machine_state['cpu_usage'] += machine_config.num_cpus / machine_state['cpu_count']
     machine_state['mem_free'] -= machine_config.memory_required
     if not machine_config.no_gpu_required:
-        machine_state['gpus'][gpu_idx] = add_to_gpu_state(machine_state['gpus'][gpu_idx], machine_config)
+        for i in gpu_indices(gpu_idx):
+            machine_state['gpus'][i] = add_to_gpu_state(machine_state['gpus'][i], machine_config)
 
     return machine_state
 
@@ -71,10 +164,186 @@ def add_to_machine_state(old_machine_state, machine_config, gpu_idx):
 def remove_from_machine_state(old_machine_state, gpu_idx):
     machine_state = old_machine_state['old_state']
     assert machine_state['gpus'] is old_machine_state['gpus'], "don't copy gpu list"
-    machine_state['gpus'][gpu_idx] = old_machine_state['gpus'][gpu_idx]['old_state']
+    for i in gpu_indices(gpu_idx):
+        machine_state['gpus'][i] = old_machine_state['gpus'][i]['old_state']
     return machine_state
 
 
+class Reservation:
+    """resources one job holds on a machine, exactly what release gives back"""
+    __slots__ = ("machine_idx", "gpu_idx", "reserved", "cpu_usage", "mem", "gpu_reserved", "gpu_mem", "gpu_utilization", "cpus", "pinned_count")
+
+    def __init__(self, machine_idx, gpu_idx, machine_config, machine_state):
+        self.machine_idx = machine_idx
+        self.reserved = 1 if machine_config.reserve else 0
+        self.cpu_usage = machine_config.num_cpus / machine_state['cpu_count']
+        self.mem = machine_config.memory_required
+        self.gpu_idx = None
+        self.gpu_reserved = self.gpu_mem = self.gpu_utilization = 0
+        if not machine_config.no_gpu_required:
+            self.gpu_idx = gpu_idx
+            self.gpu_reserved = 0 if machine_config.no_reserve_gpu else 1
+            self.gpu_mem = machine_config.gpu_memory_required
+            self.gpu_utilization = machine_config.gpu_utilization
+        # the cpus a pinned job gets, see ResourceLedger.pin
+        self.cpus = None
+        self.pinned_count = 0
+
+
+class ResourceLedger:
+    """
+    Tracks the resources each running job holds. Machine states are updated in place
+    and reservations are kept by job id, so jobs can be released in any order in O(1).
+    When the machine config has pin_cpus, each job also gets its own set of cpus, kept
+    in the machine state's free_cpu_count, which going negative puts it over its limit.
+    """
+    def __init__(self, machine_states, on_change=None):
+        """on_change(machine_idx), if given, is called whenever a machine's state changes"""
+        self.machine_states = machine_states
+        self.reservations = {}
+        self.on_change = on_change
+        # machine_idx -> cpus not pinned to any of our jobs
+        self.free_cpus = {}
+
+    def apply(self, reservation, sign):
+        machine_state = self.machine_states[reservation.machine_idx]
+        machine_state['reserved'] += sign * reservation.reserved
+        machine_state['cpu_usage'] += sign * reservation.cpu_usage
+        machine_state['mem_free'] -= sign * reservation.mem
+        for gpu_idx in gpu_indices(reservation.gpu_idx):
+            gpu_state = machine_state['gpus'][gpu_idx]
+            gpu_state['reserved'] += sign * reservation.gpu_reserved
+            gpu_state['free'] -= sign * reservation.gpu_mem
+            gpu_state['utilization'] += sign * reservation.gpu_utilization
+        if reservation.cpus is not None:
+            free_cpus = self.free_cpus[reservation.machine_idx]
+            if sign > 0:
+                free_cpus.difference_update(reservation.cpus)
+            else:
+                free_cpus.update(reservation.cpus)
+            machine_state['free_cpu_count'] -= sign * reservation.pinned_count
+        self.changed(reservation.machine_idx)
+
+    def pin(self, reservation, machine_config):
+        """
+        picks the cpus of a job from those free on its machine, on the numa node local to
+        its gpus if the machine said which that is. Machines the probe could not get the numa
+        layout of are taken as one node.
+        """
+        machine_state = self.machine_states[reservation.machine_idx]
+        numa_cpus = machine_state.get('numa_cpus') or [list(range(machine_state['cpu_count']))]
+        if reservation.machine_idx not in self.free_cpus:
+            self.free_cpus[reservation.machine_idx] = {cpu for cpus in numa_cpus for cpu in cpus}
+            machine_state['free_cpu_count'] = len(self.free_cpus[reservation.machine_idx])
+        gpu_numa = machine_state.get('gpu_numa') or []
+        nodes = {gpu_numa[i] for i in gpu_indices(reservation.gpu_idx) if i < len(gpu_numa) and gpu_numa[i] is not None}
+        reservation.pinned_count = max(1, int(math.ceil(machine_config.num_cpus)))
+        reservation.cpus = pick_cpus(numa_cpus, self.free_cpus[reservation.machine_idx], reservation.pinned_count, nodes)
+
+    def changed(self, machine_idx):
+        if self.on_change is not None:
+            self.on_change(machine_idx)
+
+    def allocate(self, job_id, machine_idx, gpu_idx, machine_config):
+        assert job_id not in self.reservations, f"job {job_id} is already placed"
+        reservation = Reservation(machine_idx, gpu_idx, machine_config, self.machine_states[machine_idx])
+        if pinned(machine_config):
+            self.pin(reservation, machine_config)
+        self.apply(reservation, 1)
+        self.reservations[job_id] = reservation
+        return reservation
+
+    def release(self, job_id):
+        reservation = self.reservations.pop(job_id)
+        self.apply(reservation, -1)
+        return reservation
+
+    def machine_reservations(self, machine_idx):
+        return [r for r in self.reservations.values() if r.machine_idx == machine_idx]
+
+    def drain(self, machine_idx):
+        """stops placing jobs on the machine until it is refreshed again"""
+        self.machine_states[machine_idx]['drained'] = True
+        self.changed(machine_idx)
+
+    def quarantine(self, machine_idx, quarantined=True):
+        """stops placing jobs on a machine that keeps failing to connect, until it is let out again"""
+        self.machine_states[machine_idx]['quarantined'] = quarantined
+        self.changed(machine_idx)
+
+    def refresh(self, machine_idx, fresh_state):
+        """
+        Replaces the machine's state with a fresh query_machine_info measurement.
+        The measurement already includes the load of our own running jobs, so each
+        resource is taken as the larger of the measured load and our reservations,
+        instead of counting our jobs twice.
+        """
+        machine_state = self.machine_states[machine_idx]
+        held = self.machine_reservations(machine_idx)
+        cpu_held = sum(r.cpu_usage for r in held)
+        mem_held = sum(r.mem for r in held)
+        mem_total = fresh_state.get('mem_total', fresh_state['mem_free'] + mem_held)
+        machine_state['cpu_count'] = fresh_state['cpu_count']
+        machine_state['cpu_usage'] = max(fresh_state['cpu_usage'], cpu_held)
+        machine_state['mem_free'] = min(fresh_state['mem_free'], mem_total - mem_held)
+        if len(fresh_state['gpus']) == len(machine_state['gpus']):
+            for gpu_idx, (gpu_state, fresh_gpu) in enumerate(zip(machine_state['gpus'], fresh_state['gpus'])):
+                gpu_held = [r for r in held if gpu_idx in gpu_indices(r.gpu_idx)]
+                gpu_state['free'] = min(fresh_gpu['free'], fresh_gpu['mem'] - sum(r.gpu_mem for r in gpu_held))
+                gpu_state['utilization'] = max(fresh_gpu['utilization'], sum(r.gpu_utilization for r in gpu_held))
+        machine_state['drained'] = False
+        self.changed(machine_idx)
+
+
+class MachineIndex:
+    """
+    Heap of machine costs, so finding the best machine does not rescore every machine.
+    Only machines passed to update are rescored, stale heap entries are skipped lazily.
+    best() picks the same machine as get_best_machine, ties go to the lowest index.
+    """
+    def __init__(self, machine_states, machine_config):
+        self.machine_states = machine_states
+        self.machine_config = machine_config
+        self.rebuild()
+
+    def rebuild(self):
+        self.versions = [0] * len(self.machine_states)
+        self.costs = [machine_cost(self.machine_config, state) for state in self.machine_states]
+        self.heap = [(cost, i, 0) for i, cost in enumerate(self.costs)]
+        heapq.heapify(self.heap)
+
+    def update(self, machine_idx):
+        self.versions[machine_idx] += 1
+        cost = machine_cost(self.machine_config, self.machine_states[machine_idx])
+        self.costs[machine_idx] = cost
+        heapq.heappush(self.heap, (cost, machine_idx, self.versions[machine_idx]))
+        if len(self.heap) > 4 * len(self.machine_states) + 64:
+            self.rebuild()
+
+    def best(self, staged=(), transfer_cost=0):
+        '''
+        with staged, the few machines holding a job's inputs, the others cost transfer_cost more,
+        so only the cheapest machine and those in staged need comparing
+        '''
+        while True:
+            cost, machine_idx, version = self.heap[0]
+            if version == self.versions[machine_idx]:
+                break
+            heapq.heappop(self.heap)
+        best = (cost + transfer_term(machine_idx, cost, staged, transfer_cost), cost, machine_idx)
+        for idx in staged:
+            best = min(best, (self.costs[idx] + transfer_term(idx, self.costs[idx], staged, transfer_cost), self.costs[idx], idx))
+        return best[2]
+
+    def best_fit(self, machine_config, staged=(), transfer_cost=0):
+        '''
+        like best, for a job reserving its own machine_config, like one sized from its history.
+        The heap is scored for the batch's config, so every machine is scored with the job added.
+        '''
+        costs = [fitted_cost(machine_config, state) for state in self.machine_states]
+        return min((cost + transfer_term(i, cost, staged, transfer_cost), cost, i) for i, cost in enumerate(costs))[2]
+
+
 def init_machine_limit(machine_limit):
     """
     machine limit comes from query_machine_info
@@ -99,8 +368,10 @@ def get_process_gpu_limit(machine_limit, machine_config):
     gpu_choices = []
     while True:
         best_gpu = get_best_gpu(machine_config, machine_limit)
+        if best_gpu is None and not machine_config.no_gpu_required:
+            break
         machine_limit = add_to_machine_state(machine_limit, machine_config, best_gpu)
-        cost = machine_cost(machine_config, machine_limit)
+        cost = machine_cost(machine_config, machine_limit, best_gpu)
         if is_over_limit(cost):
             break
         gpu_choices.append(best_gpu)
@@ -0,0 +1,119 @@
+'''
+Streams the machine's free resources as one compact JSON object per line, in
+the same format as query_machine_info.parse_full_output. Uses only the standard
+library, since the scheduler ships this file's source over ssh and keeps it
+running on one connection:
+
+    python3 metrics_agent.py INTERVAL
+
+Exits when the scheduler closes the connection.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+
+GPU_QUERY = ["nvidia-smi", "--query-gpu=name,memory.total,memory.free,utilization.gpu", "--format=csv,noheader,nounits"]
+
+
+def parse_stat_line(line):
+    '''
+    the aggregate cpu line of /proc/stat:
+    cpu  user nice system idle iowait irq softirq steal guest guest_nice
+    returns (busy, total) jiffies
+    '''
+    values = [int(v) for v in line.split()[1:]]
+    # guest time is already counted in user and nice
+    total = sum(values[:8])
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return total - idle, total
+
+
+def cpu_usage_between(before, after):
+    busy = after[0] - before[0]
+    total = after[1] - before[1]
+    return busy / total if total > 0 else 0.0
+
+
+def parse_meminfo(meminfo_str):
+    '''returns (available, total) in MiB'''
+    fields = {}
+    for line in meminfo_str.strip().split("\n"):
+        key, value = line.split(":", 1)
+        fields[key] = int(value.split()[0])
+    available = fields.get("MemAvailable", fields["MemFree"] + fields.get("Cached", 0))
+    return available // 1024, fields["MemTotal"] // 1024
+
+
+def count_cpus(cpuinfo_str):
+    return sum(1 for line in cpuinfo_str.split("\n") if line.startswith("processor"))
+
+
+def parse_gpu_csv(csv_str):
+    '''nvidia-smi --format=csv,noheader,nounits output, one line per gpu'''
+    gpus = []
+    for line in csv_str.strip().split("\n"):
+        if not line.strip():
+            continue
+        name, mem, free, util = [v.strip() for v in line.split(",")]
+        gpus.append({"name": name, "mem": int(mem), "free": int(free), "utilization": float(util)/100})
+    return gpus
+
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+
+def read_cpu_times():
+    with open("/proc/stat") as file:
+        return parse_stat_line(file.readline())
+
+
+def gpu_snapshot():
+    if shutil.which("nvidia-smi") is None:
+        return []
+    result = subprocess.run(GPU_QUERY, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return []
+    return parse_gpu_csv(result.stdout.decode("utf-8"))
+
+
+def snapshot(before, after):
+    mem_free, mem_total = parse_meminfo(read_file("/proc/meminfo"))
+    return {
+        "cpu_usage": cpu_usage_between(before, after),
+        "mem_free": mem_free,
+        "mem_total": mem_total,
+        "cpu_count": os.cpu_count() or count_cpus(read_file("/proc/cpuinfo")),
+        "gpus": gpu_snapshot(),
+    }
+
+
+def exit_on_disconnect():
+    '''ssh closes our stdin when the scheduler goes away'''
+    while sys.stdin.buffer.read(4096):
+        pass
+    os._exit(0)
+
+
+def main(argv):
+    interval = float(argv[0]) if argv else 5.0
+    threading.Thread(target=exit_on_disconnect, daemon=True).start()
+    before = read_cpu_times()
+    while True:
+        time.sleep(interval)
+        after = read_cpu_times()
+        try:
+            sys.stdout.write(json.dumps(snapshot(before, after), separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+        except BrokenPipeError:
+            return
+        before = after
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,4 +1,6 @@
+import re
 import json
+from .metrics_agent import parse_stat_line, cpu_usage_between, parse_meminfo, parse_gpu_csv, GPU_QUERY
 def get_cpu_usage():
     '''
     top
@@ -27,13 +29,19 @@ def parse_cpu_usage(usage_str):
         mem_entry = float(mem_entry.split("+")[0])*10
     else:
         mem_entry = float(mem_entry)#.split("+")[0]*10
+    total_entry = mem.split(":")[1].split("total")[0].strip()
+    if "+" in total_entry:
+        mem_total = float(total_entry.split("+")[0])*10
+    else:
+        mem_total = float(total_entry)
     if mem.split()[0] == "KiB":
         mem_free = mem_entry//1024
+        mem_total = mem_total//1024
     elif mem.split()[0] == "MiB":
         mem_free = mem_entry
     else:
         raise RuntimeError("top command returned a weirdly formatted output")
-    return {"cpu_usage": cpu_usage, "mem_free": mem_free}
+    return {"cpu_usage": cpu_usage, "mem_free": mem_free, "mem_total": mem_total}
 
 def get_cpu_count():
     return "lscpu"
@@ -78,6 +86,58 @@ def parse_gpu_info(gpu_info_str):
 
         return {"gpus": gpu_infos}
 
+def get_gpu_topology():
+    return "nvidia-smi topo -m"
+
+def parse_gpu_topology(topo_str):
+    '''
+    the connection between each pair of gpus, from nvidia-smi topo -m:
+            GPU0    GPU1    GPU2    CPU Affinity    NUMA Affinity
+    GPU0     X      NV2     SYS     0-11            0
+    GPU1    NV2      X      SYS     0-11            0
+    GPU2    SYS     SYS      X      12-23           1
+    gives {"gpu_links": [["X", "NV2", "SYS"], ["NV2", "X", "SYS"], ["SYS", "SYS", "X"]], "gpu_numa": [0, 0, 1]}
+    gpu_numa is the numa node local to each gpu, None where the driver does not say
+    '''
+    # newer drivers underline the header
+    lines = re.sub(r"\x1b\[[0-9;]*m", "", topo_str).split("\n")
+    header = next((line.split() for line in lines if re.match(r"^\s+GPU0\b", line)), None)
+    if header is None:
+        return {}
+    num_gpus = sum(1 for column in header if re.match(r"^GPU\d+$", column))
+    # gpus and nics, the columns before the affinities
+    num_links = header.index("CPU") if "CPU" in header else len(header)
+    rows = [line.split() for line in lines if re.match(r"^GPU\d+\s", line)][:num_gpus]
+    gpu_numa = [None] * len(rows)
+    if "NUMA" in header:
+        for i, row in enumerate(rows):
+            numa = row[num_links+2] if len(row) > num_links + 2 else ""
+            gpu_numa[i] = int(numa) if numa.isdigit() else None
+    return {"gpu_links": [row[1:num_gpus+1] for row in rows], "gpu_numa": gpu_numa}
+
+def get_numa_layout():
+    return "lscpu -p=CPU,NODE"
+
+def parse_numa_layout(layout_str):
+    '''
+    the cpus of each numa node, from lscpu -p=CPU,NODE:
+    # CPU,NODE
+    0,0
+    1,1
+    2,0
+    gives {"numa_cpus": [[0, 2], [1]]}, one node holding every cpu when lscpu does not know the nodes
+    '''
+    numa_cpus = []
+    for line in layout_str.strip().split("\n"):
+        fields = line.strip().split(",")
+        if line.startswith("#") or len(fields) < 2 or not fields[0].isdigit():
+            continue
+        node = int(fields[1]) if fields[1].isdigit() else 0
+        while len(numa_cpus) <= node:
+            numa_cpus.append([])
+        numa_cpus[node].append(int(fields[0]))
+    return {"numa_cpus": numa_cpus} if numa_cpus else {}
+
 def get_full_command():
     return f"{get_cpu_usage()} && printf \"<<>>\" && {get_cpu_count()} && printf \"<<>>\" && {get_gpu_info()} || echo"
 
@@ -96,6 +156,61 @@ def parse_full_output(out_str):
     cpu_count_entries = parse_cpu_count(cpu_count_data)
     return {**cpu_entries, **cpu_count_entries, **gpu_entries}
 
+def get_proc_command(window=0.2):
+    '''
+    reads /proc directly: two samples of /proc/stat `window` seconds apart give the
+    current cpu usage (top's first iteration averages since boot), then /proc/meminfo,
+    the processor count from /proc/cpuinfo, nvidia-smi only if it is installed,
+    and which cpus are on which numa node from lscpu
+    '''
+    gpu_query = " ".join(GPU_QUERY)
+    return (
+        f"head -n1 /proc/stat && sleep {window} && head -n1 /proc/stat && printf \"<<>>\" && "
+        f"cat /proc/meminfo && printf \"<<>>\" && grep -c ^processor /proc/cpuinfo && printf \"<<>>\" && "
+        f"(command -v nvidia-smi > /dev/null && {gpu_query} || true) && printf \"<<>>\" && "
+        f"(command -v nvidia-smi > /dev/null && {get_gpu_topology()} || true) && printf \"<<>>\" && "
+        f"({get_numa_layout()} 2> /dev/null || true)"
+    )
+
+def parse_proc_output(out_str):
+    '''
+    output looks like this:
+    cpu  4705 150 1120 16250 520 0 60 0 0 0
+    cpu  4725 150 1125 16270 520 0 60 0 0 0
+    <<>>MemTotal:       16353512 kB
+    MemFree:        11519076 kB
+    MemAvailable:   12647468 kB
+    ...
+    <<>>24
+    <<>>GeForce RTX 2060, 5934, 5933, 0
+    <<>>        GPU0    CPU Affinity    NUMA Affinity
+    GPU0     X      0-23            N/A
+    <<>># CPU,NODE
+    0,0
+    ...
+    '''
+    sections = out_str.split("<<>>")
+    stat_data, meminfo_data, cpu_count_data, gpu_data = sections[:4]
+    topology_data = sections[4] if len(sections) > 4 else ""
+    layout_data = sections[5] if len(sections) > 5 else ""
+    before, after = stat_data.strip().split("\n")[:2]
+    mem_free, mem_total = parse_meminfo(meminfo_data)
+    return {
+        "cpu_usage": cpu_usage_between(parse_stat_line(before), parse_stat_line(after)),
+        "mem_free": mem_free,
+        "mem_total": mem_total,
+        "cpu_count": int(cpu_count_data.strip()),
+        "gpus": parse_gpu_csv(gpu_data),
+        **parse_gpu_topology(topology_data),
+        **parse_numa_layout(layout_data),
+    }
+
+# name: (command, parser) of each way to query a machine's free resources
+PROBES = {
+    "top": (get_full_command, parse_full_output),
+    "proc": (get_proc_command, parse_proc_output),
+}
+
 if __name__ == "__main__":
     # test
     import subprocess
@@ -0,0 +1,264 @@
+'''
+Worker side of the agent backend: runs many jobs for the scheduler over a single
+ssh session. Uses only the standard library and remote_framer.py, since the
+scheduler ships the source of both over ssh:
+
+    python3 remote_agent.py
+
+Messages in both directions are frames of a one byte type, a 4 byte job id,
+a 4 byte length and the payload. The scheduler sends START (json job spec),
+INPUT (the job's copy-forward archive, ended by an empty INPUT) and KILL.
+The agent answers with STARTED (the seconds spent setting up the job folder),
+STDOUT, STDERR, EXIT (the exit code, peak memory in MB and cpu seconds), RESULTS (the copy-backward archive) and finally END, after which the job's folder is removed.
+The archive is made by remote_framer.send_results, so it only holds the copy-backwards the
+job added or changed, unless the spec has copy_back_all, and is compressed with the spec's
+compress (CODEC[:LEVEL] or none, as remote_framer.py --compress takes it). Each job's
+copy-forwards are unpacked from its own thread, so a slow one does not hold up the others.
+When the scheduler disconnects, all running jobs are killed and their folders
+removed before the agent exits.
+'''
+import os
+import sys
+import time
+import json
+import queue
+import shutil
+import signal
+import struct
+import threading
+import subprocess
+try:
+    from . import remote_framer
+except ImportError:
+    # run from its source on the worker, where remote_python_command sent remote_framer.py along
+    import remote_framer
+
+START = 1
+INPUT = 2
+KILL = 3
+STDOUT = 4
+STDERR = 5
+EXIT = 6
+RESULTS = 7
+END = 8
+STARTED = 9
+
+HEADER = struct.Struct(">BII")
+CHUNK_SIZE = 2**16
+SCRIPT_NAME = ".agent_job.sh"
+KILL_GRACE_SECONDS = 0.3
+# remote_framer channel -> the message carrying it
+FRAME_KINDS = {
+    remote_framer.STDOUT: STDOUT,
+    remote_framer.STDERR: STDERR,
+    remote_framer.RESULTS: RESULTS,
+}
+
+
+def write_message(stream, kind, job_id, payload=b""):
+    stream.write(HEADER.pack(kind, job_id, len(payload)) + payload)
+
+
+def read_exact(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_message(stream):
+    '''returns (kind, job_id, payload), or (None, None, None) if the stream ended'''
+    header = read_exact(stream, HEADER.size)
+    if header is None:
+        return None, None, None
+    kind, job_id, size = HEADER.unpack(header)
+    payload = read_exact(stream, size)
+    if payload is None:
+        return None, None, None
+    return kind, job_id, payload
+
+
+class MessageWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, kind, job_id, payload=b""):
+        with self.lock:
+            try:
+                write_message(self.stream, kind, job_id, payload)
+                self.stream.flush()
+            except (BrokenPipeError, ValueError):
+                # the scheduler is gone, jobs still drain their output while they are cleaned up
+                pass
+
+
+class JobFrames(remote_framer.FrameWriter):
+    '''writes the remote_framer frames of one job as its messages, for remote_framer.send_results'''
+    def __init__(self, writer, job_id):
+        self.writer = writer
+        self.job_id = job_id
+
+    def write(self, channel, payload=b""):
+        self.writer.send(FRAME_KINDS[channel], self.job_id, payload)
+
+
+class AgentJob:
+    '''on_end(job_id), if given, is called once the job's folder is removed'''
+    def __init__(self, writer, job_id, spec, on_end=None):
+        self.writer = writer
+        self.frames = JobFrames(writer, job_id)
+        self.job_id = job_id
+        self.on_end = on_end
+        self.thread = None
+        self.folder = spec['folder']
+        self.script = spec['script']
+        self.copy_backwards = spec['copy_backwards']
+        self.copy_back_all = spec.get('copy_back_all', False)
+        self.compress = spec.get('compress')
+        self.unpack_command = spec.get('unpack') or "tar -x"
+        self.unpack = None
+        # chunks of the copy-forward archive, b"" once it is complete, None if it never will be
+        self.inputs = queue.Queue()
+        self.proc = None
+        self.killed = False
+        self.setup_start = time.time()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder)
+
+    def add_input(self, data):
+        '''queues a chunk of the copy-forward archive, the empty chunk ends it and starts the job'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.feed, daemon=True)
+            self.thread.start()
+        self.inputs.put(data)
+
+    def feed(self):
+        '''unpacks the copy-forwards as they arrive, then runs the job'''
+        data = self.inputs.get()
+        while data:
+            # started on the first input, tar fails on an empty archive
+            if self.unpack is None:
+                self.unpack = subprocess.Popen(self.unpack_command, shell=True, cwd=self.folder, stdin=subprocess.PIPE)
+            try:
+                self.unpack.stdin.write(data)
+            except BrokenPipeError:
+                pass
+            data = self.inputs.get()
+        if data is None:
+            # the scheduler went away before sending all of them, so the job never runs
+            if self.unpack is not None:
+                self.unpack.kill()
+                self.unpack.wait()
+            shutil.rmtree(self.folder, ignore_errors=True)
+            return
+        if self.unpack is not None:
+            try:
+                self.unpack.stdin.close()
+            except BrokenPipeError:
+                pass
+        self.run()
+
+    def run_script(self, command):
+        '''runs the job's script in its own process group, returning its exit code and resource usage'''
+        proc = subprocess.Popen(
+            command,
+            cwd=self.folder,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        self.proc = proc
+        if self.killed:
+            self.kill()
+        threads = [
+            self.frames.pump_thread(remote_framer.STDOUT, proc.stdout),
+            self.frames.pump_thread(remote_framer.STDERR, proc.stderr),
+        ]
+        for thread in threads:
+            thread.join()
+        return remote_framer.wait_with_usage(proc)
+
+    def in_folder(self, paths):
+        '''paths in the job's folder, as seen from the agent's own'''
+        return [os.path.join(self.folder, path) for path in paths]
+
+    def run(self):
+        try:
+            if self.unpack is not None and self.unpack.wait() != 0:
+                self.writer.send(STDERR, self.job_id, b"agent: could not unpack copy-forwards\n")
+            self.writer.send(STARTED, self.job_id, struct.pack(">d", time.time() - self.setup_start))
+            with open(os.path.join(self.folder, SCRIPT_NAME), 'w') as file:
+                file.write(self.script)
+            unbuffer = ["stdbuf", "-i0", "-o0", "-e0"] if shutil.which("stdbuf") else []
+            before = remote_framer.snapshot(self.in_folder(self.copy_backwards)) if self.copy_backwards and not self.copy_back_all else None
+            returncode, usage = self.run_script(unbuffer + ["bash", "-i", SCRIPT_NAME])
+            self.writer.send(EXIT, self.job_id, remote_framer.exit_payload(returncode, usage))
+            if self.copy_backwards and not self.killed:
+                remote_framer.send_results(self.frames, self.copy_backwards, before, self.compress, self.folder)
+        finally:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.writer.send(END, self.job_id)
+            if self.on_end is not None:
+                self.on_end(self.job_id)
+
+    def signal_group(self, proc, signum):
+        if proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signum)
+            except OSError:
+                pass
+
+    def kill(self):
+        '''terminates the job's whole process group, interactive bash ignores SIGTERM so it is killed after a grace period'''
+        self.killed = True
+        if self.proc is not None:
+            self.signal_group(self.proc, signal.SIGTERM)
+            threading.Timer(KILL_GRACE_SECONDS, self.signal_group, args=(self.proc, signal.SIGKILL)).start()
+
+    def abandon(self):
+        '''waits for a killed job's folder to be removed, for when the scheduler went away'''
+        if self.thread is None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            return
+        # wakes the job if its copy-forwards never finished arriving, so it never runs
+        self.inputs.put(None)
+        self.thread.join()
+
+
+def main():
+    writer = MessageWriter(sys.stdout.buffer)
+    # the jobs that have not ended, removed by their run threads as they do
+    jobs = {}
+
+    def ended(job_id):
+        jobs.pop(job_id, None)
+
+    while True:
+        kind, job_id, payload = read_message(sys.stdin.buffer)
+        if kind is None:
+            break
+        if kind == START:
+            try:
+                jobs[job_id] = AgentJob(writer, job_id, json.loads(payload), on_end=ended)
+            except OSError as err:
+                writer.send(STDERR, job_id, f"agent: could not start job: {err}\n".encode("utf-8"))
+                writer.send(END, job_id)
+        elif kind == INPUT and job_id in jobs:
+            jobs[job_id].add_input(payload)
+        elif kind == KILL and job_id in jobs:
+            jobs[job_id].kill()
+    # the scheduler went away, nobody is left to collect results
+    remaining = list(jobs.values())
+    for job in remaining:
+        job.kill()
+    for job in remaining:
+        job.abandon()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+'''
+Content addressed blob cache kept on each worker. Uses only the standard library,
+since better_basic_run ships this file's source over ssh and runs it with the
+remote python:
+
+    python3 remote_cache.py missing CACHE_DIR < "hash size" lines
+    python3 remote_cache.py build CACHE_DIR MAX_BYTES [hardlink] < payload tar
+
+build is run inside the job folder. The payload tar holds the blobs the cache
+was missing under .blobs/<hash>, the job's file list in .manifest.json, and any
+other files, which are extracted in place.
+
+Job files are reflinks of their blobs where the filesystem supports it, and copies
+otherwise, unless hardlink is given. Hardlinked files are read only, and a job
+running as root can still write through them, so a blob's modification time is
+pinned to BLOB_MTIME: a blob whose modification time moved is treated as missing,
+and sent again. How recently a blob was used is kept in its access time.
+'''
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tarfile
+
+BLOB_PREFIX = ".blobs/"
+MANIFEST_NAME = ".manifest.json"
+# blobs touched this recently may be about to be linked by a job that was told they exist
+EVICT_GRACE_SECONDS = 3600
+FICLONE = 0x40049409
+CHUNK_SIZE = 2**20
+BLOB_MTIME = 0
+
+
+def blob_path(cache_dir, blob_hash):
+    return os.path.join(cache_dir, blob_hash[:2], blob_hash)
+
+
+def find_missing(cache_dir, entries):
+    '''
+    entries is a list of (hash, size) pairs, returns the hashes not in the cache,
+    or whose blob was written to since it was stored.
+    Present blobs are touched so they count as recently used.
+    '''
+    missing = []
+    now = time.time()
+    for blob_hash, size in entries:
+        path = blob_path(cache_dir, blob_hash)
+        try:
+            stat = os.stat(path)
+            if stat.st_size != size or stat.st_mtime != BLOB_MTIME:
+                raise FileNotFoundError(path)
+            os.utime(path, (now, BLOB_MTIME))
+        except OSError:
+            missing.append(blob_hash)
+    return missing
+
+
+def store_blob(cache_dir, blob_hash, fileobj):
+    path = blob_path(cache_dir, blob_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    hasher = hashlib.sha256()
+    with open(tmp_path, 'wb') as file:
+        chunk = fileobj.read(CHUNK_SIZE)
+        while chunk:
+            hasher.update(chunk)
+            file.write(chunk)
+            chunk = fileobj.read(CHUNK_SIZE)
+    if hasher.hexdigest() != blob_hash:
+        os.remove(tmp_path)
+        raise RuntimeError(f"blob {blob_hash} changed while it was being sent")
+    # blobs may be shared by hardlinks, so jobs must not be able to edit them in place
+    os.chmod(tmp_path, 0o444)
+    os.utime(tmp_path, (time.time(), BLOB_MTIME))
+    os.replace(tmp_path, path)
+
+
+def materialize(src, dest, mode, hardlink=False):
+    '''
+    makes dest a copy of the cached blob src: a reflink if the filesystem
+    supports it, otherwise a hardlink if asked for, otherwise a real copy
+    '''
+    try:
+        with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        os.chmod(dest, mode)
+        return
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+    blob_executable = bool(os.stat(src).st_mode & 0o111)
+    if hardlink and blob_executable == bool(mode & 0o111):
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dest)
+    os.chmod(dest, mode)
+
+
+def build_job_folder(cache_dir, manifest, job_folder=".", hardlink=False):
+    now = time.time()
+    for entry in manifest:
+        dest = os.path.join(job_folder, entry['path'])
+        if entry['type'] == 'dir':
+            os.makedirs(dest, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        if entry['type'] == 'symlink':
+            os.symlink(entry['target'], dest)
+        else:
+            src = blob_path(cache_dir, entry['hash'])
+            os.utime(src, (now, BLOB_MTIME))
+            materialize(src, dest, entry['mode'], hardlink)
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    '''removes least recently used blobs until the cache fits in max_bytes'''
+    blobs = []
+    for root, dirs, files in os.walk(cache_dir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            blobs.append((stat.st_atime, stat.st_size, fname, path))
+    total = sum(size for _, size, _, _ in blobs)
+    recent = time.time() - EVICT_GRACE_SECONDS
+    keep = set(keep)
+    for atime, size, fname, path in sorted(blobs):
+        if total <= max_bytes:
+            break
+        if fname in keep or atime > recent:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+
+def build(cache_dir, max_bytes, fileobj, job_folder=".", hardlink=False):
+    manifest = []
+    added = False
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if member.name.startswith(BLOB_PREFIX):
+                store_blob(cache_dir, member.name[len(BLOB_PREFIX):], tar.extractfile(member))
+                added = True
+            elif member.name == MANIFEST_NAME:
+                manifest = json.load(tar.extractfile(member))
+            else:
+                tar.extract(member, job_folder)
+    build_job_folder(cache_dir, manifest, job_folder, hardlink)
+    if added:
+        evict(cache_dir, max_bytes, keep=[entry['hash'] for entry in manifest if entry['type'] == 'file'])
+
+
+def main(argv):
+    mode, cache_dir = argv[0], os.path.expanduser(argv[1])
+    os.makedirs(cache_dir, exist_ok=True)
+    if mode == "missing":
+        entries = [line.split() for line in sys.stdin if line.strip()]
+        for blob_hash in find_missing(cache_dir, [(h, int(size)) for h, size in entries]):
+            print(blob_hash)
+    elif mode == "build":
+        build(cache_dir, int(argv[2]), sys.stdin.buffer, hardlink=argv[3:] == ["hardlink"])
+    else:
+        raise ValueError(f"unknown mode {mode}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+'''
+Runs a job script on the worker and sends everything back over ssh stdout as
+length prefixed frames, so stdout text, stderr text and the results archive
+can never be confused, whatever bytes the job prints. Uses only the standard
+library, since better_basic_run ships this file's source over ssh:
+
+    python3 remote_framer.py [--copy-back-all] [--compress CODEC[:LEVEL]] SCRIPT [COPY_BACKWARDS ...]
+    python3 remote_framer.py [--copy-back-all] [--compress CODEC[:LEVEL]] --pack PARALLEL SCRIPT [SCRIPT ...] -- [COPY_BACKWARDS ...]
+
+Each frame is a one byte channel, a 4 byte big endian length, then the payload.
+The STARTED frame holds the seconds the job folder took to set up, measured from
+the SSHS_SETUP_START environment variable (a unix time), or -1 if it is not set.
+The EXIT frame holds the 4 byte exit code, then the peak memory in megabytes and
+the cpu seconds of the job script and the processes it waited for, as doubles.
+With --pack, the scripts run PARALLEL at a time, and each script's own frames are
+sent inside PACKED frames, prefixed by the script's 4 byte index and the frame's
+channel. The results archive of each script is taken right after it exits. Scripts
+run in the job folder, except when several run at once with COPY_BACKWARDS: then
+each runs in its own WORKSPACE_PREFIX<index> folder, a copy of the job folder made
+of hard links, so its results only hold the files it wrote itself.
+The results archive only holds the files under COPY_BACKWARDS that are new or
+whose size or modification time changed while the script ran, unless
+--copy-back-all comes first, and is gzipped when those add up to COMPRESS_BYTES.
+--compress picks the codec instead (one of COMPRESSORS, or none), which is used
+from MIN_COMPRESS_BYTES on. Either way, results a sample of which barely
+compresses are sent as they are.
+'''
+import os
+import sys
+import time
+import queue
+import zlib
+import struct
+import shutil
+import threading
+import subprocess
+
+STDOUT = 1
+STDERR = 2
+EXIT = 3
+RESULTS = 4
+END = 5
+STARTED = 6
+PACKED = 7
+
+HEADER = struct.Struct(">BI")
+PACK_HEADER = struct.Struct(">IB")
+CHUNK_SIZE = 2**16
+# results at least this big are compressed on the way back
+COMPRESS_BYTES = 2**23
+# results at least this big are compressed when a codec was picked for the machine's link
+MIN_COMPRESS_BYTES = 2**16
+# codec -> command compressing stdin to stdout, and the level it uses by default
+COMPRESSORS = {"zstd": "zstd -q -c -{level}", "lz4": "lz4 -q -c -{level}", "gzip": "gzip -c -{level}"}
+DEFAULT_LEVELS = {"zstd": 3, "lz4": 1, "gzip": 1}
+# bytes read from the files to guess how well they compress
+SAMPLE_BYTES = 2**20
+# data whose sample shrinks less than this is not worth compressing
+INCOMPRESSIBLE = 0.9
+# the folder each script of a parallel pack runs in, inside the job folder
+WORKSPACE_PREFIX = ".pack_"
+# skipped anywhere in the copy-forwards, like the tar of the ssh path does
+EXCLUDED = {"job_results", ".git"}
+
+
+def write_frame(stream, channel, payload=b""):
+    stream.write(HEADER.pack(channel, len(payload)) + payload)
+
+
+def read_exact(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    '''returns (channel, payload), or (None, None) if the stream ended'''
+    header = read_exact(stream, HEADER.size)
+    if header is None:
+        return None, None
+    channel, size = HEADER.unpack(header)
+    payload = read_exact(stream, size)
+    if payload is None:
+        return None, None
+    return channel, payload
+
+
+class FrameWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, channel, payload=b""):
+        with self.lock:
+            write_frame(self.stream, channel, payload)
+            self.stream.flush()
+
+    def pump(self, channel, source):
+        '''frames everything read from source, an unbuffered pipe'''
+        chunk = os.read(source.fileno(), CHUNK_SIZE)
+        while chunk:
+            self.write(channel, chunk)
+            chunk = os.read(source.fileno(), CHUNK_SIZE)
+
+    def pump_thread(self, channel, source):
+        thread = threading.Thread(target=self.pump, args=(channel, source))
+        thread.start()
+        return thread
+
+
+class PackedWriter(FrameWriter):
+    '''writes the frames of one script of a pack inside PACKED frames'''
+    def __init__(self, writer, index):
+        self.writer = writer
+        self.index = index
+
+    def write(self, channel, payload=b""):
+        self.writer.write(PACKED, PACK_HEADER.pack(self.index, channel) + payload)
+
+
+def wait_with_usage(proc):
+    '''waits for proc, returning its exit code and the resource usage of it and the children it waited for'''
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return proc.returncode, usage
+
+
+def exit_payload(returncode, usage):
+    return struct.pack(">idd", returncode, usage.ru_maxrss / 1024, usage.ru_utime + usage.ru_stime)
+
+
+def feed_input(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+
+def run_command(writer, command, out_channel, input=None, cwd=None):
+    '''returns the exit code of command and its resource usage. input, if given, is written to its stdin'''
+    stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL
+    proc = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    threads = [writer.pump_thread(out_channel, proc.stdout), writer.pump_thread(STDERR, proc.stderr)]
+    if input is not None:
+        threads.append(threading.Thread(target=feed_input, args=(proc.stdin, input)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    return wait_with_usage(proc)
+
+
+def walk_files(paths):
+    '''yields (path, lstat) of every file and symlink under paths, folders are walked without following links'''
+    for top in paths:
+        if os.path.isdir(top) and not os.path.islink(top):
+            for root, dirs, files in os.walk(top):
+                for name in dirs + files:
+                    path = os.path.normpath(os.path.join(root, name))
+                    stat = os.lstat(path)
+                    if name in files or os.path.islink(path):
+                        yield path, stat
+        elif os.path.lexists(top):
+            yield os.path.normpath(top), os.lstat(top)
+
+
+def snapshot(paths):
+    '''path -> (size, mtime) of the files under paths'''
+    return {path: (stat.st_size, stat.st_mtime_ns) for path, stat in walk_files(paths)}
+
+
+def changed_files(paths, before):
+    '''the files under paths that are new or changed since the snapshot before, and their total size'''
+    files = []
+    size = 0
+    for path, stat in walk_files(paths):
+        if before.get(path) != (stat.st_size, stat.st_mtime_ns):
+            files.append(path)
+            size += stat.st_size
+    return files, size
+
+
+def sample_ratio(files, sample_bytes=SAMPLE_BYTES):
+    '''
+    how much a sample spread over the files shrinks with zlib at level 1, compressed over
+    original size, as a guess of how well all of them compress. 1.0 if there is nothing to read
+    '''
+    files = [path for path in files if os.path.isfile(path) and not os.path.islink(path)]
+    if not files:
+        return 1.0
+    # every file in the sample if there are few, evenly spaced ones if there are many
+    files = files[::max(1, len(files) // 64)]
+    per_file = max(2**12, sample_bytes // len(files))
+    sample = b""
+    for path in files:
+        try:
+            with open(path, 'rb') as file:
+                sample += file.read(per_file)
+        except OSError:
+            pass
+        if len(sample) >= sample_bytes:
+            break
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def parse_codec(compress):
+    '''(codec, level) from CODEC[:LEVEL], or None for none'''
+    name, _, level = compress.partition(":")
+    if name == "none":
+        return None
+    return name, int(level) if level else DEFAULT_LEVELS[name]
+
+
+def result_compressor(files, size, compress=None):
+    '''
+    the command compressing the results archive, or None to send it as it is. With compress
+    None, results from COMPRESS_BYTES on are gzipped, otherwise compress is CODEC[:LEVEL] or none
+    '''
+    codec, threshold = ("gzip", 1), COMPRESS_BYTES
+    if compress is not None:
+        codec, threshold = parse_codec(compress), MIN_COMPRESS_BYTES
+    if codec is None or size < threshold or not shutil.which(codec[0]) or sample_ratio(files) > INCOMPRESSIBLE:
+        return None
+    return COMPRESSORS[codec[0]].format(level=codec[1])
+
+
+def results_command(recursive=False, compressor=None):
+    '''archives the null separated file names on stdin, piped through compressor if it is given'''
+    tar = "tar -cmf - --null -T -" if recursive else "tar -cmf - --null --no-recursion -T -"
+    if compressor is not None:
+        return ["sh", "-c", f"{tar} | {compressor}"]
+    return ["sh", "-c", tar]
+
+
+def send_results(writer, copy_backwards, before, compress=None, folder="."):
+    '''sends the copy-backwards under folder, only those changed since the snapshot before unless it is None'''
+    paths = [os.path.normpath(os.path.join(folder, path)) for path in copy_backwards]
+    for path, shown in zip(paths, copy_backwards):
+        if not os.path.lexists(path):
+            writer.write(STDERR, f"tar: {shown}: Cannot stat: No such file or directory\n".encode("utf-8"))
+    if before is None:
+        files = [path for path in paths if os.path.lexists(path)]
+        walked = list(walk_files(files))
+        size = sum(stat.st_size for _, stat in walked)
+        compressor = result_compressor([path for path, _ in walked], size, compress)
+    else:
+        files, size = changed_files(paths, before)
+        compressor = result_compressor(files, size, compress)
+    names = b"".join(os.path.relpath(path, folder).encode("utf-8") + b"\0" for path in files)
+    run_command(writer, results_command(before is None, compressor), RESULTS, names, cwd=folder)
+
+
+def make_workspace(folder):
+    '''a copy of the job folder at folder, of hard links to its files, for a script of a parallel pack'''
+    for root, dirs, files in os.walk("."):
+        dirs[:] = [name for name in dirs if not (root == "." and name.startswith(WORKSPACE_PREFIX))]
+        dest_root = os.path.normpath(os.path.join(folder, root))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in dirs + files:
+            source, dest = os.path.join(root, name), os.path.join(dest_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), dest)
+            elif name in files:
+                try:
+                    os.link(source, dest)
+                except OSError:
+                    shutil.copy2(source, dest)
+
+
+def run_script(writer, script, copy_backwards, copy_back_all=False, compress=None, folder="."):
+    '''runs script in folder, the job folder or a workspace in it'''
+    unbuffer = ["stdbuf", "-i0", "-o0", "-e0"] if shutil.which("stdbuf") else []
+    paths = [os.path.join(folder, path) for path in copy_backwards]
+    before = snapshot(paths) if copy_backwards and not copy_back_all else None
+    returncode, usage = run_command(writer, unbuffer + ["bash", "-i", script], STDOUT, cwd=folder)
+    writer.write(EXIT, exit_payload(returncode, usage))
+    if copy_backwards:
+        send_results(writer, copy_backwards, before, compress, folder)
+    writer.write(END)
+
+
+def run_pack(writer, parallel, scripts, copy_backwards, copy_back_all=False, compress=None):
+    todo = queue.Queue()
+    for index, script in enumerate(scripts):
+        todo.put((index, script))
+
+    # scripts running at once would each see the others' files as their own results
+    separate = parallel > 1 and len(scripts) > 1 and bool(copy_backwards)
+
+    def worker():
+        while True:
+            try:
+                index, script = todo.get_nowait()
+            except queue.Empty:
+                return
+            folder = f"{WORKSPACE_PREFIX}{index}" if separate else "."
+            if separate:
+                make_workspace(folder)
+            run_script(PackedWriter(writer, index), script, copy_backwards, copy_back_all, compress, folder)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, parallel))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main(argv):
+    writer = FrameWriter(sys.stdout.buffer)
+    setup_start = os.environ.get("SSHS_SETUP_START")
+    writer.write(STARTED, struct.pack(">d", time.time() - float(setup_start) if setup_start else -1.0))
+    copy_back_all = argv[0] == "--copy-back-all"
+    if copy_back_all:
+        argv = argv[1:]
+    compress = None
+    if argv[0] == "--compress":
+        compress, argv = argv[1], argv[2:]
+    if argv[0] == "--pack":
+        split = argv.index("--")
+        run_pack(writer, int(argv[1]), argv[2:split], argv[split+1:], copy_back_all, compress)
+        writer.write(END)
+    else:
+        run_script(writer, argv[0], argv[1:], copy_back_all, compress)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
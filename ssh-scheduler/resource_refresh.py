@@ -0,0 +1,113 @@
+import json
+import threading
+import subprocess
+from collections import namedtuple
+from .better_basic_run import machine_command, remote_python_command, remote_script
+from .query_machine_info import PROBES
+
+# info is None if the machine could not be reached
+MachineRefresh = namedtuple("MachineRefresh", ["machine_idx", "info"])
+
+
+def query_machine(machine_config, timeout, probe="proc"):
+    get_command, parse_output = PROBES[probe]
+    try:
+        result = subprocess.run(
+            machine_command(machine_config, get_command()),
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout
+        )
+        if result.returncode != 0:
+            return None
+        return parse_output(result.stdout.decode("utf-8"))
+    except (subprocess.TimeoutExpired, ValueError, IndexError, RuntimeError):
+        return None
+
+
+class ResourceRefresher:
+    '''
+    Re-queries every machine's free resources in a background thread every
+    interval seconds, putting a MachineRefresh per machine on events (a CompletionQueue),
+    so the scheduler applies them between placements.
+    '''
+    def __init__(self, machine_configs, interval, events, timeout=30, probe="proc"):
+        self.machine_configs = machine_configs
+        self.interval = interval
+        self.events = events
+        self.timeout = timeout
+        self.probe = probe
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh_machine(self, machine_idx):
+        info = query_machine(self.machine_configs[machine_idx], self.timeout, self.probe)
+        if not self.stopped.is_set():
+            self.events.put(MachineRefresh(machine_idx, info))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            threads = [threading.Thread(target=self.refresh_machine, args=(i,)) for i in range(len(self.machine_configs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+
+class AgentRefresher:
+    '''
+    Like ResourceRefresher, but keeps metrics_agent.py running on each machine over
+    one ssh session, which streams a snapshot every interval seconds instead of
+    the scheduler starting a new probe each time. Reconnects after a disconnect.
+    '''
+    def __init__(self, machine_configs, interval, events):
+        self.machine_configs = machine_configs
+        self.interval = interval
+        self.events = events
+        self.stopped = threading.Event()
+        self.procs = {}
+        self.threads = [threading.Thread(target=self.follow, args=(i,), daemon=True) for i in range(len(machine_configs))]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for proc in list(self.procs.values()):
+            # closing stdin tells the agent to exit
+            proc.stdin.close()
+
+    def follow(self, machine_idx):
+        machine_config = self.machine_configs[machine_idx]
+        agent_command = remote_python_command(machine_config, remote_script("metrics_agent.py"), str(self.interval))
+        while not self.stopped.is_set():
+            proc = subprocess.Popen(
+                machine_command(machine_config, agent_command),
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            self.procs[machine_idx] = proc
+            for line in proc.stdout:
+                if self.stopped.is_set():
+                    break
+                try:
+                    self.events.put(MachineRefresh(machine_idx, json.loads(line)))
+                except ValueError:
+                    continue
+            proc.wait()
+            if not self.stopped.is_set():
+                self.events.put(MachineRefresh(machine_idx, None))
+                self.stopped.wait(self.interval)
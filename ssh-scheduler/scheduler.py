@@ -0,0 +1,450 @@
+'''
+The scheduling loop of a batch, split in three parts that share the state of the batch:
+Placement reserves slots on the machines, Launcher starts packs of jobs in them and
+keeps track of what is running, and CompletionHandler settles each job as it exits,
+releasing its slot, retrying it or reporting it. schedule runs the loop over them.
+'''
+import os
+import time
+import heapq
+import threading
+import subprocess
+from collections import namedtuple
+from .machine_cost_model import machine_cost, is_over_limit, get_best_gpu, ResourceLedger, MachineIndex
+from .dispatch import CompletionQueue, is_connection_failure, connect_latency
+from .resource_refresh import MachineRefresh
+from .job_trace import SCHEDULER
+from .job_log import log_files, rename_log
+from .job_history import observed_usage
+
+COPY = "copy"
+COPY_SUFFIX = ".copy"
+
+# a launched job, job being the (line_num, job_name, command) it was scheduled as, queued_at when it was last queued
+RunningJob = namedtuple("RunningJob", ["line_num", "job_name", "command", "machine_idx", "gpu_idx", "proc", "launched_at", "pack_id", "job", "queued_at"])
+
+
+def remove_results(job_name):
+    logs = log_files(f"./job_results/{job_name}.out") + log_files(f"./job_results/{job_name}.err")
+    subprocess.run(["rm", "-rf", f"./job_results/{job_name}", *logs])
+
+
+def settle_results(job_name, kept_name, discarded, previous=None):
+    '''
+    once the discarded (name, process) copies of a job have ended, removes their results,
+    then moves the results of the kept copy, if any, to where job_name's go.
+    previous is the thread that settled the job's results before, to wait for.
+    '''
+    if previous is not None:
+        previous.join()
+    for name, proc in discarded:
+        proc.wait()
+        remove_results(name)
+    if kept_name is not None and kept_name != job_name:
+        if os.path.exists(f"./job_results/{kept_name}"):
+            os.rename(f"./job_results/{kept_name}", f"./job_results/{job_name}")
+        for suffix in (".out", ".err"):
+            rename_log(f"./job_results/{kept_name}{suffix}", f"./job_results/{job_name}{suffix}")
+
+
+class Placement:
+    '''
+    Reserves a slot for each pack on the cheapest machine it fits on, counting where its
+    copy-forwards already are when given a locality.Locality. job_config(command), if given,
+    returns the resources to reserve for a job instead of machine_config.
+    '''
+    def __init__(self, machine_infos, machine_config, job_config=None, locality=None):
+        self.machine_infos = machine_infos
+        self.machine_config = machine_config
+        self.job_config = job_config
+        self.locality = locality
+        self.index = MachineIndex(machine_infos, machine_config)
+        self.ledger = ResourceLedger(machine_infos, on_change=self.index.update)
+
+    def config_for(self, command):
+        return self.job_config(command) if self.job_config is not None else self.machine_config
+
+    def inputs_of(self, command):
+        return self.locality.inputs(command) if self.locality is not None else None
+
+    def place(self, pack_id, config, inputs=None):
+        '''
+        reserves a slot for the pack on the best machine, counting where its inputs, from
+        inputs_of, already are. returns (machine_idx, gpu_idx), None if it does not fit
+        '''
+        preference = self.locality.preference(inputs) if self.locality is not None else ()
+        if config is self.machine_config:
+            machine_idx = self.index.best(*preference)
+        else:
+            machine_idx = self.index.best_fit(config, *preference)
+        gpu_idx = get_best_gpu(config, self.machine_infos[machine_idx])
+        self.ledger.allocate(pack_id, machine_idx, gpu_idx, config)
+        if not is_over_limit(machine_cost(config, self.machine_infos[machine_idx], gpu_idx)):
+            return machine_idx, gpu_idx
+        self.ledger.release(pack_id)
+        return None
+
+    def placed(self, machine_idx, commands):
+        '''tells the locality which copy-forwards the started commands sent, a pack sends each set once'''
+        if self.locality is not None:
+            for inputs in dict.fromkeys(self.inputs_of(command) for command in commands):
+                self.locality.placed(machine_idx, inputs)
+
+    def pinning(self, pack_id):
+        cpus = self.ledger.reservations[pack_id].cpus
+        return {"cpus": cpus} if cpus is not None else {}
+
+    def release(self, pack_id):
+        self.ledger.release(pack_id)
+
+    def quarantine(self, machine_idx, quarantined=True):
+        self.ledger.quarantine(machine_idx, quarantined)
+
+    def refresh(self, event):
+        '''applies a MachineRefresh, draining the machine if it could not be reached'''
+        if event.info is None:
+            if not self.machine_infos[event.machine_idx].get('drained'):
+                print(f"WARNING: could not refresh machine {event.machine_idx}, no jobs will be placed on it until it responds", flush=True)
+            self.ledger.drain(event.machine_idx)
+        else:
+            self.ledger.refresh(event.machine_idx, event.info)
+
+
+class Launcher:
+    '''
+    Starts packs in the slots Placement reserved for them, and keeps track of the running jobs
+    by token: the line_num of a job, or (COPY, line_num) for the straggler copy of a job.
+    launch, launch_pack, report, limiter, trace, packer and journal are as for schedule.
+    '''
+    def __init__(self, placement, launch, report, limiter, completions, clock, trace=None, packer=None, launch_pack=None, journal=None):
+        self.placement = placement
+        self.launch = launch
+        self.report = report
+        self.limiter = limiter
+        self.completions = completions
+        self.clock = clock
+        self.trace = trace
+        self.packer = packer
+        self.launch_pack = launch_pack
+        self.journal = journal
+        self.running = {}
+        # pack_id -> [jobs still running, launch time, jobs in the pack]
+        self.packs_running = {}
+        # line_num -> when the job was queued, taken from the batch or due for a retry
+        self.queued_at = {}
+        # line_nums of jobs a straggler copy was started for
+        self.copied = set()
+
+    def queued(self, pack):
+        for line_num, job_name, command in pack:
+            self.queued_at.setdefault(line_num, self.clock())
+            if self.journal is not None:
+                self.journal.queued(line_num, job_name, command)
+
+    def start(self, pack_id, pack, machine_idx, gpu_idx, place_start):
+        self.limiter.wait(machine_idx)
+        launched_at = self.clock()
+        if self.trace is not None:
+            self.trace.record(SCHEDULER, None, "place", place_start, self.trace.since_start(launched_at))
+        pinning = self.placement.pinning(pack_id)
+        if self.packer is None or pack_id != pack[0][0]:
+            line_num, job_name, command = pack[0]
+            launched_jobs = [self.launch(line_num, job_name, command, machine_idx, gpu_idx, **pinning)]
+        else:
+            launched_jobs = self.launch_pack(pack, machine_idx, gpu_idx, **pinning)
+        if self.trace is not None:
+            self.trace.record(SCHEDULER, None, "launch", self.trace.since_start(launched_at), self.trace.now())
+        self.placement.placed(machine_idx, [command for _, _, command in pack])
+        self.packs_running[pack_id] = [len(pack), launched_at, len(pack)]
+        for job, (proc, job_name) in zip(pack, launched_jobs):
+            line_num, _, command = job
+            self.running[line_num] = RunningJob(line_num, job_name, command, machine_idx, gpu_idx, proc, launched_at, pack_id, job, self.queued_at.pop(line_num, launched_at))
+            self.report("started", line_num, job_name, command)
+            if self.journal is not None:
+                self.journal.started(line_num, job[1], machine_idx, gpu_idx, pack[0][1] if len(pack) > 1 else None, run=job_name if job_name != job[1] else None)
+            self.completions.watch(proc, line_num)
+
+    def start_copy(self, job, machine_idx, gpu_idx):
+        '''starts a second copy of a straggling job, as job_name+COPY_SUFFIX, in the slot placed for (COPY, line_num)'''
+        token = (COPY, job.line_num)
+        self.copied.add(job.line_num)
+        self.limiter.wait(machine_idx)
+        launched_at = self.clock()
+        remove_results(job.job_name + COPY_SUFFIX)
+        proc, copy_name = self.launch(job.line_num, job.job_name + COPY_SUFFIX, job.command, machine_idx, gpu_idx, **self.placement.pinning(token))
+        self.placement.placed(machine_idx, [job.command])
+        self.packs_running[token] = [1, launched_at, 1]
+        self.running[token] = RunningJob(job.line_num, copy_name, job.command, machine_idx, gpu_idx, proc, launched_at, token, job.job, launched_at)
+        self.report("speculating", job.line_num, copy_name, job.command)
+        if self.journal is not None:
+            self.journal.speculating(job.line_num, job.job[1], copy_name, machine_idx)
+        self.completions.watch(proc, token)
+
+    def speculate(self, speculator):
+        '''starts a copy of each straggler there is room for, on another slot'''
+        candidates = [
+            job for key, job in self.running.items()
+            if not isinstance(key, tuple) and key not in self.copied and job.pack_id == key and self.packs_running[key][2] == 1
+        ]
+        for job in speculator.stragglers(candidates, self.clock()):
+            placement = self.placement.place((COPY, job.line_num), self.placement.config_for(job.command), self.placement.inputs_of(job.command))
+            if placement is None:
+                return
+            self.start_copy(job, *placement)
+
+    def backfill(self, order):
+        '''
+        starts jobs from the order's window that fit now and are expected to finish before any
+        running job does, so they cannot delay the job waiting for a slot. returns whether any started.
+        '''
+        remaining = [job.launched_at + order.history.seconds(job.command) - self.clock() for job in self.running.values() if order.history.seconds(job.command) is not None]
+        if not remaining:
+            return False
+        started = False
+        for job in order.candidates(min(remaining)):
+            placement = self.placement.place(job[0], self.placement.config_for(job[2]), self.placement.inputs_of(job[2]))
+            if placement is not None:
+                order.take(job)
+                self.queued_at[job[0]] = self.clock()
+                if self.journal is not None:
+                    self.journal.queued(*job)
+                self.start(job[0], [job], *placement, self.trace.now() if self.trace is not None else None)
+                started = True
+        return started
+
+    def release_slot(self, job):
+        '''releases the slot of the job's pack once its last job is done, telling the packer how long it took'''
+        pack_state = self.packs_running[job.pack_id]
+        pack_state[0] -= 1
+        if pack_state[0] == 0:
+            del self.packs_running[job.pack_id]
+            self.placement.release(job.pack_id)
+            if self.packer is not None:
+                self.packer.observe(self.clock() - pack_state[1], pack_state[2])
+
+    def stop(self):
+        '''stops the jobs still running, their teardowns kill them'''
+        for job in self.running.values():
+            if hasattr(job.proc, "close"):
+                job.proc.close()
+
+
+class CompletionHandler:
+    '''
+    Settles the jobs Launcher started as the completion queue hands back their tokens:
+    releases their slots, retries those whose connection failed, keeps the first copy of a
+    straggler to finish, and reports, journals, traces and records the history of the rest.
+    Also applies the machine refreshes coming through the same queue.
+    report, limiter, trace, journal, retry_policy, history and speculator are as for schedule.
+    '''
+    def __init__(self, placement, launcher, report, limiter, clock, trace=None, journal=None, retry_policy=None, history=None, speculator=None):
+        self.placement = placement
+        self.launcher = launcher
+        self.report = report
+        self.limiter = limiter
+        self.clock = clock
+        self.trace = trace
+        self.journal = journal
+        self.retry_policy = retry_policy
+        self.history = history
+        self.speculator = speculator
+        # (when to retry, line_num, job) of jobs whose connection failed
+        self.retries = []
+        # line_num -> the thread settling the results of a job with a straggler copy
+        self.settling = {}
+
+    def release_quarantines(self):
+        if self.retry_policy is not None:
+            for machine_idx in self.retry_policy.released(self.clock()):
+                print(f"WARNING: retrying machine {machine_idx} after its quarantine", flush=True)
+                self.placement.quarantine(machine_idx, False)
+
+    def quarantined(self):
+        '''whether a machine is quarantined, so jobs that fit nowhere now may fit once it is back'''
+        return self.retry_policy is not None and self.retry_policy.next_release() is not None
+
+    def next_wakeup(self):
+        '''seconds until a retry or the end of a quarantine is due, None to wait for a job'''
+        times = [self.retries[0][0]] if self.retries else []
+        if self.quarantined():
+            times.append(self.retry_policy.next_release())
+        return max(0.0, min(times) - self.clock()) if times else None
+
+    def due_retry(self):
+        '''the job of a retry that is due, None if there is none'''
+        if self.retries and self.retries[0][0] <= self.clock():
+            return heapq.heappop(self.retries)[2]
+        return None
+
+    def retry(self, job, machine_idx):
+        if self.retry_policy.machine_failed(machine_idx, self.clock()):
+            print(f"WARNING: quarantining machine {machine_idx} after {self.retry_policy.quarantine_after} connection failures in a row", flush=True)
+            self.placement.quarantine(machine_idx)
+        delay = self.retry_policy.job_failed(job[0])
+        if delay is None:
+            return False
+        heapq.heappush(self.retries, (self.clock() + delay, job[0], job))
+        self.launcher.queued_at[job[0]] = self.clock()
+        return True
+
+    def settle(self, job, kept, discarded):
+        '''in the background, after the earlier settling of the same line, see settle_results'''
+        line_num, job_name, _ = job
+        thread = threading.Thread(
+            target=settle_results,
+            args=(job_name, kept.job_name if kept is not None else None, [(d.job_name, d.proc) for d in discarded], self.settling.get(line_num)),
+        )
+        self.settling[line_num] = thread
+        thread.start()
+
+    def finish_copies(self, token, job, message):
+        '''
+        settles a job that had a straggler copy started, returns whether the line is done:
+        the first copy to finish keeps its results and the other is killed by its cleanup,
+        a failed copy is dropped while the other may still finish.
+        '''
+        running = self.launcher.running
+        twin_token = token[1] if isinstance(token, tuple) else (COPY, token)
+        twin = running.get(twin_token)
+        if twin is None:
+            self.settle(job.job, job, [])
+            return True
+        if message != "finished":
+            self.report("dropped", job.line_num, job.job_name, job.command)
+            self.settle(job.job, None, [job])
+            return False
+        del running[twin_token]
+        self.launcher.release_slot(twin)
+        twin.proc.close()
+        self.report("dropped", twin.line_num, twin.job_name, twin.command)
+        self.settle(job.job, job, [twin])
+        return True
+
+    def handle(self, tokens):
+        for token in tokens:
+            if isinstance(token, MachineRefresh):
+                self.placement.refresh(token)
+                continue
+            job = self.launcher.running.pop(token, None)
+            if job is None:
+                # the losing copy of a straggler, already settled
+                continue
+            self.finish(token, job)
+
+    def finish(self, token, job):
+        proc = job.proc
+        message = "finished" if proc is None or proc.returncode == 0 else "failed"
+        self.launcher.release_slot(job)
+        connection_failed = proc is not None and message == "failed" and is_connection_failure(proc)
+        if proc is not None:
+            self.limiter.observe(job.machine_idx, connection_failed, connect_latency(proc, job.launched_at))
+            if self.retry_policy is not None and not connection_failed:
+                self.retry_policy.machine_ok(job.machine_idx)
+        if job.line_num in self.launcher.copied:
+            if not self.finish_copies(token, job, message):
+                return
+        elif self.retry_policy is not None and connection_failed and self.retry(job.job, job.machine_idx):
+            message = "retrying"
+        if message == "finished" and proc is not None:
+            if self.history is not None:
+                self.history.record(job.command, *observed_usage(proc, self.clock() - job.launched_at))
+            if self.speculator is not None:
+                self.speculator.observe(self.clock() - job.launched_at)
+        self.report(message, job.line_num, job.job[1], job.command)
+        if self.journal is not None:
+            self.journal.record(message, job.line_num, job.job[1])
+        if self.trace is not None and proc is not None:
+            self.trace.record_job(job.job_name, job.machine_idx, self.trace.since_start(job.queued_at), self.trace.since_start(job.launched_at), self.trace.now(), proc)
+            self.trace.record_cleanup(job.job_name, job.machine_idx, proc)
+
+    def join(self):
+        for thread in self.settling.values():
+            thread.join()
+
+
+def schedule(jobs, machine_infos, machine_config, launch, report, limiter, completions=None, refreshing=False, trace=None, packer=None, launch_pack=None, journal=None, retry_policy=None, history=None, order=None, job_config=None, clock=time.monotonic, speculator=None, locality=None):
+    '''
+    places each (line_num, job_name, command) in jobs on the cheapest machine, as soon
+    as a running job exits and frees enough capacity for it.
+    launch(line_num, job_name, command, machine_idx, gpu_idx) starts the job, returning
+    its process (None for dry runs) and its final job name. When machine_config has pin_cpus,
+    launch and launch_pack are also passed the cpus=[...] the job is pinned to.
+    report(message, line_num, job_name, command) prints job progress.
+    limiter paces launches to each machine, and is told how each launch went.
+    completions may be shared with a ResourceRefresher, whose MachineRefresh events
+    update machine states; refreshing says to wait for those when nothing fits.
+    trace, a JobTrace, records the phases of every job and of the scheduler itself.
+    packer, a dispatch.Packer, groups consecutive jobs into packs placed in a single slot and
+    started together by launch_pack(pack, machine_idx, gpu_idx), which returns a (process, job_name)
+    per job of the pack.
+    journal, a BatchJournal, records when each job is queued, started and finished.
+    retry_policy, a dispatch.RetryPolicy, retries jobs whose ssh connection failed and
+    quarantines machines that keep failing, instead of reporting those jobs as failed.
+    history, a JobHistory, records the duration and peak resources of every job that finished.
+    order, a LongestFirst the jobs were ordered by, lets the scheduler backfill short jobs from its window.
+    job_config(command), if given, returns the resources to reserve for a job instead of machine_config.
+    clock is what the scheduler measures time with, a simulation can pass its own.
+    speculator, a dispatch.Speculator, picks stragglers to start a second copy of once there
+    are no more jobs to start. The copy runs as job_name+COPY_SUFFIX, and whichever copy
+    finishes first has its results kept under job_name.
+    locality, a locality.Locality, places jobs where their copy-forwards already are when loads are close.
+    '''
+    completions = completions if completions is not None else CompletionQueue()
+    placement = Placement(machine_infos, machine_config, job_config, locality)
+    launcher = Launcher(placement, launch, report, limiter, completions, clock, trace, packer, launch_pack, journal)
+    handler = CompletionHandler(placement, launcher, report, limiter, clock, trace, journal, retry_policy, history, speculator)
+    packs = iter(packer.packs(jobs) if packer is not None else ([job] for job in jobs))
+
+    def next_pack():
+        '''
+        (pack_id, pack) for a retry that is due, else for the next pack of jobs, (None, None) if
+        neither is ready yet. A retry gets its own pack_id, the rest of its pack may still be running.
+        '''
+        job = handler.due_retry()
+        if job is not None:
+            return ("retry", job[0]), [job]
+        pack = next(packs, None)
+        return (pack[0][0] if pack is not None else None), pack
+
+    def idle_wait():
+        '''waits for jobs to finish when there is nothing to start, checking for stragglers now and then'''
+        timeout = handler.next_wakeup()
+        if speculator is not None and launcher.running:
+            launcher.speculate(speculator)
+            timeout = speculator.interval if timeout is None else min(timeout, speculator.interval)
+        handler.handle(completions.get(timeout=timeout))
+
+    try:
+        while True:
+            handler.release_quarantines()
+            pack_id, pack = next_pack()
+            if pack is None:
+                if not launcher.running and not handler.retries:
+                    break
+                idle_wait()
+                continue
+            launcher.queued(pack)
+            # a pack shares one slot sized for a single job of the batch
+            config = placement.config_for(pack[0][2]) if len(pack) == 1 else machine_config
+            inputs = placement.inputs_of(pack[0][2])
+            place_start = trace.now() if trace is not None else None
+            while True:
+                slot = placement.place(pack_id, config, inputs)
+                if slot is not None:
+                    break
+                if order is not None and order.backfill and packer is None and launcher.backfill(order):
+                    continue
+                # wait for a running job to free capacity
+                if not launcher.running and not refreshing and not handler.quarantined():
+                    raise RuntimeError(f"job '{pack[0][1]}' does not fit on any machine even when nothing else is running")
+                if trace is not None:
+                    trace.record(SCHEDULER, None, "place", place_start, trace.now())
+                handler.handle(completions.get(timeout=handler.next_wakeup()))
+                handler.release_quarantines()
+                place_start = trace.now() if trace is not None else None
+            launcher.start(pack_id, pack, *slot, place_start)
+    except BaseException:
+        # interrupted or failed: stop the jobs still running, their teardowns kill them
+        launcher.stop()
+        raise
+    handler.join()
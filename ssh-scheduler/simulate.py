@@ -0,0 +1,139 @@
+'''
+Replays a batch recorded in its journal against the cost model, without touching
+any machine, to compare job orderings offline. Each job takes as long as it took
+in the recorded run, on the machine states recorded when that run started:
+
+    python -m ssh_scheduler.simulate job_results/batch.sh.journal --policies file longest-first backfill
+
+Jobs are estimated from the durations of the recorded run itself, or from a
+job history with --history, which is what a real run would know.
+'''
+import sys
+import copy
+import json
+import heapq
+import argparse
+from types import SimpleNamespace
+from .scheduler import schedule
+from .dispatch import LaunchRateLimiter
+from .job_history import JobHistory, LongestFirst
+
+POLICIES = ["file", "longest-first", "backfill"]
+
+
+def replay_jobs(path):
+    '''
+    returns the journal's last batch event, the (line_num, job_name, command) of every job that
+    ran to the end, and line_num -> seconds its last attempt ran for
+    '''
+    batch = None
+    commands = {}
+    starts = {}
+    durations = {}
+    with open(path) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            event = entry["event"]
+            if event == "batch":
+                batch = entry
+            elif event == "queued":
+                commands[entry["line"]] = (entry["job"], entry["command"])
+            elif event == "started":
+                starts[entry["line"]] = entry["time"]
+            elif event in ("finished", "failed") and entry["line"] in starts:
+                durations[entry["line"]] = entry["time"] - starts[entry["line"]]
+    jobs = [(line_num, *commands[line_num]) for line_num in sorted(durations) if line_num in commands]
+    return batch, jobs, durations
+
+
+class SimulatedProc:
+    returncode = 0
+
+    def wait(self):
+        return 0
+
+
+class SimulatedCompletions:
+    '''a CompletionQueue on a simulated clock, where every job takes its recorded duration'''
+    def __init__(self, durations):
+        self.durations = durations
+        self.now = 0.0
+        self.events = []
+        self.count = 0
+
+    def push(self, at, token):
+        self.count += 1
+        heapq.heappush(self.events, (at, self.count, token))
+
+    def watch(self, proc, token):
+        self.push(self.now + self.durations[token], token)
+
+    def put(self, token):
+        self.push(self.now, token)
+
+    def get(self, timeout=None):
+        if not self.events:
+            self.now += timeout or 0.0
+            return []
+        self.now = max(self.now, self.events[0][0])
+        tokens = []
+        while self.events and self.events[0][0] <= self.now:
+            tokens.append(heapq.heappop(self.events)[2])
+        return tokens
+
+    def clock(self):
+        return self.now
+
+
+def simulate(jobs, durations, machine_infos, machine_config, policy, history, lookahead=1000, sized=False):
+    '''returns the simulated makespan in seconds of running jobs with the policy'''
+    completions = SimulatedCompletions(durations)
+    order = None
+    if policy != "file":
+        order = LongestFirst(history, lookahead, backfill=policy == "backfill")
+        jobs = order.jobs(jobs)
+    job_config = (lambda command: history.sized_config(machine_config, command)) if sized else None
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx, cpus=None):
+        return SimulatedProc(), job_name
+
+    schedule(
+        jobs, copy.deepcopy(machine_infos), machine_config, launch, lambda *args: None, LaunchRateLimiter(None), completions,
+        order=order, job_config=job_config, clock=completions.clock
+    )
+    return completions.now
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compare job orderings on a batch recorded by execute_batch, without running anything')
+    parser.add_argument('journal', help='the journal of the recorded batch')
+    parser.add_argument('--policies', nargs='*', choices=POLICIES, default=POLICIES, help='orderings to simulate')
+    parser.add_argument('--history', help='estimate jobs from this job history file instead of from the recorded durations')
+    parser.add_argument('--lookahead', type=int, default=1000, help='how many upcoming lines are reordered among')
+    parser.add_argument('--size-from-history', action="store_true", help='reserve resources for each job from its peaks in the history')
+    args = parser.parse_args(argv)
+
+    batch, jobs, durations = replay_jobs(args.journal)
+    if batch is None:
+        sys.exit(f"{args.journal} has no recorded machine states, it was written by an older execute_batch")
+    if args.history:
+        history = JobHistory(args.history)
+    else:
+        # the recorded durations of each exact command
+        history = JobHistory(template=str)
+        for line_num, job_name, command in jobs:
+            history.record(command, durations[line_num])
+    machine_config = SimpleNamespace(**batch["resources"])
+    print(f"{len(jobs)} jobs on {len(batch['machines'])} machines")
+    baseline = None
+    for policy in args.policies:
+        makespan = simulate(jobs, durations, batch["infos"], machine_config, policy, history, args.lookahead, args.size_from_history)
+        baseline = makespan if baseline is None else baseline
+        print(f"{policy:>14}: {makespan:10.1f}s  ({makespan / max(baseline, 1e-9):.2f}x of {args.policies[0]})")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,267 @@
+'''
+Splits the framed output of remote_framer.py back into the job's stdout, its
+stderr, and its results archive, which is unpacked straight from the stream.
+'''
+import io
+import os
+import sys
+import time
+import queue
+import struct
+import tarfile
+import subprocess
+import threading
+from .remote_framer import STDOUT, STDERR, EXIT, RESULTS, END, STARTED, PACKED, PACK_HEADER, read_frame, write_frame
+
+# magic number -> command decompressing archives tarfile cannot read by itself
+DECOMPRESSORS = {
+    b"\x28\xb5\x2f\xfd": ["zstd", "-q", "-d", "-c"],
+    b"\x04\x22\x4d\x18": ["lz4", "-q", "-d", "-c"],
+}
+
+
+def binary_stream(fileobj, default):
+    if fileobj is None:
+        return default
+    return getattr(fileobj, "buffer", fileobj)
+
+
+class ResultsReader:
+    '''file-like view of the RESULTS frames, for tarfile's streaming mode'''
+    def __init__(self, demux, first_payload):
+        self.demux = demux
+        self.buffer = first_payload
+        self.offset = 0
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) - self.offset < size):
+            payload = self.demux.next_results_payload()
+            if payload is None:
+                self.done = True
+            else:
+                self.buffer = self.buffer[self.offset:] + payload
+                self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def peek(self, size):
+        data = self.read(size)
+        self.offset -= len(data)
+        return data
+
+    def drain(self):
+        while self.read(2**16):
+            pass
+
+
+def inside(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def results_member(member, folder):
+    '''
+    member of a results archive made by the remote job, checked as tar x would check it:
+    nothing may land or link outside folder. Like tar xm, the time it was extracted at is kept.
+    '''
+    if hasattr(tarfile, "data_filter"):
+        member = tarfile.data_filter(member, folder)
+    else:
+        # as tar does, absolute names are taken to be under folder
+        member.name = member.name.lstrip("/")
+        root = os.path.realpath(folder)
+        target = os.path.realpath(os.path.join(root, member.name))
+        if not inside(target, root):
+            raise tarfile.TarError(f"{member.name} is outside the results folder")
+        if member.issym() or member.islnk():
+            base = os.path.dirname(target) if member.issym() else root
+            if os.path.isabs(member.linkname) or not inside(os.path.realpath(os.path.join(base, member.linkname)), root):
+                raise tarfile.TarError(f"{member.name} links outside the results folder")
+        if member.isdev():
+            raise tarfile.TarError(f"{member.name} is a special file")
+        member.mode &= 0o777
+    member.mtime = time.time()
+    return member
+
+
+# members are checked by results_member, so tarfile does not need to filter them again
+EXTRACT_OPTIONS = {"filter": "fully_trusted"} if hasattr(tarfile, "data_filter") else {}
+
+
+def feed_decompressor(reader, stdin):
+    '''writes everything reader has into stdin, reading the rest even if the decompressor died'''
+    try:
+        chunk = reader.read(2**16)
+        while chunk:
+            stdin.write(chunk)
+            chunk = reader.read(2**16)
+        stdin.close()
+    except BrokenPipeError:
+        pass
+    reader.drain()
+
+
+class StreamDemux:
+    '''
+    stdout and stderr are the files job output goes to (None for this process's own),
+    results_folder is where the results archive is unpacked (None to discard it).
+    times holds when the STARTED, EXIT and END frames arrived (time.monotonic()),
+    remote_setup the seconds the worker spent setting up the job folder, if it measured them,
+    peak_memory (MB) and cpu_seconds the resources the job used, if the worker measured them.
+    '''
+    def __init__(self, stdout=None, stderr=None, results_folder=None):
+        self.stdout = binary_stream(stdout, sys.stdout.buffer)
+        self.stderr = binary_stream(stderr, sys.stderr.buffer)
+        self.results_folder = results_folder
+        self.stream = None
+        self.returncode = None
+        self.ended = False
+        self.times = {}
+        self.remote_setup = None
+        self.peak_memory = None
+        self.cpu_seconds = None
+
+    def write(self, fileobj, payload):
+        fileobj.write(payload)
+        if not getattr(fileobj, "buffered", False):
+            fileobj.flush()
+
+    def handle(self, channel, payload):
+        '''handles a non results frame'''
+        if channel in (STARTED, EXIT, END, None):
+            self.times.setdefault(END if channel is None else channel, time.monotonic())
+        if channel == STDOUT:
+            self.write(self.stdout, payload)
+        elif channel == STDERR:
+            self.write(self.stderr, payload)
+        elif channel == EXIT:
+            self.returncode = struct.unpack(">i", payload[:4])[0]
+            if len(payload) >= 20:
+                self.peak_memory, self.cpu_seconds = struct.unpack(">dd", payload[4:20])
+        elif channel == STARTED:
+            remote_setup = struct.unpack(">d", payload)[0]
+            self.remote_setup = remote_setup if remote_setup >= 0 else None
+        elif channel in (END, None):
+            self.ended = True
+
+    def next_results_payload(self):
+        while not self.ended:
+            channel, payload = read_frame(self.stream)
+            if channel == RESULTS:
+                return payload
+            self.handle(channel, payload)
+        return None
+
+    def unpack_results(self, first_payload):
+        reader = ResultsReader(self, first_payload)
+        if self.results_folder is None:
+            reader.drain()
+            return
+        os.makedirs(self.results_folder, exist_ok=True)
+        command = DECOMPRESSORS.get(reader.peek(4))
+        if command is None:
+            # gzipped or plain, which tarfile reads itself
+            self.extract(reader)
+            # the rest is tar's zero padding
+            reader.drain()
+            return
+        try:
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as err:
+            self.write(self.stderr, f"could not unpack results: {err}\n".encode("utf-8"))
+            reader.drain()
+            return
+        feeder = threading.Thread(target=feed_decompressor, args=(reader, proc.stdin))
+        feeder.start()
+        self.extract(proc.stdout)
+        while proc.stdout.read(2**16):
+            pass
+        feeder.join()
+        if proc.wait() != 0:
+            self.write(self.stderr, f"could not unpack results: {command[0]} exited with {proc.returncode}\n".encode("utf-8"))
+
+    def extract(self, fileobj):
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+                for member in tar:
+                    tar.extract(results_member(member, self.results_folder), self.results_folder, **EXTRACT_OPTIONS)
+        except tarfile.TarError as err:
+            self.write(self.stderr, f"could not unpack results: {err}\n".encode("utf-8"))
+
+    def run(self, stream):
+        '''reads frames from stream until the remote side ends or disconnects'''
+        self.stream = stream
+        while not self.ended:
+            channel, payload = read_frame(stream)
+            if channel == RESULTS:
+                self.unpack_results(payload)
+            else:
+                self.handle(channel, payload)
+        # buffered outputs, like job_log.LogSinks, are complete once the job is seen to end
+        self.stdout.flush()
+        self.stderr.flush()
+
+
+class JobStream:
+    '''file-like stream of frames put on it from another thread, for a StreamDemux to read'''
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.buffer = b""
+        self.ended = False
+
+    def put(self, channel, payload):
+        frame = io.BytesIO()
+        write_frame(frame, channel, payload)
+        self.chunks.put(frame.getvalue())
+
+    def end(self):
+        self.chunks.put(None)
+
+    def read(self, size):
+        while len(self.buffer) < size and not self.ended:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.ended = True
+            else:
+                self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class PackDemux:
+    '''
+    splits the output of a pack (remote_framer.py --pack) between the StreamDemux of each of
+    its jobs, each run in its own reader thread. returncode is 0 once the pack ended with
+    every script exited, None if it did not.
+    '''
+    def __init__(self, demuxes):
+        self.streams = [JobStream() for _ in demuxes]
+        self.readers = [threading.Thread(target=demux.run, args=(stream,), daemon=True) for demux, stream in zip(demuxes, self.streams)]
+        for reader in self.readers:
+            reader.start()
+        self.returncode = None
+
+    def run(self, stream):
+        '''reads frames from stream until the remote side ends or disconnects'''
+        while True:
+            channel, payload = read_frame(stream)
+            if channel == PACKED:
+                index, job_channel = PACK_HEADER.unpack(payload[:PACK_HEADER.size])
+                self.streams[index].put(job_channel, payload[PACK_HEADER.size:])
+                if job_channel == END:
+                    self.streams[index].end()
+            elif channel == STARTED:
+                # the setup is shared by every job of the pack
+                for job_stream in self.streams:
+                    job_stream.put(channel, payload)
+            elif channel == END:
+                # every script of the pack exited
+                self.returncode = 0
+                break
+            elif channel is None:
+                break
+        for job_stream in self.streams:
+            job_stream.end()
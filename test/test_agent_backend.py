@@ -0,0 +1,122 @@
+import io
+import os
+import time
+from ssh_scheduler.agent_backend import RemoteAgent, run_on_agent, agent_python_command
+from ssh_scheduler.remote_agent import AgentJob, MessageWriter
+from ssh_scheduler.stream_demux import StreamDemux
+
+data_path = os.path.join(os.path.dirname(__file__), "data", "sed_data.txt")
+
+
+def local_agent(tmp_path):
+    os.makedirs(tmp_path / "worker")
+    return RemoteAgent(f"cd {tmp_path / 'worker'} && " + agent_python_command({}))
+
+
+def run_job(agent, job_name, command, copy_forwards=(), copy_backwards=(), machine_config=None):
+    stdout = open(f"job_results/{job_name}.out", 'wb')
+    stderr = open(f"job_results/{job_name}.err", 'wb')
+    return run_on_agent(agent, list(copy_forwards), list(copy_backwards), machine_config or {}, job_name, command, stdout=stdout, stderr=stderr)
+
+
+def test_many_jobs_on_one_agent(tmp_path, monkeypatch):
+    agent = local_agent(tmp_path)
+    os.makedirs(tmp_path / "local" / "job_results")
+    monkeypatch.chdir(tmp_path / "local")
+    with open("input.txt", 'w') as file:
+        file.write("forwarded\n")
+    procs = [
+        run_job(agent, f"job{i}", f"cat input.txt && echo {i} > out.txt && exit {i}", ["input.txt"], ["out.txt"])
+        for i in range(4)
+    ]
+    assert [proc.wait() for proc in procs] == list(range(4))
+    for i in range(4):
+        assert open(f"job_results/job{i}.out").read() == "forwarded\n"
+        assert open(f"job_results/job{i}/out.txt").read() == f"{i}\n"
+    # one agent process ran everything, and removed the job folders
+    assert agent.alive()
+    assert os.listdir(tmp_path / "worker" / "job_data") == []
+    agent.close()
+
+
+def test_only_changed_results(tmp_path, monkeypatch):
+    agent = local_agent(tmp_path)
+    os.makedirs(tmp_path / "local" / "job_results")
+    monkeypatch.chdir(tmp_path / "local")
+    with open("input.txt", 'w') as file:
+        file.write("forwarded\n")
+    assert run_job(agent, "delta", "echo out > out.txt", ["input.txt"], ["."]).wait() == 0
+    assert os.listdir("job_results/delta") == ["out.txt"]
+    agent.close()
+
+
+def test_binary_output(tmp_path, monkeypatch):
+    agent = local_agent(tmp_path)
+    os.makedirs(tmp_path / "local" / "job_results")
+    monkeypatch.chdir(tmp_path / "local")
+    assert run_job(agent, "binary", f"cat {data_path}").wait() == 0
+    assert open("job_results/binary.out", 'rb').read() == open(data_path, 'rb').read()
+    agent.close()
+
+
+def test_machine_compression(tmp_path, monkeypatch):
+    agent = local_agent(tmp_path)
+    os.makedirs(tmp_path / "local" / "job_results")
+    monkeypatch.chdir(tmp_path / "local")
+    with open("input.txt", 'w') as file:
+        file.write("forwarded\n" * 20000)
+    specs = []
+    submit = agent.submit
+    monkeypatch.setattr(agent, "submit", lambda spec, demux, feed: specs.append(spec) or submit(spec, demux, feed))
+    proc = run_job(agent, "gzipped", "cp input.txt out.txt", ["input.txt"], ["out.txt"], {"compression": "gzip", "compression_level": 6})
+    assert proc.wait() == 0
+    assert specs[0]["compress"] == "gzip:6"
+    assert specs[0]["unpack"].startswith("gzip -d -c | ")
+    assert open("job_results/gzipped/out.txt").read() == "forwarded\n" * 20000
+    agent.close()
+
+
+def test_slow_unpack_does_not_hold_up_other_jobs(tmp_path):
+    agent = local_agent(tmp_path)
+    data = os.urandom(2**22)
+    # the unpack of the first job reads nothing for a while, so its input fills the pipe
+    slow = {"folder": "job_data/slow", "script": "true\n", "copy_backwards": [], "unpack": "sleep 10; cat > /dev/null"}
+    fast = {"folder": "job_data/fast", "script": "echo fast\n", "copy_backwards": []}
+    out = tmp_path / "fast.out"
+    slow_job = agent.submit(slow, StreamDemux(io.BytesIO(), io.BytesIO()), lambda writer: writer.write(data))
+    time.sleep(0.5)
+    start = time.monotonic()
+    fast_job = agent.submit(fast, StreamDemux(open(out, 'wb'), io.BytesIO()), lambda writer: None)
+    assert fast_job.wait() == 0
+    # the job shell's startup takes its time too
+    assert time.monotonic() - start < 8
+    assert open(out, 'rb').read() == b"fast\n"
+    assert slow_job.wait() == 0
+    agent.close()
+
+
+def test_kill_and_disconnect(tmp_path, monkeypatch):
+    agent = local_agent(tmp_path)
+    os.makedirs(tmp_path / "local" / "job_results")
+    monkeypatch.chdir(tmp_path / "local")
+    killed = run_job(agent, "killed", "sleep 30")
+    orphaned = run_job(agent, "orphaned", "sleep 30")
+    time.sleep(1)
+    start = time.monotonic()
+    killed.kill()
+    assert killed.wait() != 0
+    agent.close()
+    assert orphaned.wait() != 0
+    assert time.monotonic() - start < 10
+    # the agent removed the orphaned job's folder before exiting
+    assert os.listdir(tmp_path / "worker" / "job_data") == []
+
+
+def test_ended_jobs_are_forgotten(tmp_path):
+    ended = []
+    spec = {"folder": str(tmp_path / "job"), "script": "true\n", "copy_backwards": []}
+    job = AgentJob(MessageWriter(io.BytesIO()), 7, spec, on_end=ended.append)
+    job.add_input(b"")
+    job.thread.join()
+    assert ended == [7]
+    assert not os.path.exists(tmp_path / "job")
@@ -0,0 +1,74 @@
+import os
+import sys
+import getpass
+import subprocess
+import pytest
+import ssh_scheduler
+from ssh_scheduler.batch_input import read_batch, expand_sweep, point_name
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+    return str(path)
+
+
+def test_lines(tmp_path):
+    path = write(tmp_path / "batch.sh", "echo one\n  echo two  \n")
+    assert list(read_batch(path)) == [(0, "1", "echo one"), (1, "2", "echo two")]
+
+
+def test_sweep(tmp_path):
+    path = write(tmp_path / "sweep.yaml", """
+command: train --lr {lr} --seed {seed} --data {data} --bs {bs} ${{HOME}}
+product:
+  lr: [0.1, 0.01]
+  seed: {start: 0, stop: 3}
+zip:
+  data: [a.csv, b.csv]
+  bs: [32, 64]
+""")
+    jobs = list(read_batch(path))
+    assert len(jobs) == 12
+    assert jobs[0] == (0, "data=a.csv.bs=32.lr=0.1.seed=0", "train --lr 0.1 --seed 0 --data a.csv --bs 32 ${HOME}")
+    assert jobs[-1][2] == "train --lr 0.01 --seed 2 --data b.csv --bs 64 ${HOME}"
+    assert len({name for _, name, _ in jobs}) == 12
+
+
+def test_sweep_axes():
+    points = list(expand_sweep({"product": {"x": {"start": 0, "stop": 1, "step": 0.25}, "y": "fixed"}}))
+    assert [p["x"] for p in points] == [0, 0.25, 0.5, 0.75]
+    assert all(p["y"] == "fixed" for p in points)
+    with pytest.raises(ValueError):
+        list(expand_sweep({"zip": {"a": [1, 2], "b": [1]}}))
+
+
+def test_point_names():
+    assert point_name({"path": "data/x y.csv"}) == "path=data_x_y.csv"
+    assert len(point_name({"long": "x" * 500})) == 16
+
+
+def dry_run(tmp_path, sweep):
+    '''(jobs finished, peak rss in bytes) of `execute_batch --dry-run` on the sweep, with a local machine'''
+    write(tmp_path / "sweep.yaml", sweep)
+    write(tmp_path / "local.yaml", f"username: {getpass.getuser()}\nip: 127.0.0.1\n")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(ssh_scheduler.__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "ssh_scheduler.batch_run", "sweep.yaml", "--dry-run", "--no-gpu-required", "--memory-required", "1", "--machines", "local.yaml"],
+        cwd=tmp_path, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    finished = sum(line.startswith(b"finished: ") for line in proc.stdout)
+    _, status, usage = os.wait4(proc.pid, 0)
+    assert status == 0
+    return finished, usage.ru_maxrss * 2**10
+
+
+def test_million_job_dry_run(tmp_path):
+    os.makedirs(tmp_path / "small")
+    os.makedirs(tmp_path / "large")
+    finished, small_rss = dry_run(tmp_path / "small", "command: echo {a} {b}\nproduct:\n  a: {stop: 10}\n  b: {stop: 100}\n")
+    assert finished == 1000
+    finished, large_rss = dry_run(tmp_path / "large", "command: echo {a} {b}\nproduct:\n  a: {stop: 1000}\n  b: {stop: 1000}\n")
+    assert finished == 10**6
+    # holding every job would take hundreds of megabytes
+    assert large_rss - small_rss < 20 * 2**20
@@ -0,0 +1,106 @@
+import os
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.batch_journal import BatchJournal, load_journal, is_done, orphaned_jobs, run_folders, reconcile_command, set_aside_results
+from ssh_scheduler.batch_run import pending_jobs
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.batch_input import read_batch
+from ssh_scheduler.dispatch import LaunchRateLimiter
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def test_load_after_crash(tmp_path):
+    path = str(tmp_path / "batch.journal")
+    journal = BatchJournal(path, ["m0", "m1"])
+    for line_num in range(3):
+        journal.queued(line_num, f"job.{line_num}", f"echo {line_num}")
+    journal.started(0, "job.0", 0, 1)
+    journal.started(1, "job.1", 1, 0, pack="job.1")
+    journal.started(2, "job.2", 1, 0, pack="job.1")
+    journal.record("finished", 0, "job.0")
+    journal.record("failed", 2, "job.2")
+    journal.close()
+    # the scheduler died halfway through writing an event
+    with open(path, 'a') as file:
+        file.write('{"event": "finis')
+
+    statuses = load_journal(path)
+    assert is_done(statuses["job.0"], "echo 0")
+    # the line changed since it ran
+    assert not is_done(statuses["job.0"], "echo changed")
+    assert not is_done(statuses["job.1"], "echo 1")
+    assert not is_done(statuses["job.2"], "echo 2")
+    assert not is_done(statuses.get("job.3"), "echo 3")
+    orphans = orphaned_jobs(statuses)
+    assert list(orphans) == ["m1"]
+    assert run_folders(orphans["m1"]) == ["job_data/job.1", "job_data/job.1.pack"]
+
+
+def test_reconcile_command(tmp_path):
+    folder = tmp_path / "job_data" / "job.1"
+    os.makedirs(folder)
+    orphan = subprocess.Popen(["sleep", "30"])
+    with open(folder / ".abc_pid.txt", 'w') as file:
+        file.write(str(orphan.pid))
+    subprocess.run(reconcile_command(["job_data/job.1", "job_data/missing"]), shell=True, cwd=tmp_path, check=True)
+    assert orphan.wait(timeout=5) != 0
+    assert not os.path.exists(folder)
+
+
+def test_set_aside_results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("job_results/job.1")
+    set_aside_results("job.1")
+    set_aside_results("job.2")
+    assert os.listdir("job_results") == ["job.1.incomplete"]
+
+
+def test_schedule_journal(tmp_path):
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 2, "gpus": []}
+    init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        return subprocess.Popen(command, shell=True), job_name
+
+    path = str(tmp_path / "batch.journal")
+    journal = BatchJournal(path, ["local"])
+    jobs = [(0, "job.0", "true"), (1, "job.1", "false")]
+    schedule(jobs, [machine_state], machine_config, launch, lambda *args: None, LaunchRateLimiter(None), journal=journal)
+    journal.close()
+    statuses = load_journal(path)
+    assert [statuses["job.0"]["event"], statuses["job.1"]["event"]] == ["finished", "failed"]
+    assert statuses["job.0"]["machine"] == "local"
+    assert is_done(statuses["job.0"], "true")
+
+
+def test_resume_extended_sweep(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("job_results")
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 2, "gpus": []}
+    init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        os.makedirs(f"job_results/{job_name}")
+        return subprocess.Popen(command, shell=True), job_name
+
+    def run_sweep(b_values, statuses=None):
+        with open("s.yaml", 'w') as file:
+            file.write(f"command: echo {{a}} {{b}}\nproduct:\n  a: [1, 2]\n  b: {b_values}\n")
+        jobs = list(pending_jobs(read_batch("s.yaml"), "s.yaml", statuses))
+        journal = BatchJournal("s.journal", ["local"])
+        schedule(jobs, [machine_state], machine_config, launch, lambda *args: None, LaunchRateLimiter(None), journal=journal)
+        journal.close()
+        return [job_name for _, job_name, _ in jobs]
+
+    assert run_sweep("[1]") == ["s.yaml.a=1.b=1", "s.yaml.a=2.b=1"]
+    # the points that finished moved to other line numbers, they are still done
+    assert run_sweep("[0, 1]", load_journal("s.journal")) == ["s.yaml.a=1.b=0", "s.yaml.a=2.b=0"]
+    assert sorted(os.listdir("job_results")) == ["s.yaml.a=1.b=0", "s.yaml.a=1.b=1", "s.yaml.a=2.b=0", "s.yaml.a=2.b=1"]
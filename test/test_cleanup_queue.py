@@ -0,0 +1,59 @@
+import os
+import time
+import subprocess
+from ssh_scheduler import cleanup_queue
+from ssh_scheduler.cleanup_queue import CleanupQueue
+from ssh_scheduler.better_basic_run import CleanupShellProcess, Teardown, teardown_command
+
+local_machine = {"ip": "127.0.0.1", "local": True}
+other_machine = {"ip": "127.0.0.2", "local": True}
+
+
+def make_job(folder, running):
+    '''a run folder with the pid file of a job that is still running or has exited'''
+    os.makedirs(folder)
+    proc = subprocess.Popen(["sleep", "30" if running else "0"])
+    if not running:
+        proc.wait()
+    with open(os.path.join(folder, ".job_pid.txt"), 'w') as file:
+        file.write(f"{proc.pid}\n")
+    return proc
+
+
+def test_flush_coalesces_per_machine(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cleanup_queue, "MAX_BATCH", 4)
+    queue = CleanupQueue(interval=0.2)
+    procs = [make_job(f"job_data/job{i}", running=i < 3) for i in range(10)]
+    open("script.sh", 'w').close()
+    handles = [queue.add(Teardown(local_machine, f"job_data/job{i}", ["script.sh"] if i == 0 else []), kill=i < 3) for i in range(9)]
+    handles.append(queue.add(Teardown(other_machine, "job_data/job9", []), kill=False))
+    start = time.monotonic()
+    queue.close()
+    assert time.monotonic() - start < 5
+    assert all(handle.wait() == 0 for handle in handles)
+    # 9 jobs in batches of 4 on one machine, 1 on the other
+    assert queue.sessions == 4
+    assert os.listdir("job_data") == []
+    assert not os.path.exists("script.sh")
+    assert [proc.wait(timeout=5) for proc in procs[:3]] == [-15] * 3
+
+
+def test_close_tears_down_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queue = CleanupQueue(interval=0.05)
+    make_job("job_data/job", running=False)
+    proc = CleanupShellProcess("true", teardown=Teardown(local_machine, "job_data/job", []), cleanup_queue=queue)
+    proc.wait()
+    first = proc.close()
+    assert proc.close() is first and len(first) == 1
+    first[0].wait()
+    assert not os.path.exists("job_data/job")
+    queue.close()
+    assert queue.sessions == 1
+
+
+def test_teardown_command():
+    command = teardown_command(local_machine, ["job_data/a", "job_data/b"], ["job_data/b"], ["/tmp/x.sh"])
+    assert command == "(for d in job_data/b; do kill -- $(cat $d/.*_pid.txt $d/.pack_*/.*_pid.txt 2>/dev/null) 2>/dev/null; done; sleep 0.3; rm -rf job_data/a job_data/b) ; rm -f /tmp/x.sh"
+    assert teardown_command(local_machine, ["job_data/a"]) == "(rm -rf job_data/a)"
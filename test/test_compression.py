@@ -0,0 +1,91 @@
+import os
+import copy
+from ssh_scheduler import compression
+from ssh_scheduler.better_basic_run import machine_codec, compress_args, remote_job_command
+from ssh_scheduler.compression import choose_codec, forward_files, payload_speed, negotiate_all
+from ssh_scheduler.remote_framer import sample_ratio, result_compressor, MIN_COMPRESS_BYTES
+
+machine = {"username": "u", "ip": "10.0.0.9", "port": 22, "ssh_key_path": "~/.ssh/id_rsa"}
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def test_sample_ratio(tmp_path):
+    write(str(tmp_path / "text.txt"), b"".join(b"line %d of some text\n" % i for i in range(50000)))
+    write(str(tmp_path / "random.bin"), os.urandom(2**20))
+    assert sample_ratio([str(tmp_path / "text.txt")]) < 0.3
+    assert sample_ratio([str(tmp_path / "random.bin")]) > 0.99
+    assert sample_ratio([]) == 1.0
+    assert result_compressor([str(tmp_path / "random.bin")], 2**20, "zstd") is None
+    assert result_compressor([str(tmp_path / "text.txt")], 2**20, "none") is None
+    assert result_compressor([str(tmp_path / "text.txt")], MIN_COMPRESS_BYTES - 1, "gzip") is None
+    # without a negotiated codec, only big results are gzipped
+    assert result_compressor([str(tmp_path / "text.txt")], 2**20) is None
+    assert result_compressor([str(tmp_path / "text.txt")], 2**20, "gzip:4") == "gzip -c -4"
+
+
+def test_choose_codec():
+    codecs = ["zstd", "lz4", "gzip"]
+    # a 100 Mbit link and text
+    assert choose_codec(12.5, 0.3, codecs) == "zstd"
+    assert choose_codec(12.5, 0.3, ["gzip"]) == "gzip"
+    # already compressed data, a 10 Gbit link, or an unmeasured one go raw
+    assert choose_codec(12.5, 0.98, codecs) is None
+    assert choose_codec(1250, 0.3, codecs) is None
+    assert choose_codec(None, 0.3, codecs) is None
+    assert choose_codec(12.5, 0.3, []) is None
+    # gigabit: gzip cannot keep up with the link, lz4 and zstd still pay off
+    assert payload_speed(125, 0.3, "gzip") < 125
+    assert choose_codec(125, 0.3, ["gzip", "lz4"]) == "lz4"
+
+
+def test_forward_files_skip_results(tmp_path, monkeypatch):
+    write(str(tmp_path / "src" / "a.txt"), b"a")
+    write(str(tmp_path / "job_results" / "old.txt"), b"old")
+    write(str(tmp_path / ".git" / "HEAD"), b"ref")
+    monkeypatch.chdir(tmp_path)
+    assert forward_files(["."]) == ["./src/a.txt"]
+
+
+def test_machine_compression():
+    assert machine_codec(machine) is None
+    assert compress_args(machine) == []
+    assert compress_args(dict(machine, compression="none")) == ["--compress", "none"]
+    assert machine_codec(dict(machine, compression="zstd")) == ("zstd", 3)
+    assert compress_args(dict(machine, compression="gzip", compression_level=6)) == ["--compress", "gzip:6"]
+    command, _, _ = remote_job_command(["src"], dict(machine, compression="zstd", compression_level=9), "job_data/x", ["echo hi"], "{scripts}", False)
+    assert "| zstd -q -c -9 | ssh" in command
+    assert "tar -x" in command and "zstd -q -d -c | tar -x" in command
+    raw, _, _ = remote_job_command(["src"], machine, "job_data/x", ["echo hi"], "{scripts}", False)
+    assert "zstd" not in raw and " | ssh" in raw
+
+
+def test_links_measured_once(tmp_path, monkeypatch):
+    measured = []
+    monkeypatch.setattr(compression, "negotiate", lambda config, measure_bytes: measured.append(config["ip"]) or (12.5, ["zstd"]))
+    monkeypatch.setattr(compression, "local_codecs", lambda: ["zstd"])
+    write(str(tmp_path / "text.txt"), b"".join(b"line %d of some text\n" % i for i in range(50000)))
+    links_path = str(tmp_path / "cache" / "links.json")
+    other = dict(machine, port=2222)
+
+    def negotiate(now, max_age=3600):
+        configs = [copy.deepcopy(machine), copy.deepcopy(other)]
+        negotiate_all(configs, ["a", "b"], [str(tmp_path / "text.txt")], links_path=links_path, max_age=max_age, now=now)
+        return [config["compression"] for config in configs]
+
+    assert negotiate(1000) == ["zstd", "zstd"]
+    assert measured == ["10.0.0.9", "10.0.0.9"]
+    # a machine on another port of the same address is a link of its own
+    assert len(compression.load_links(links_path)) == 2
+    # the next batch reuses both links
+    assert negotiate(2000) == ["zstd", "zstd"]
+    assert len(measured) == 2
+    # until they are too old, or caching is turned off
+    negotiate(5000)
+    assert len(measured) == 4
+    negotiate(5001, max_age=0)
+    assert len(measured) == 6
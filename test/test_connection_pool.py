@@ -0,0 +1,37 @@
+import os
+from ssh_scheduler.better_basic_run import make_ssh_command
+from ssh_scheduler.connection_pool import ConnectionPool
+
+machine_config = {"username": "ben", "ip": "127.0.0.1", "port": 22, "ssh_key_path": "~/.ssh/id_rsa"}
+
+
+def test_unpooled_command():
+    cmd = make_ssh_command(machine_config, "echo hi")
+    assert "ControlPath" not in cmd
+    assert cmd.endswith("ben@127.0.0.1 'echo hi'")
+
+
+def test_pooled_command_round_robin():
+    pool = ConnectionPool()
+    try:
+        config = dict(machine_config)
+        config['control_paths'] = [pool.control_path(config, i) for i in range(2)]
+        used = {make_ssh_command(config, "true").split("ControlPath=")[1].split()[0] for _ in range(4)}
+        assert used == set(config['control_paths'])
+        # unix socket paths must fit in sockaddr_un
+        assert all(len(path) < 100 for path in used)
+        assert "ControlMaster=no" in make_ssh_command(config, "true")
+    finally:
+        pool.close()
+    assert not os.path.exists(pool.socket_dir)
+
+
+def test_unreachable_machine_not_pooled():
+    config = dict(machine_config, port=1, ssh_key_path="/dev/null")
+    with ConnectionPool() as pool:
+        assert pool.open(config) is False
+        assert 'control_paths' not in config
+        # a failed master is not kept, so opening again retries it
+        assert not pool.masters
+        assert pool.open(config) is False
+        assert not pool.masters
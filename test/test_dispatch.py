@@ -0,0 +1,258 @@
+import os
+import copy
+import time
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.dispatch import CompletionQueue, LaunchRateLimiter, MachineRateLimiter, Packer, RetryPolicy, Speculator, backoff_delay, is_connection_failure
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def test_completion_queue_wakes_on_exit():
+    completions = CompletionQueue()
+    slow = subprocess.Popen(["sleep", "5"])
+    completions.watch(subprocess.Popen(["true"]), "fast")
+    completions.watch(slow, "slow")
+    completions.watch(None, "dry")
+    start = time.monotonic()
+    tokens = set()
+    while len(tokens) < 2:
+        tokens.update(completions.get(timeout=5))
+    assert tokens == {"fast", "dry"}
+    assert time.monotonic() - start < 2
+    slow.kill()
+    assert completions.get(timeout=5) == ["slow"]
+
+
+def test_rate_limiter():
+    limiter = LaunchRateLimiter(100, burst=5)
+    start = time.monotonic()
+    for i in range(15):
+        limiter.wait()
+    # 5 launches from the burst, the other 10 paced at 100 per second
+    assert 0.08 < time.monotonic() - start < 0.5
+    unlimited = LaunchRateLimiter(0)
+    start = time.monotonic()
+    for i in range(1000):
+        unlimited.wait()
+    assert time.monotonic() - start < 0.1
+
+
+def test_machine_rate_limiter():
+    limiter = MachineRateLimiter(2, rate=4, max_rate=5)
+    for i in range(20):
+        limiter.observe(0, False, latency=0.1)
+    assert limiter.rate(0) == 5
+    limiter.observe(0, True)
+    assert limiter.rate(0) == 2.5
+    # connecting got much slower than the fastest seen
+    limiter.observe(0, False, latency=2.0)
+    assert limiter.rate(0) == 2.0
+    assert limiter.rate(1) == 4
+
+
+def test_backoff():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, base_delay=1.0, max_delay=8.0) <= min(8.0, 2 ** attempt)
+
+
+def test_connection_failure():
+    assert is_connection_failure(SimpleNamespace(returncode=255))
+    assert not is_connection_failure(SimpleNamespace(returncode=1))
+    # the command itself exited with 255
+    assert not is_connection_failure(SimpleNamespace(returncode=255, demux=SimpleNamespace(returncode=255)))
+
+
+def test_retry_policy():
+    policy = RetryPolicy(max_retries=2, base_delay=0.0, quarantine_after=2, quarantine_seconds=10.0)
+    assert policy.job_failed(0) == 0.0
+    assert policy.job_failed(0) == 0.0
+    assert policy.job_failed(0) is None
+    assert not policy.machine_failed(1, 100.0)
+    policy.machine_ok(1)
+    assert not policy.machine_failed(1, 100.0)
+    assert policy.machine_failed(1, 100.0)
+    assert policy.next_release() == 110.0
+    assert policy.released(109.0) == []
+    assert policy.released(110.0) == [1]
+    # on probation, one more failure quarantines it again
+    assert policy.machine_failed(1, 120.0)
+
+
+def test_packer_fixed_size():
+    packer = Packer(size=3)
+    packs = list(packer.packs(range(8)))
+    assert packs == [[0, 1, 2], [3, 4, 5], [6, 7]]
+
+
+def test_packer_target_seconds():
+    packer = Packer(target_seconds=10, parallel=2)
+    packs = packer.packs(range(100))
+    # nothing observed yet, one job at a time
+    assert next(packs) == [0]
+    # a pack of 4 jobs running 2 at a time took 2 seconds, so one job takes a second
+    packer.observe(2.0, 4)
+    assert len(next(packs)) == 20
+
+
+def test_schedule_packs():
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 2, "gpus": []}
+    init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    original_state = copy.deepcopy(machine_state)
+    launched = []
+    reports = []
+
+    def launch_pack(pack, machine_idx, gpu_idx):
+        launched.append([line_num for line_num, _, _ in pack])
+        return [(None, job_name) for _, job_name, _ in pack]
+
+    def report(message, line_num, job_name, command):
+        reports.append((message, line_num))
+
+    jobs = [(i, f"job.{i}", "true") for i in range(7)]
+    schedule(jobs, [machine_state], machine_config, None, report, LaunchRateLimiter(None), packer=Packer(3), launch_pack=launch_pack)
+    assert launched == [[0, 1, 2], [3, 4, 5], [6]]
+    assert sorted(line_num for message, line_num in reports if message == "finished") == list(range(7))
+    assert machine_state == original_state
+
+
+def test_schedule_retries():
+    # one slot on machine 0, so each failure is seen before its next launch there
+    machine_states = [{"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": cpus, "gpus": []} for cpus in (1, 2)]
+    for machine_state in machine_states:
+        init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    launched = []
+    reports = []
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        launched.append((line_num, machine_idx))
+        # machine 0 never accepts a connection
+        return subprocess.Popen("exit 255" if machine_idx == 0 else command, shell=True), job_name
+
+    def report(message, line_num, job_name, command):
+        reports.append((message, line_num))
+
+    jobs = [(i, f"job.{i}", "true") for i in range(6)]
+    policy = RetryPolicy(max_retries=3, base_delay=0.01, quarantine_after=2, quarantine_seconds=60)
+    schedule(jobs, machine_states, machine_config, launch, report, LaunchRateLimiter(None), retry_policy=policy)
+    assert sorted(line_num for message, line_num in reports if message == "finished") == list(range(6))
+    assert not any(message == "failed" for message, line_num in reports)
+    assert machine_states[0]["quarantined"]
+    assert sum(machine_idx == 0 for line_num, machine_idx in launched) == 2
+
+
+def test_schedule_retries_on_its_clock(capsys):
+    # a clock running 1000 times faster than time.monotonic ends the minute long quarantine in 60ms
+    machine_states = [{"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 1, "gpus": []} for _ in range(2)]
+    for machine_state in machine_states:
+        init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    launched = []
+    start = time.monotonic()
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        launched.append(machine_idx)
+        return subprocess.Popen("exit 255" if machine_idx == 0 else "sleep 0.1", shell=True), job_name
+
+    jobs = [(i, f"job.{i}", "true") for i in range(6)]
+    policy = RetryPolicy(max_retries=10, base_delay=0.01, quarantine_after=1, quarantine_seconds=60)
+    schedule(jobs, machine_states, machine_config, launch, lambda *args: None, LaunchRateLimiter(None), retry_policy=policy, clock=lambda: (time.monotonic() - start) * 1000)
+    assert "retrying machine 0 after its quarantine" in capsys.readouterr().out
+    assert launched.count(0) > 1
+
+
+def test_schedule_places_sized_jobs_where_they_fit():
+    # the least loaded machine is too small for the sized job
+    machine_states = [
+        {"cpu_usage": 0.0, "mem_free": 100, "cpu_count": 2, "gpus": []},
+        {"cpu_usage": 0.5, "mem_free": 10**6, "cpu_count": 2, "gpus": []},
+    ]
+    for machine_state in machine_states:
+        init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    sized = copy.copy(machine_config)
+    sized.memory_required = 1000
+    launched = []
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        launched.append(machine_idx)
+        return None, job_name
+
+    jobs = [(0, "job.0", "big"), (1, "job.1", "small")]
+    schedule(jobs, machine_states, machine_config, launch, lambda *args: None, LaunchRateLimiter(None), job_config=lambda command: sized if command == "big" else machine_config)
+    assert launched == [1, 0]
+
+
+def test_speculator():
+    speculator = Speculator(factor=2.0, min_seconds=10.0, min_finished=3)
+    job = SimpleNamespace(command="train", launched_at=0.0)
+    # nothing to compare against yet
+    assert speculator.stragglers([job], 100.0) == []
+    for seconds in [5.0, 6.0, 100.0]:
+        speculator.observe(seconds)
+    assert speculator.expected("train") == 6.0
+    assert speculator.stragglers([job], 13.0) == [job]
+    assert speculator.stragglers([job], 11.0) == []
+
+
+class KillableProc:
+    def __init__(self, command):
+        self.proc = subprocess.Popen(command, shell=True)
+
+    def wait(self):
+        return self.proc.wait()
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        return []
+
+
+def test_schedule_speculates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("job_results")
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 2, "gpus": []}
+    init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    reports = []
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        # the first run of the last job is stuck, its copy is not
+        slow = line_num == 3 and not job_name.endswith(".copy")
+        results = f"mkdir -p job_results/{job_name} && echo {job_name} > job_results/{job_name}/result && echo out > job_results/{job_name}.out"
+        return KillableProc(results + (" && sleep 30" if slow else "")), job_name
+
+    def report(message, line_num, job_name, command):
+        reports.append((message, job_name))
+
+    jobs = [(i, f"job.{i}", "true") for i in range(4)]
+    speculator = Speculator(factor=2.0, min_seconds=0.5, interval=0.1)
+    start = time.monotonic()
+    schedule(jobs, [machine_state], machine_config, launch, report, LaunchRateLimiter(None), speculator=speculator)
+    assert time.monotonic() - start < 10
+    assert ("speculating", "job.3.copy") in reports
+    assert ("dropped", "job.3") in reports
+    assert [message for message, job_name in reports if job_name == "job.3" and message in ("finished", "failed")] == ["finished"]
+    assert open("job_results/job.3/result").read() == "job.3.copy\n"
+    assert sorted(os.listdir("job_results")) == sorted([f"job.{i}" for i in range(4)] + [f"job.{i}.out" for i in range(4)])
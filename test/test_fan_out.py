@@ -0,0 +1,66 @@
+import time
+import threading
+from ssh_scheduler.fan_out import run_bounded, relay, relay_command, ORIGIN
+
+
+class SleepProc:
+    '''a process that takes seconds and exits with returncode'''
+    def __init__(self, seconds, returncode=0, on_exit=None):
+        self.seconds = seconds
+        self.returncode = returncode
+        self.on_exit = on_exit
+
+    def wait(self):
+        time.sleep(self.seconds)
+        if self.on_exit is not None:
+            self.on_exit()
+            self.on_exit = None
+        return self.returncode
+
+
+def test_run_bounded():
+    lock = threading.Lock()
+    counts = {"running": 0, "most": 0}
+
+    def finished():
+        with lock:
+            counts["running"] -= 1
+
+    def start(item):
+        with lock:
+            counts["running"] += 1
+            counts["most"] = max(counts["most"], counts["running"])
+        return SleepProc(0.01, item % 3, finished)
+
+    done = []
+    results = run_bounded(range(30), start, 4, lambda item, returncode: done.append(item))
+    assert counts["most"] <= 4
+    assert sorted(done) == list(range(30))
+    assert results[5] == 2
+
+
+def test_relay_tree():
+    sends = []
+
+    def send(sender, receiver):
+        sends.append((sender, receiver))
+        # machine 7 cannot be reached from other machines, only from the origin
+        return SleepProc(0.01, 1 if receiver == 7 and sender is not ORIGIN else 0)
+
+    done = []
+    received = relay(60, send, fanout=2, max_parallel=64, done=lambda receiver, ok: done.append((receiver, ok)))
+    assert received == set(range(60))
+    assert sorted(done) == [(i, True) for i in range(60)]
+    from_origin = [receiver for sender, receiver in sends if sender is ORIGIN]
+    assert 7 in from_origin
+    # the machines having the payload triple every round, and the origin sends 2 per round
+    assert len(from_origin) <= 2 * 5 + 1
+
+
+def test_relay_command():
+    sender = {"username": "a", "ip": "10.0.0.1", "port": 22, "ssh_key_path": "~/.ssh/id"}
+    receiver = {"username": "b", "ip": "10.0.0.2", "relay_ip": "192.168.0.2", "port": 2222, "ssh_key_path": "~/.ssh/id"}
+    command = relay_command(sender, receiver, "~/.cache/x.tar")
+    assert "a@10.0.0.1" in command
+    assert "-p 2222 b@192.168.0.2" in command
+    assert command.endswith("< ~/.cache/x.tar'")
@@ -0,0 +1,94 @@
+import io
+import os
+from ssh_scheduler import forward_cache, remote_cache
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, "src", "job_results"))
+    os.makedirs(os.path.join(root, "src", "empty"))
+    with open(os.path.join(root, "src", "data.bin"), 'wb') as file:
+        file.write(os.urandom(200000))
+    with open(os.path.join(root, "src", "copy.bin"), 'wb') as file:
+        file.write(open(os.path.join(root, "src", "data.bin"), 'rb').read())
+    with open(os.path.join(root, "src", "run.sh"), 'w') as file:
+        file.write("echo hi\n")
+    os.chmod(os.path.join(root, "src", "run.sh"), 0o755)
+    with open(os.path.join(root, "src", "job_results", "old.txt"), 'w') as file:
+        file.write("should not be sent")
+    return os.path.join(root, "src")
+
+
+def send_job(src, cache_dir, job_folder, hardlink=False):
+    manifest = forward_cache.build_manifest([src])
+    blobs = forward_cache.manifest_blobs(manifest)
+    missing = set(remote_cache.find_missing(cache_dir, [(h, size) for h, (size, _) in blobs.items()]))
+    payload = io.BytesIO()
+    forward_cache.write_payload(payload, manifest, missing, [("tmp/script.sh", b"echo job\n", 0o644)])
+    os.makedirs(job_folder)
+    remote_cache.build(cache_dir, 2**30, io.BytesIO(payload.getvalue()), job_folder, hardlink)
+    return len(payload.getvalue())
+
+
+def test_unchanged_tree_sends_near_zero_bytes(tmp_path):
+    src = make_tree(str(tmp_path))
+    cache_dir = str(tmp_path / "cache")
+    first = send_job(src, cache_dir, str(tmp_path / "job1"))
+    second = send_job(src, cache_dir, str(tmp_path / "job2"))
+    # duplicate file content is only sent once
+    assert 200000 < first < 2 * 200000
+    assert second < 0.05 * first
+
+    arc = forward_cache.archive_name(src)
+    for job in ["job1", "job2"]:
+        folder = tmp_path / job / arc
+        assert open(folder / "data.bin", 'rb').read() == open(os.path.join(src, "data.bin"), 'rb').read()
+        assert os.access(folder / "run.sh", os.X_OK)
+        assert os.path.isdir(folder / "empty")
+        assert not os.path.exists(folder / "job_results")
+        assert open(tmp_path / job / "tmp" / "script.sh").read() == "echo job\n"
+
+
+def test_job_files_do_not_share_blobs(tmp_path):
+    src = make_tree(str(tmp_path))
+    cache_dir = str(tmp_path / "cache")
+    send_job(src, cache_dir, str(tmp_path / "job1"))
+    data = tmp_path / "job1" / forward_cache.archive_name(src) / "data.bin"
+    assert os.access(data, os.W_OK) or os.getuid() == 0
+    with open(data, 'r+b') as file:
+        file.write(b"overwritten")
+    send_job(src, cache_dir, str(tmp_path / "job2"))
+    original = open(os.path.join(src, "data.bin"), 'rb').read()
+    assert open(tmp_path / "job2" / forward_cache.archive_name(src) / "data.bin", 'rb').read() == original
+
+
+def test_blob_written_through_hardlink_is_sent_again(tmp_path):
+    src = make_tree(str(tmp_path))
+    cache_dir = str(tmp_path / "cache")
+    send_job(src, cache_dir, str(tmp_path / "job1"), hardlink=True)
+    data = tmp_path / "job1" / forward_cache.archive_name(src) / "data.bin"
+    if os.stat(data).st_nlink == 1:
+        # the filesystem made a reflink, the blob is not shared
+        return
+    os.chmod(data, 0o644)
+    with open(data, 'r+b') as file:
+        file.write(b"overwritten")
+    second = send_job(src, cache_dir, str(tmp_path / "job2"), hardlink=True)
+    assert second > 200000
+    original = open(os.path.join(src, "data.bin"), 'rb').read()
+    assert open(tmp_path / "job2" / forward_cache.archive_name(src) / "data.bin", 'rb').read() == original
+
+
+def test_lru_eviction(tmp_path):
+    cache_dir = str(tmp_path)
+    hashes = []
+    for i in range(4):
+        data = os.urandom(1000)
+        blob_hash = forward_cache.hashlib.sha256(data).hexdigest()
+        remote_cache.store_blob(cache_dir, blob_hash, io.BytesIO(data))
+        path = remote_cache.blob_path(cache_dir, blob_hash)
+        os.utime(path, (i, i))
+        hashes.append(blob_hash)
+    total = remote_cache.evict(cache_dir, 2500, keep=[hashes[0]])
+    assert total == 2000
+    remaining = [h for h in hashes if os.path.exists(remote_cache.blob_path(cache_dir, h))]
+    assert remaining == [hashes[0], hashes[3]]
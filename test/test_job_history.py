@@ -0,0 +1,114 @@
+import os
+import sys
+from types import SimpleNamespace
+from ssh_scheduler.better_basic_run import CleanupShellProcess, remote_python_command, remote_script
+from ssh_scheduler.stream_demux import StreamDemux
+from ssh_scheduler.job_history import JobHistory, LongestFirst, command_template, observed_usage
+from ssh_scheduler.batch_journal import BatchJournal
+from ssh_scheduler.machine_cost_model import init_machine_limit
+from ssh_scheduler.simulate import simulate, replay_jobs
+
+
+def batch_config(**resources):
+    config = dict(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=10
+    )
+    config.update(resources)
+    return SimpleNamespace(**config)
+
+
+def machine(cpu_count, mem_free):
+    machine_state = {"cpu_usage": 0.0, "mem_free": mem_free, "cpu_count": cpu_count, "gpus": []}
+    init_machine_limit(machine_state)
+    return machine_state
+
+
+def test_command_template():
+    assert command_template("python train.py --lr 0.01  --seed 3 --layers=1e-3") == "python train.py --lr # --seed # --layers=#"
+    assert command_template("run_v2 x3") == "run_v2 x3"
+
+
+def test_history_file(tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    history = JobHistory(path)
+    history.record("train --seed 1", 10.0, peak_memory=800.0, cpu_seconds=20.0)
+    history.record("train --seed 2", 20.0, peak_memory=1000.0, cpu_seconds=10.0)
+    history.close()
+    with open(path, 'a') as file:
+        file.write('{"template": "cut sh')
+
+    history = JobHistory(path)
+    assert 10.0 < history.seconds("train --seed 3") < 20.0
+    assert history.seconds("evaluate") is None
+    sized = history.sized_config(batch_config(memory_required=7000), "train --seed 9")
+    assert sized.memory_required == 1250
+    assert sized.num_cpus == 2
+    assert history.sized_config(batch_config(), "evaluate").memory_required == 10
+
+
+def test_longest_first():
+    history = JobHistory(template=str)
+    for command, seconds in [("a", 1), ("b", 5), ("c", 3), ("d", 4)]:
+        history.record(command, seconds)
+    jobs = [(i, command, command) for i, command in enumerate(["a", "b", "new", "c", "d"])]
+    assert [job[2] for job in LongestFirst(history).jobs(jobs)] == ["new", "b", "d", "c", "a"]
+    # only reorders within the window of upcoming jobs
+    assert [job[2] for job in LongestFirst(history, lookahead=2).jobs(jobs)] == ["b", "new", "c", "d", "a"]
+
+
+def test_simulate_longest_first():
+    commands = ["short 1", "short 2", "short 3", "short 4", "long 5"]
+    jobs = [(i, command, command) for i, command in enumerate(commands)]
+    durations = {i: (40.0 if command.startswith("long") else 10.0) for i, command in enumerate(commands)}
+    history = JobHistory()
+    for i, command in enumerate(commands):
+        history.record(command, durations[i])
+    # two jobs fit at a time
+    infos = [machine(cpu_count=2, mem_free=10**6)]
+    assert simulate(jobs, durations, infos, batch_config(), "file", history) == 60.0
+    assert simulate(jobs, durations, infos, batch_config(), "longest-first", history) == 40.0
+
+
+def test_simulate_backfill():
+    # big holds 60 of the 100MB for a long time, so huge has to wait for it,
+    # but the small jobs fit in the 40MB left one at a time and finish well before big
+    commands = ["big 0", "huge 1", "small 2", "small 3", "small 4"]
+    jobs = [(i, command, command) for i, command in enumerate(commands)]
+    durations = {0: 100.0, 1: 10.0, 2: 10.0, 3: 10.0, 4: 10.0}
+    history = JobHistory()
+    for command, seconds, peak_memory in [("big #", 100.0, 48.0), ("huge #", 10.0, 64.0), ("small #", 10.0, 24.0)]:
+        history.record(command, seconds, peak_memory=peak_memory)
+    infos = [machine(cpu_count=64, mem_free=100)]
+    assert simulate(jobs, durations, infos, batch_config(), "longest-first", history, sized=True) == 120.0
+    assert simulate(jobs, durations, infos, batch_config(), "backfill", history, sized=True) == 110.0
+
+
+def test_replay_journal(tmp_path):
+    path = str(tmp_path / "batch.journal")
+    journal = BatchJournal(path, ["local"])
+    journal.batch([machine(cpu_count=2, mem_free=10**6)], batch_config())
+    for line_num in range(3):
+        journal.queued(line_num, f"job.{line_num}", f"echo {line_num}")
+    journal.started(0, "job.0", 0, None)
+    journal.started(1, "job.1", 0, None)
+    journal.record("finished", 0, "job.0")
+    journal.close()
+    batch, jobs, durations = replay_jobs(path)
+    assert batch["resources"]["memory_required"] == 10
+    assert jobs == [(0, "job.0", "echo 0")]
+    assert durations[0] >= 0
+
+
+def test_framer_measures_usage(tmp_path):
+    os.makedirs(tmp_path / "job")
+    with open(tmp_path / "job" / "job.sh", 'w') as file:
+        file.write(f"{sys.executable} -c 'x = bytearray(200 * 2**20); x[::4096] = b\"1\" * len(x[::4096])'\n")
+    framer = remote_python_command({}, remote_script("remote_framer.py"), "job.sh")
+    demux = StreamDemux(open(os.devnull, 'wb'), open(os.devnull, 'wb'))
+    proc = CleanupShellProcess(f"cd {tmp_path / 'job'} && {framer}", demux=demux)
+    assert proc.wait() == 0
+    seconds, peak_memory, cpu_seconds = observed_usage(proc, 100.0)
+    assert seconds < 100.0
+    assert peak_memory > 200
+    assert cpu_seconds > 0
@@ -0,0 +1,102 @@
+import io
+import os
+import shutil
+import pytest
+from ssh_scheduler.job_log import LogSink, JobLogs, Follower, tail, rotated_segments, log_files, rename_log
+from ssh_scheduler.better_basic_run import CleanupShellProcess
+from ssh_scheduler.stream_demux import StreamDemux
+from ssh_scheduler.remote_framer import STDOUT, STDERR, EXIT, END, write_frame
+
+
+def progress_output():
+    '''a progress bar and some lines, cut into chunks that split lines and updates'''
+    data = b"epoch 1\n" + b"".join(b"\r%3d%%|" % i + b"#" * (i // 10) for i in range(101)) + b"\ndone\r\n"
+    return [data[i:i + 7] for i in range(0, len(data), 7)]
+
+
+def test_collapse_progress_bars(tmp_path):
+    sink = LogSink(str(tmp_path / "job.out"), buffer_bytes=16, collapse_cr=True)
+    for chunk in progress_output():
+        sink.write(chunk)
+    sink.write(b"left at 50%\rleft at 60%")
+    sink.close()
+    assert open(tmp_path / "job.out", 'rb').read() == b"epoch 1\n100%|##########\ndone\nleft at 60%"
+
+
+def test_keeps_output_as_printed_by_default(tmp_path):
+    sink = LogSink(str(tmp_path / "job.out"))
+    for chunk in progress_output():
+        sink.write(chunk)
+    sink.close()
+    assert open(tmp_path / "job.out", 'rb').read() == b"".join(progress_output())
+
+
+def test_buffered_until_sync(tmp_path):
+    logs = JobLogs(interval=3600, collapse_cr=True)
+    sink = logs.open(str(tmp_path / "job.out"))
+    sink.write(b"line\n")
+    assert open(tmp_path / "job.out", 'rb').read() == b""
+    sink.sync()
+    assert open(tmp_path / "job.out", 'rb').read() == b"line\n"
+    sink.write(b"more\n50%\r60%")
+    sink.sync()
+    assert open(tmp_path / "job.out", 'rb').read() == b"line\nmore\n"
+    sink.flush()
+    assert open(tmp_path / "job.out", 'rb').read() == b"line\nmore\n60%"
+    logs.close()
+    assert open(tmp_path / "job.out", 'rb').read() == b"line\nmore\n60%"
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_rotation(tmp_path, compression):
+    if compression == "zstd" and not shutil.which("zstd"):
+        pytest.skip("zstd is not installed")
+    base = str(tmp_path / "job.out")
+    sink = LogSink(base, compression, buffer_bytes=1, max_bytes=100, keep=3)
+    follower = Follower(base)
+    followed = b""
+    for i in range(100):
+        sink.write(b"line %d\n" % i)
+        followed += follower.read()
+    sink.close()
+    followed += follower.read()
+    lines = [b"line %d\n" % i for i in range(100)]
+    # the follower saw every line, across rotations
+    assert followed == b"".join(lines)
+    numbers = [number for number, _ in rotated_segments(base)]
+    assert len(numbers) == 3 and numbers == list(range(numbers[0], numbers[0] + 3))
+    out = io.BytesIO()
+    tail(base, 20, out=out)
+    assert out.getvalue() == b"".join(lines[-20:])
+    rename_log(base, str(tmp_path / "kept.out"))
+    assert log_files(base) == []
+    assert len(log_files(str(tmp_path / "kept.out"))) == 4
+
+
+def test_process_stderr_to_sink(tmp_path):
+    sink = LogSink(str(tmp_path / "job.err"))
+    proc = CleanupShellProcess("echo to stderr >&2; exit 4", stderr=sink)
+    assert proc.wait() == 4
+    sink.close()
+    assert open(tmp_path / "job.err", 'rb').read() == b"to stderr\n"
+
+
+def test_logs_written_once_job_ends(tmp_path):
+    # as a job that ended is reported finished, its logs may be read, renamed or removed at once
+    logs = JobLogs(interval=3600, collapse_cr=True)
+    out, err = logs.open(str(tmp_path / "job.out")), logs.open(str(tmp_path / "job.err"))
+    frames = io.BytesIO()
+    write_frame(frames, STDOUT, b"line\n10%\r")
+    write_frame(frames, STDERR, b"warning\n")
+    write_frame(frames, EXIT, b"\0\0\0\0")
+    write_frame(frames, END, b"")
+    frames.seek(0)
+    StreamDemux(out, err).run(frames)
+    assert open(tmp_path / "job.out", 'rb').read() == b"line\n10%"
+    assert open(tmp_path / "job.err", 'rb').read() == b"warning\n"
+    rename_log(str(tmp_path / "job.err"), str(tmp_path / "kept.err"))
+    sink = logs.open(str(tmp_path / "ssh.err"))
+    assert CleanupShellProcess("echo to stderr >&2", stderr=sink).wait() == 0
+    assert open(tmp_path / "ssh.err", 'rb').read() == b"to stderr\n"
+    logs.close()
+    assert open(tmp_path / "kept.err", 'rb').read() == b"warning\n"
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.better_basic_run import CleanupShellProcess, remote_python_command, remote_script
+from ssh_scheduler.stream_demux import StreamDemux
+from ssh_scheduler.job_trace import JobTrace, SCHEDULER, load_events, summarize, chrome_trace, format_summary
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.dispatch import LaunchRateLimiter
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def test_framed_job_phases(tmp_path):
+    os.makedirs(tmp_path / "job")
+    with open(tmp_path / "job" / "job.sh", 'w') as file:
+        file.write("sleep 0.5\necho done > out.txt\n")
+    trace = JobTrace(str(tmp_path / "trace.jsonl"), ["local"], [1])
+    framer = remote_python_command({}, remote_script("remote_framer.py"), "job.sh out.txt")
+    command = f"SETUP_START=$(date +%s.%N) && sleep 0.2 && cd {tmp_path / 'job'} && SSHS_SETUP_START=$SETUP_START {framer}"
+    launched = trace.now()
+    demux = StreamDemux(open(os.devnull, 'wb'), open(os.devnull, 'wb'), str(tmp_path / "results"))
+    proc = CleanupShellProcess(command, cleanups=["sleep 0.1"], demux=demux)
+    assert proc.wait() == 0
+    trace.record_job("job", 0, 0.0, launched, trace.now(), proc)
+    trace.record_cleanup("job", 0, proc)
+    trace.close()
+
+    phases = {event["phase"]: event for event in load_events(str(tmp_path / "trace.jsonl"))}
+    assert phases["unpack"]["end"] - phases["unpack"]["start"] >= 0.2
+    assert phases["command"]["end"] - phases["command"]["start"] >= 0.5
+    assert phases["cleanup"]["end"] - phases["cleanup"]["start"] >= 0.1
+    order = ["queue", "connect", "unpack", "command", "copy_back"]
+    for before, after in zip(order, order[1:]):
+        assert phases[before]["end"] <= phases[after]["start"] + 1e-6
+
+
+def test_summary_and_chrome_trace(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    trace = JobTrace(path, ["a", "b"], [2, 1])
+    trace.record("j1", 0, "command", 0.0, 10.0)
+    trace.record("j2", 0, "command", 0.0, 5.0)
+    trace.record("j3", 1, "queue", 0.0, 5.0)
+    trace.record("j3", 1, "command", 5.0, 10.0)
+    trace.record(SCHEDULER, None, "place", 0.0, 0.5)
+    trace.record(SCHEDULER, None, "launch", 0.5, 1.0)
+    trace.close()
+
+    summary = summarize(load_events(path))
+    assert summary["jobs"] == 3
+    assert summary["jobs_per_second"] == 0.3
+    assert summary["scheduler_overhead_percent"] == 10.0
+    assert summary["utilization"] == {"a": 0.75, "b": 0.5}
+    assert "3 jobs" in format_summary(summary)
+
+    chrome = chrome_trace(load_events(path))
+    json.dumps(chrome)
+    assert len(chrome["traceEvents"]) == 6
+    j3 = [e for e in chrome["traceEvents"] if e["tid"] == "j3" and e["name"] == "command"][0]
+    assert (j3["pid"], j3["ts"], j3["dur"], j3["ph"]) == ("b", 5e6, 5e6, "X")
+
+
+class TracedProc:
+    def __init__(self, command):
+        self.proc = subprocess.Popen(command, shell=True)
+        self.returncode = None
+
+    def wait(self):
+        self.returncode = self.proc.wait()
+        return self.returncode
+
+    def close(self):
+        return []
+
+
+def test_queue_starts_when_job_is_queued(tmp_path):
+    machine_state = {"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 2, "gpus": []}
+    init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+
+    def jobs():
+        yield (0, "job.0", "true")
+        # read lazily, like a long batch file, after job 0 already finished
+        time.sleep(0.5)
+        yield (1, "job.1", "true")
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        return TracedProc(command), job_name
+
+    path = str(tmp_path / "trace.jsonl")
+    trace = JobTrace(path, ["local"], [2])
+    schedule(jobs(), [machine_state], machine_config, launch, lambda *args: None, LaunchRateLimiter(None), trace=trace)
+    trace.close()
+    queues = {event["job"]: event for event in load_events(path) if event["phase"] == "queue"}
+    assert queues["job.1"]["start"] >= 0.5
+    assert queues["job.1"]["end"] - queues["job.1"]["start"] < 0.4
@@ -0,0 +1,66 @@
+import os
+import io
+import getpass
+from ssh_scheduler.better_basic_run import generate_command, is_local, machine_command, LOCAL_RUN_FOLDER
+from ssh_scheduler.local_runner import build_workspace, move_results
+
+local_machine = {"username": getpass.getuser(), "ip": "127.0.0.1", "port": 22, "ssh_key_path": "~/.ssh/id_rsa"}
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def test_is_local():
+    assert is_local(local_machine)
+    assert not is_local(dict(local_machine, username="someone_else"))
+    assert not is_local(dict(local_machine, ip="10.0.0.5"))
+    # a tunnel or a container's sshd
+    assert not is_local(dict(local_machine, port=2222))
+    assert is_local(dict(local_machine, port=2222, local=True))
+    assert is_local(dict(local_machine, ip="10.0.0.5", local=True))
+    assert machine_command(local_machine, "echo hi") == "(echo hi)"
+
+
+def test_workspace_links(tmp_path, monkeypatch):
+    write(str(tmp_path / "src" / "data" / "a.txt"), "a")
+    write(str(tmp_path / "src" / "job_results" / "old.txt"), "old")
+    write(str(tmp_path / "src" / ".git" / "HEAD"), "ref")
+    monkeypatch.chdir(tmp_path / "src")
+    build_workspace(str(tmp_path / "run"), ["."], "hardlink")
+    assert os.listdir(tmp_path / "run") == ["data"]
+    assert os.stat(tmp_path / "run" / "data" / "a.txt").st_ino == os.stat(tmp_path / "src" / "data" / "a.txt").st_ino
+    build_workspace(str(tmp_path / "run"), ["data"], "reflink")
+    assert os.stat(tmp_path / "run" / "data" / "a.txt").st_ino != os.stat(tmp_path / "src" / "data" / "a.txt").st_ino
+    assert open(tmp_path / "run" / "data" / "a.txt").read() == "a"
+
+
+def test_move_results_merges(tmp_path):
+    write(str(tmp_path / "run" / "out" / "new.txt"), "new")
+    write(str(tmp_path / "results" / "out" / "kept.txt"), "kept")
+    missing = move_results(str(tmp_path / "run"), str(tmp_path / "results"), ["out", "absent.txt"])
+    assert missing == ["absent.txt"]
+    assert sorted(os.listdir(tmp_path / "results" / "out")) == ["kept.txt", "new.txt"]
+    assert not os.path.exists(tmp_path / "run" / "out" / "new.txt")
+
+
+def test_local_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write("inputs/words.txt", "robot\n")
+    stdout = io.BytesIO()
+    with open("job.err", 'wb') as stderr:
+        proc = generate_command(["inputs"], ["outfile.txt"], local_machine, "job", False, "sed s/robot/human/g inputs/words.txt | tee outfile.txt", stdout, stderr)
+        assert proc.wait() == 0
+    assert stdout.getvalue() == b"human\n"
+    assert open("job_results/job/outfile.txt").read() == "human\n"
+    assert proc.demux.peak_memory > 0
+    for cleanup in proc.close():
+        cleanup.wait()
+    assert not os.path.exists(LOCAL_RUN_FOLDER + "job")
+
+    with open("failing.err", 'wb') as stderr:
+        proc = generate_command([], ["nothing.txt"], local_machine, "failing", False, "exit 3", io.BytesIO(), stderr)
+        assert proc.wait() == 3
+    assert b"nothing.txt" in open("failing.err", 'rb').read()
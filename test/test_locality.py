@@ -0,0 +1,77 @@
+import os
+import subprocess
+from types import SimpleNamespace
+from ssh_scheduler.locality import Locality, payload_fingerprint
+from ssh_scheduler.scheduler import schedule
+from ssh_scheduler.dispatch import LaunchRateLimiter
+from ssh_scheduler.machine_cost_model import init_machine_limit
+
+
+def make_dataset(folder, content):
+    os.makedirs(folder)
+    with open(os.path.join(folder, "data.bin"), 'wb') as file:
+        file.write(content)
+    return folder
+
+
+def test_fingerprint_follows_content(tmp_path):
+    content = os.urandom(2**20)
+    first = payload_fingerprint([make_dataset(str(tmp_path / "a"), content)])
+    moved = payload_fingerprint([make_dataset(str(tmp_path / "b"), content)])
+    other = payload_fingerprint([make_dataset(str(tmp_path / "c"), os.urandom(2**20))])
+    assert first == moved
+    assert first[0] != other[0]
+    assert first[1] == 2**20
+
+
+def test_staged_sets_are_evicted(tmp_path):
+    datasets = {name: make_dataset(str(tmp_path / name), os.urandom(2**20)) for name in "abc"}
+    locality = Locality(2, lambda command: [datasets[command]], 1.0, capacity=2 * 2**20, local=[1])
+    a, b, c = (locality.inputs(name) for name in "abc")
+    assert locality.preference(a) == ({1}, locality.transfer_cost * 1e10 / 2**10)
+    locality.placed(0, a)
+    locality.placed(0, b)
+    locality.placed(0, a)
+    locality.placed(0, c)
+    # b was used least recently, local machines never hold anything
+    assert locality.preference(a)[0] == {0, 1}
+    assert locality.preference(b)[0] == {1}
+    locality.placed(1, b)
+    assert (locality.jobs, locality.hits, locality.bytes_avoided, locality.bytes_sent) == (4, 1, 2**20, 3 * 2**20)
+    assert "1 of 4 jobs" in locality.summary()
+
+
+def run_batch(tmp_path, transfer_cost):
+    machine_states = [{"cpu_usage": 0.0, "mem_free": 10**6, "cpu_count": 4, "gpus": []} for _ in range(2)]
+    for machine_state in machine_states:
+        init_machine_limit(machine_state)
+    machine_config = SimpleNamespace(
+        no_gpu_required=True, no_reserve_gpu=True, gpu_memory_required=0, gpu_utilization=0.0,
+        reserve=False, num_cpus=1, memory_required=1
+    )
+    datasets = {name: str(tmp_path / name) for name in "ab"}
+    for name, folder in datasets.items():
+        if not os.path.exists(folder):
+            make_dataset(folder, os.urandom(2**20))
+    locality = Locality(2, lambda command: [datasets[command.split()[-1]]], transfer_cost)
+    placed = []
+
+    def launch(line_num, job_name, command, machine_idx, gpu_idx):
+        placed.append((command.split()[-1], machine_idx))
+        return subprocess.Popen("sleep 0.3", shell=True), job_name
+
+    jobs = [(i, f"job.{i}", f"train {'aabb'[i % 4]}") for i in range(8)]
+    schedule(jobs, machine_states, machine_config, launch, lambda *args: None, LaunchRateLimiter(None), locality=locality)
+    return placed, locality
+
+
+def test_schedule_places_jobs_with_their_inputs(tmp_path):
+    placed, locality = run_batch(tmp_path, 200.0)
+    assert len({machine_idx for name, machine_idx in placed if name == "a"}) == 1
+    assert len({machine_idx for name, machine_idx in placed if name == "b"}) == 1
+    assert locality.hits == 6
+    assert locality.bytes_avoided == 6 * 2**20
+    # by load alone, each dataset is sent to both machines
+    placed, locality = run_batch(tmp_path, 0.0)
+    assert locality.hits == 4
+    assert len({machine_idx for name, machine_idx in placed if name == "a"}) == 2
@@ -1,6 +1,8 @@
 import copy
-from ssh_scheduler.machine_cost_model import init_machine_limit, add_to_machine_state, remove_from_machine_state
-from ssh_scheduler.machine_cost_model import machine_cost, get_best_gpu, get_process_gpu_limit, is_over_limit
+import math
+import random
+from ssh_scheduler.machine_cost_model import init_machine_limit, add_to_machine_state, remove_from_machine_state, ResourceLedger, MachineIndex, get_best_machine
+from ssh_scheduler.machine_cost_model import machine_cost, get_best_gpu, get_process_gpu_limit, is_over_limit, pick_cpus
 
 class ExampleArgs:
     def __init__(self):
@@ -41,3 +43,228 @@ def test_invertible():
             machine_state = remove_from_machine_state(machine_state, i)
 
     assert machine_state == orig_machine_state
+
+
+def assert_states_close(state, expected):
+    for key in ['reserved', 'cpu_usage', 'mem_free']:
+        assert math.isclose(state[key], expected[key], abs_tol=1e-9), key
+    for gpu, expected_gpu in zip(state['gpus'], expected['gpus']):
+        for key in ['reserved', 'free', 'utilization']:
+            assert math.isclose(gpu[key], expected_gpu[key], abs_tol=1e-9), key
+
+
+def test_ledger_random_interleavings():
+    machine_args = ExampleArgs()
+    machine_args.no_reserve_gpu = False
+    machine_args.reserve = True
+    for seed in range(20):
+        rng = random.Random(seed)
+        machine_states = [copy.deepcopy(example_machine_state) for _ in range(3)]
+        for state in machine_states:
+            init_machine_limit(state)
+        orig_states = copy.deepcopy(machine_states)
+        ledger = ResourceLedger(machine_states)
+        placed = {}
+        for job_id in range(200):
+            if placed and rng.random() < 0.45:
+                release_id = rng.choice(list(placed))
+                reservation = ledger.release(release_id)
+                assert (reservation.machine_idx, reservation.gpu_idx) == placed.pop(release_id)
+            else:
+                machine_idx, gpu_idx = rng.randrange(3), rng.randrange(2)
+                ledger.allocate(job_id, machine_idx, gpu_idx, machine_args)
+                placed[job_id] = (machine_idx, gpu_idx)
+        for job_id in rng.sample(list(placed), len(placed)):
+            ledger.release(job_id)
+        assert not ledger.reservations
+        for state, orig_state in zip(machine_states, orig_states):
+            assert_states_close(state, orig_state)
+
+
+def test_ledger_releases_the_finished_job():
+    machine_args = ExampleArgs()
+    machine_state = copy.deepcopy(example_machine_state)
+    init_machine_limit(machine_state)
+    ledger = ResourceLedger([machine_state])
+    ledger.allocate("first", 0, 0, machine_args)
+    ledger.allocate("second", 0, 1, machine_args)
+    # the first job finishes before the one placed after it
+    ledger.release("first")
+    assert math.isclose(machine_state['gpus'][0]['utilization'], 0.0, abs_tol=1e-9)
+    assert math.isclose(machine_state['gpus'][1]['utilization'], machine_args.gpu_utilization)
+
+
+def test_ledger_without_gpus():
+    machine_args = ExampleArgs()
+    machine_args.no_gpu_required = True
+    machine_state = {"cpu_usage": 0.0, "mem_free": 30607, "cpu_count": 24, "gpus": []}
+    init_machine_limit(machine_state)
+    assert get_best_gpu(machine_args, machine_state) is None
+    ledger = ResourceLedger([machine_state])
+    ledger.allocate(0, 0, None, machine_args)
+    assert machine_state['mem_free'] == 30607 - machine_args.memory_required
+    ledger.release(0)
+    assert machine_state['mem_free'] == 30607
+
+
+def test_index_matches_argmin():
+    machine_args = ExampleArgs()
+    rng = random.Random(0)
+    machine_states = []
+    for i in range(12):
+        state = copy.deepcopy(example_machine_state)
+        state['cpu_usage'] = rng.choice([0.0, 0.1, 0.5])
+        init_machine_limit(state)
+        machine_states.append(state)
+    index = MachineIndex(machine_states, machine_args)
+    ledger = ResourceLedger(machine_states, on_change=index.update)
+    for job_id in range(2000):
+        assert index.best() == get_best_machine(machine_states, machine_args)
+        if ledger.reservations and rng.random() < 0.5:
+            ledger.release(rng.choice(list(ledger.reservations)))
+        else:
+            best = index.best()
+            ledger.allocate(job_id, best, get_best_gpu(machine_args, machine_states[best]), machine_args)
+
+
+def test_index_matches_argmin_with_staged():
+    machine_args = ExampleArgs()
+    rng = random.Random(1)
+    machine_states = []
+    for i in range(12):
+        state = copy.deepcopy(example_machine_state)
+        state['cpu_usage'] = rng.choice([0.0, 0.1, 0.5])
+        init_machine_limit(state)
+        machine_states.append(state)
+    index = MachineIndex(machine_states, machine_args)
+    ledger = ResourceLedger(machine_states, on_change=index.update)
+    for job_id in range(2000):
+        staged = set(rng.sample(range(12), rng.randint(0, 3)))
+        transfer_cost = rng.choice([0, 1e7, 1e8, 1e9])
+        best = index.best(staged, transfer_cost)
+        assert best == get_best_machine(machine_states, machine_args, staged, transfer_cost)
+        if ledger.reservations and rng.random() < 0.5:
+            ledger.release(rng.choice(list(ledger.reservations)))
+        else:
+            ledger.allocate(job_id, best, get_best_gpu(machine_args, machine_states[best]), machine_args)
+
+
+def test_ledger_refresh_does_not_double_count():
+    machine_args = ExampleArgs()
+    machine_state = copy.deepcopy(example_machine_state)
+    init_machine_limit(machine_state)
+    ledger = ResourceLedger([machine_state])
+    ledger.allocate("job", 0, 0, machine_args)
+    fresh = copy.deepcopy(example_machine_state)
+    fresh['mem_total'] = 32000
+    # our job is actually using its memory, someone else started using gpu 1
+    fresh['mem_free'] = 30607 - machine_args.memory_required
+    fresh['gpus'][1]['utilization'] = 0.9
+    ledger.refresh(0, fresh)
+    assert machine_state['mem_free'] == 30607 - machine_args.memory_required
+    assert machine_state['gpus'][0]['utilization'] == machine_args.gpu_utilization
+    assert machine_state['gpus'][1]['utilization'] == 0.9
+    ledger.release("job")
+    assert machine_state['mem_free'] == 30607
+    assert machine_state['gpus'][1]['utilization'] == 0.9
+
+    ledger.drain(0)
+    assert is_over_limit(machine_cost(machine_args, machine_state))
+    ledger.refresh(0, fresh)
+    assert not is_over_limit(machine_cost(machine_args, machine_state))
+
+
+def four_gpu_state():
+    gpu = {"name": "A100", "mem": 40000, "free": 40000, "utilization": 0.0}
+    state = {"cpu_usage": 0.0, "mem_free": 100000, "cpu_count": 64, "gpus": [dict(gpu) for _ in range(4)]}
+    # 0-1 and 2-3 are nvlinked, 0-2 and 1-3 share a pcie switch
+    state["gpu_links"] = [
+        ["X", "NV4", "PXB", "SYS"],
+        ["NV4", "X", "SYS", "PXB"],
+        ["PXB", "SYS", "X", "NV4"],
+        ["SYS", "PXB", "NV4", "X"],
+    ]
+    init_machine_limit(state)
+    return state
+
+
+def test_multi_gpu_sets():
+    machine_args = ExampleArgs()
+    machine_args.no_reserve_gpu = False
+    machine_args.num_gpus = 2
+    state = four_gpu_state()
+    assert get_best_gpu(machine_args, state) == (0, 1)
+    ledger = ResourceLedger([state])
+    ledger.allocate("first", 0, (0, 1), machine_args)
+    assert get_best_gpu(machine_args, state) == (2, 3)
+    ledger.allocate("second", 0, (2, 3), machine_args)
+    third = get_best_gpu(machine_args, state)
+    ledger.allocate("third", 0, third, machine_args)
+    assert is_over_limit(machine_cost(machine_args, state, third))
+    ledger.release("third")
+    ledger.release("first")
+    assert [gpu['reserved'] for gpu in state['gpus']] == [0, 0, 1, 1]
+    assert get_process_gpu_limit(four_gpu_state(), machine_args) == [(0, 1), (2, 3)]
+    machine_args.num_gpus = 8
+    assert get_best_gpu(machine_args, state) is None
+    assert is_over_limit(machine_cost(machine_args, state))
+
+
+def test_placed_gpu_is_checked():
+    machine_args = ExampleArgs()
+    machine_state = copy.deepcopy(example_machine_state)
+    init_machine_limit(machine_state)
+    machine_state['gpus'][0]['utilization'] = 1.2
+    # gpu 1 is free, but a job placed on gpu 0 overloads it
+    assert not is_over_limit(machine_cost(machine_args, machine_state))
+    assert is_over_limit(machine_cost(machine_args, machine_state, 0))
+
+
+def test_pinned_cpus_follow_gpu_numa():
+    machine_args = ExampleArgs()
+    machine_args.pin_cpus = True
+    machine_args.num_cpus = 8
+    state = four_gpu_state()
+    # gpus 0-1 are on the numa node of cpus 0-15, gpus 2-3 on that of 16-31
+    state["cpu_count"] = 32
+    state["numa_cpus"] = [list(range(16)), list(range(16, 32))]
+    state["gpu_numa"] = [0, 0, 1, 1]
+    ledger = ResourceLedger([state])
+    assert ledger.allocate("a", 0, 2, machine_args).cpus == list(range(16, 24))
+    assert ledger.allocate("b", 0, 0, machine_args).cpus == list(range(8))
+    assert ledger.allocate("c", 0, 3, machine_args).cpus == list(range(24, 32))
+    # node 1 is full, so the job goes where there is room
+    assert ledger.allocate("d", 0, 2, machine_args).cpus == list(range(8, 16))
+    assert not is_over_limit(machine_cost(machine_args, state, 2))
+    ledger.allocate("e", 0, 1, machine_args)
+    assert is_over_limit(machine_cost(machine_args, state, 1))
+    ledger.release("e")
+    ledger.release("a")
+    assert state["free_cpu_count"] == 8
+    assert ledger.allocate("f", 0, 1, machine_args).cpus == list(range(16, 24))
+
+
+def test_pick_cpus_splits_only_when_no_node_fits():
+    numa_cpus = [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert pick_cpus(numa_cpus, {1, 2, 3, 4, 5}, 2) == [1, 2]
+    assert pick_cpus(numa_cpus, {1, 2, 3, 4, 5}, 2, nodes={1}) == [4, 5]
+    assert pick_cpus(numa_cpus, {2, 3, 4, 5, 6}, 4) == [4, 5, 6, 2]
+    assert pick_cpus(numa_cpus, {0}, 2) == [0]
+
+
+def test_best_fit_scores_the_jobs_own_size():
+    machine_args = ExampleArgs()
+    machine_args.no_gpu_required = True
+    # the least loaded machine has little memory left
+    small = {"cpu_usage": 0.0, "mem_free": 3000, "cpu_count": 24, "gpus": []}
+    large = {"cpu_usage": 0.5, "mem_free": 30000, "cpu_count": 24, "gpus": []}
+    machine_states = [small, large]
+    for state in machine_states:
+        init_machine_limit(state)
+    index = MachineIndex(machine_states, machine_args)
+    assert index.best_fit(machine_args) == index.best() == 0
+    sized = copy.copy(machine_args)
+    sized.memory_required = 10000
+    assert index.best_fit(sized) == 1
+    # scoring left the states as they were
+    assert small["mem_free"] == 3000 and large["mem_free"] == 30000
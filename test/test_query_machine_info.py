@@ -0,0 +1,63 @@
+import os
+import json
+import subprocess
+from ssh_scheduler.query_machine_info import parse_full_output, parse_proc_output, parse_gpu_topology, parse_numa_layout, get_proc_command
+from ssh_scheduler.better_basic_run import remote_python_command, remote_script
+
+data_path = os.path.join(os.path.dirname(__file__), "data")
+
+
+def read_fixture(name):
+    return open(os.path.join(data_path, name)).read()
+
+
+def test_parse_proc_fixture():
+    info = parse_proc_output(read_fixture("proc_probe_output.txt"))
+    # 250 busy jiffies out of 950 between the two samples
+    assert abs(info['cpu_usage'] - 250 / 950) < 1e-9
+    assert info['mem_free'] == 50184932 // 1024
+    assert info['mem_total'] == 65849456 // 1024
+    assert info['cpu_count'] == 24
+    assert info['gpus'][1] == {"name": "GeForce RTX 2060", "mem": 5932, "free": 1931, "utilization": 0.45}
+
+
+def test_probes_agree_on_fixtures():
+    proc_info = parse_proc_output(read_fixture("proc_probe_output.txt"))
+    top_info = parse_full_output(read_fixture("top_probe_output.txt"))
+    for key in ['mem_free', 'mem_total', 'cpu_count']:
+        assert proc_info[key] == top_info[key]
+    assert [gpu['free'] for gpu in proc_info['gpus']] == [gpu['free'] for gpu in top_info['gpus']]
+
+
+def test_proc_probe_runs_locally():
+    out = subprocess.run(get_proc_command(0.05), shell=True, stdout=subprocess.PIPE, check=True)
+    info = parse_proc_output(out.stdout.decode("utf-8"))
+    assert 0 <= info['cpu_usage'] <= 1
+    assert 0 < info['mem_free'] <= info['mem_total']
+    assert info['cpu_count'] == os.cpu_count()
+
+
+def test_metrics_agent_streams_snapshots():
+    agent = remote_python_command({}, remote_script("metrics_agent.py"), "0.05")
+    proc = subprocess.Popen(agent, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    snapshots = [json.loads(proc.stdout.readline()) for _ in range(2)]
+    proc.stdin.close()
+    assert proc.wait(timeout=5) == 0
+    for snapshot in snapshots:
+        assert set(snapshot) == {"cpu_usage", "mem_free", "mem_total", "cpu_count", "gpus"}
+
+
+def test_parse_gpu_topology():
+    links = parse_gpu_topology(read_fixture("gpu_topology.txt"))["gpu_links"]
+    assert links[0] == ["X", "NV4", "PXB", "SYS"]
+    assert links[3][2] == "NV4"
+    assert len(links) == 4
+    assert parse_gpu_topology("") == {}
+
+
+def test_parse_numa_layout():
+    numa_cpus = parse_numa_layout(read_fixture("numa_layout.txt"))["numa_cpus"]
+    assert numa_cpus == [list(range(16)), list(range(16, 32))]
+    assert parse_numa_layout("# CPU,Node\n0,\n1,\n") == {"numa_cpus": [[0, 1]]}
+    assert parse_numa_layout("") == {}
+    assert parse_gpu_topology(read_fixture("gpu_topology.txt"))["gpu_numa"] == [0, 0, 1, 1]
@@ -0,0 +1,199 @@
+import os
+import io
+import shutil
+import time
+import tarfile
+import subprocess
+import pytest
+from ssh_scheduler.better_basic_run import CleanupShellProcess, PackMember, remote_python_command, remote_script, job_script, cpu_list
+from ssh_scheduler import stream_demux
+from ssh_scheduler.stream_demux import StreamDemux, PackDemux
+from ssh_scheduler.remote_framer import write_frame, STDOUT, RESULTS, EXIT, END
+
+data_path = os.path.join(os.path.dirname(__file__), "data", "sed_data.txt")
+
+
+def run_framed(tmp_path, script, copy_backwards=(), inputs=None, copy_back_all=False, compress=None):
+    '''inputs maps the names of files in the job folder before it runs to their contents'''
+    os.makedirs(tmp_path / "job" / "tmp")
+    with open(tmp_path / "job" / "tmp" / "job.sh", 'w') as file:
+        file.write(script)
+    for name, contents in (inputs or {}).items():
+        os.makedirs(os.path.dirname(tmp_path / "job" / name), exist_ok=True)
+        with open(tmp_path / "job" / name, 'w') as file:
+            file.write(contents)
+    flags = (["--copy-back-all"] if copy_back_all else []) + (["--compress", compress] if compress else [])
+    framer = remote_python_command({}, remote_script("remote_framer.py"), " ".join([*flags, "tmp/job.sh", *copy_backwards]))
+    stdout = open(tmp_path / "job.out", 'wb')
+    stderr = open(tmp_path / "job.err", 'wb')
+    demux = StreamDemux(stdout, stderr, str(tmp_path / "results") if copy_backwards else None)
+    proc = CleanupShellProcess(f"cd {tmp_path / 'job'} && {framer}", demux=demux, stderr=stderr)
+    proc.wait()
+    stdout.close()
+    stderr.close()
+    return proc.returncode
+
+
+def test_binary_output_and_results(tmp_path):
+    # the output holds control characters, nulls and no trailing newline
+    script = f"cat {data_path}\necho to stderr >&2\nhead -c 300000 /dev/urandom > big.bin\necho done > small.txt\n"
+    assert run_framed(tmp_path, script, ["big.bin", "small.txt"]) == 0
+    assert open(tmp_path / "job.out", 'rb').read() == open(data_path, 'rb').read()
+    assert b"to stderr" in open(tmp_path / "job.err", 'rb').read()
+    assert open(tmp_path / "results" / "big.bin", 'rb').read() == open(tmp_path / "job" / "big.bin", 'rb').read()
+    assert open(tmp_path / "results" / "small.txt").read() == "done\n"
+
+
+def test_only_changed_results(tmp_path):
+    inputs = {"data/input.txt": "input", "data/edited.txt": "old", "checkpoint.bin": "untouched"}
+    script = "echo new > data/new.txt\necho newer >> data/edited.txt\nhead -c 9000000 /dev/zero > big.bin\n"
+    assert run_framed(tmp_path / "changed", script, ["."], inputs) == 0
+    results = tmp_path / "changed" / "results"
+    assert sorted(os.listdir(results)) == ["big.bin", "data"]
+    assert sorted(os.listdir(results / "data")) == ["edited.txt", "new.txt"]
+    # big enough to come back gzipped
+    assert os.path.getsize(results / "big.bin") == 9000000
+
+    assert run_framed(tmp_path / "all", script, ["data"], inputs, copy_back_all=True) == 0
+    assert sorted(os.listdir(tmp_path / "all" / "results" / "data")) == ["edited.txt", "input.txt", "new.txt"]
+
+
+@pytest.mark.parametrize("codec", ["zstd:3", "lz4", "gzip:6"])
+def test_compressed_results(tmp_path, codec):
+    if not shutil.which(codec.split(":")[0]):
+        pytest.skip(f"{codec} is not installed")
+    script = f"for i in $(seq 20000); do echo line $i; done > lines.txt\ncp {data_path} data.txt\n"
+    assert run_framed(tmp_path, script, ["lines.txt", "data.txt"], compress=codec) == 0
+    assert open(tmp_path / "results" / "lines.txt").read() == open(tmp_path / "job" / "lines.txt").read()
+    assert open(tmp_path / "results" / "data.txt", 'rb').read() == open(data_path, 'rb').read()
+    assert b"could not unpack" not in open(tmp_path / "job.err", 'rb').read()
+
+
+def results_archive(members):
+    '''(name, data or None for a symlink, its target) -> frames of a results archive and the job's end'''
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for name, data, target in members:
+            info = tarfile.TarInfo(name)
+            info.mtime = 1000
+            if data is None:
+                info.type, info.linkname = tarfile.SYMTYPE, target
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    frames = io.BytesIO()
+    write_frame(frames, RESULTS, archive.getvalue())
+    write_frame(frames, EXIT, b"\0\0\0\0")
+    write_frame(frames, END)
+    frames.seek(0)
+    return frames
+
+
+@pytest.mark.parametrize("data_filter", [True, False])
+def test_results_stay_in_folder(tmp_path, monkeypatch, data_filter):
+    if not data_filter:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+        monkeypatch.setattr(stream_demux, "EXTRACT_OPTIONS", {})
+    elif not hasattr(tarfile, "data_filter"):
+        pytest.skip("tarfile has no extraction filters")
+    results = tmp_path / "results"
+    stderr = io.BytesIO()
+    StreamDemux(io.BytesIO(), stderr, str(results)).run(results_archive([("out/kept.txt", b"kept", None)]))
+    assert open(results / "out" / "kept.txt", 'rb').read() == b"kept"
+    # extracted at, not made at, like tar xm
+    assert os.stat(results / "out" / "kept.txt").st_mtime > time.time() - 60
+    for members in (
+        [("../escaped.txt", b"escaped", None)],
+        [("link", None, str(tmp_path)), ("link/escaped.txt", b"escaped", None)],
+        [("link", None, "../.."), ("link/escaped.txt", b"escaped", None)],
+    ):
+        stderr = io.BytesIO()
+        StreamDemux(io.BytesIO(), stderr, str(results)).run(results_archive(members))
+        assert b"could not unpack results" in stderr.getvalue()
+        assert not os.path.exists(tmp_path / "escaped.txt")
+        assert not os.path.exists(results / "link")
+    StreamDemux(io.BytesIO(), io.BytesIO(), str(results)).run(results_archive([("/tmp/escaped.txt", b"escaped", None)]))
+    assert not os.path.exists("/tmp/escaped.txt")
+    assert open(results / "tmp" / "escaped.txt", 'rb').read() == b"escaped"
+
+
+def test_exit_code(tmp_path):
+    assert run_framed(tmp_path, "echo failing\nexit 3\n") == 3
+    assert open(tmp_path / "job.out").read() == "failing\n"
+
+
+def test_job_script_env(tmp_path):
+    script = job_script("echo $CUDA_VISIBLE_DEVICES", ".pid.txt", {"CUDA_VISIBLE_DEVICES": "0,2"})
+    subprocess.run(f"printf '{script}' > {tmp_path / 'job.sh'}", shell=True, check=True)
+    out = subprocess.run(["bash", str(tmp_path / "job.sh")], cwd=tmp_path, stdout=subprocess.PIPE, check=True)
+    assert out.stdout == b"0,2\n"
+
+
+def test_job_script_pins_cpus(tmp_path):
+    assert cpu_list([5, 0, 1, 2, 7, 8]) == "0-2,5,7-8"
+    script = job_script("grep Cpus_allowed_list /proc/self/status", ".pid.txt", cpus=[0])
+    subprocess.run(f"printf '{script}' > {tmp_path / 'job.sh'}", shell=True, check=True)
+    out = subprocess.run(["bash", str(tmp_path / "job.sh")], cwd=tmp_path, stdout=subprocess.PIPE, check=True)
+    assert out.stdout.split() == [b"Cpus_allowed_list:", b"0"]
+
+
+def test_disconnect_without_exit_frame():
+    stream = io.BytesIO()
+    write_frame(stream, STDOUT, b"partial")
+    stdout = io.BytesIO()
+    demux = StreamDemux(stdout, io.BytesIO())
+    demux.run(io.BytesIO(stream.getvalue()))
+    assert stdout.getvalue() == b"partial"
+    assert demux.returncode is None
+
+
+def test_pack(tmp_path):
+    os.makedirs(tmp_path / "job" / "tmp")
+    scripts = []
+    for i in range(3):
+        scripts.append(f"tmp/job{i}.sh")
+        with open(tmp_path / "job" / scripts[-1], 'w') as file:
+            file.write(f"echo out {i}\necho err {i} >&2\necho {i} > result.txt\nexit {i}\n")
+    framer = remote_python_command({}, remote_script("remote_framer.py"), " ".join(["--pack", "2", *scripts, "--", "result.txt"]))
+    demuxes = [
+        StreamDemux(open(tmp_path / f"job{i}.out", 'wb'), open(tmp_path / f"job{i}.err", 'wb'), str(tmp_path / f"results{i}"))
+        for i in range(3)
+    ]
+    pack_demux = PackDemux(demuxes)
+    proc = CleanupShellProcess(f"cd {tmp_path / 'job'} && {framer}", demux=pack_demux)
+    assert proc.wait() == 0
+    members = [PackMember(proc, demux, reader) for demux, reader in zip(demuxes, pack_demux.readers)]
+    assert [member.wait() for member in members] == [0, 1, 2]
+    for i, demux in enumerate(demuxes):
+        demux.stdout.close()
+        demux.stderr.close()
+        assert open(tmp_path / f"job{i}.out").read() == f"out {i}\n"
+        assert f"err {i}" in open(tmp_path / f"job{i}.err").read()
+        assert open(tmp_path / f"results{i}" / "result.txt").read() == f"{i}\n"
+
+
+def test_parallel_pack_results_are_separate(tmp_path):
+    os.makedirs(tmp_path / "job" / "tmp")
+    os.makedirs(tmp_path / "job" / "out")
+    with open(tmp_path / "job" / "input.txt", 'w') as file:
+        file.write("forwarded\n")
+    scripts = []
+    for i in range(2):
+        scripts.append(f"tmp/job{i}.sh")
+        with open(tmp_path / "job" / scripts[-1], 'w') as file:
+            # both run at once, each writing its own file while the other runs
+            file.write(f"cat input.txt > out/job{i}.txt\nsleep 0.5\n")
+    framer = remote_python_command({}, remote_script("remote_framer.py"), " ".join(["--pack", "2", *scripts, "--", "out"]))
+    demuxes = [
+        StreamDemux(open(os.devnull, 'wb'), open(tmp_path / f"job{i}.err", 'wb'), str(tmp_path / f"results{i}"))
+        for i in range(2)
+    ]
+    pack_demux = PackDemux(demuxes)
+    proc = CleanupShellProcess(f"cd {tmp_path / 'job'} && {framer}", demux=pack_demux)
+    assert proc.wait() == 0
+    members = [PackMember(proc, demux, reader) for demux, reader in zip(demuxes, pack_demux.readers)]
+    assert [member.wait() for member in members] == [0, 0]
+    for i in range(2):
+        assert os.listdir(tmp_path / f"results{i}" / "out") == [f"job{i}.txt"]
+        assert open(tmp_path / f"results{i}" / "out" / f"job{i}.txt").read() == "forwarded\n"